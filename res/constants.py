@@ -13,17 +13,34 @@ INCLUDE_NPCS = True             # True if you want to include the NPCs of the ch
 STATUS = "timeout"          # closed, open, timeout, all
 TYPE = "all"                # channel, thread, DM, all
 MODE = "end"                # start, end
+SCENE_RENDERER = "local"    # local (render the scenes from the backup), dce (download them again with DCE)
 
 # Feedback settings
 INFO = True             # True if you want to know what the script is doing
 DEBUG = True           # True if you want to see an insane amount of information
 CONSOLE = False          # True if you want to see the output of DCE console commands
 LOG = True              # True if you want to save absolutely all the info into a log file
+TRACE = True            # True if you want to save how long each step, category and channel takes into a trace file
+
+# Performance settings
+WORKERS = None          # Number of parallel processes for the heavy steps. None uses all the CPU cores
+EXPORT_CONCURRENCY = 5      # Number of channels DCE exports at the same time
+DM_EXPORT_CONCURRENCY = 3   # Number of channels DCE exports at the same time in DM categories, which are bigger
+EXPORT_MAX_CONCURRENCY = 10 # Highest number of channels DCE exports at the same time, when Discord doesn't rate limit the exports
+EXPORT_RETRIES = 5          # Number of times an export is retried after a rate limit or a network error
+EXPORT_BACKOFF = 2          # Seconds to wait before the first retry. It doubles with each retry
+EXPORT_BACKOFF_MAX = 60     # Maximum seconds to wait before a retry
+EXPORT_STALL_TIMEOUT = 600  # Seconds an export can go without printing any progress before it's killed and retried
+SHARD_MESSAGES = 50000      # Channels expected to download more messages than this are split in date ranges exported at the same time. 0 to disable
+SHARD_COUNT = 4             # Maximum number of date ranges a channel is split in
+BUNDLE_CHUNK = 1048576      # Bytes of each chunk compressed in parallel when creating a zip. Also limits the memory it uses
+BUNDLE_LEVEL = 6            # Compression level of the zips, from 1 (fastest) to 9 (smallest)
 
 # Result file parameters
 OUTPUT_SCENES = "f{SEARCH_FOLDER}/scenes.json"
 OUTPUT_LINKS = "f{SEARCH_FOLDER}/scene-links.txt"
 LOG_FILE = "out/log.txt"
+TRACE_FILE = "out/trace.jsonl"
 
 # File parameters
 CHARACTER_LIST = "res/character_list.json"
@@ -31,6 +48,22 @@ BACKUP_INFO = "res/backup_info.json"
 FIXED_MESSAGES = "res/fixed_messages.json"
 BAD_MESSAGES =  "res/bad_messages.json"
 BAD_END_MESSAGES = "res/bad_end_messages.json"
+MESSAGE_INDEX = "res/message_index.json"
+CHANNEL_MANIFEST = "res/channel_manifest.json"
+EXPORT_JOURNAL = "res/export_journal.jsonl"
+LAYOUT_MANIFEST = "res/file_layout.json"
+BACKUP_MANIFEST = "res/backup_manifest.sqlite"
+BACKUP_STATE = "res/backup_state.jsonl"
+BACKUP_LOCK = "res/backup.lock"
+PIPELINE_STATE = "res/pipeline.json"
+STATE_SNAPSHOT_EVERY = 200  # Number of status changes appended to BACKUP_STATE before it's compacted into a snapshot
+SHARD_FOLDER = "Shards"
+SCENE_CACHE = "out/SceneCache" # exported scenes, shared by all characters, so they are not exported again
+
+# DCE parameters
+DCE_COMMAND = ["dotnet", "DCE/DiscordChatExporter.Cli.dll"]     # Program and arguments to call DCE
+EXPORTER = "dce"        # "dce" to export channels with DCE, "native" to export them with discord.py in the same process
+DISCORD_API = None      # URL of the Discord API for the native exporter, like "http://127.0.0.1:8080/api/v10". None uses Discord's
 
 # Discord parameters
 from res import server_data as s
@@ -1,7 +1,12 @@
 import os
 import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 import tricks as t
 import exceptions as exc
+import tracing
+import backup_state as bs
+import backup_manifest as bm
 t.set_path()
 from res import constants as c
 
@@ -19,6 +24,13 @@ Main function: assign_ids(search_folder)
     unique ID, updates the original JSON files with these IDs, and saves the mapping back to the character 
     ID file for future reference.
 
+    The work is split in three phases, so the files can be processed in parallel:
+    worker processes collect the bot names of each file, then new IDs are given out in order of first appearance,
+    and finally the workers rewrite the author IDs in each file. The resulting IDs are the same on every run.
+
+    Files that didn't change since they were recorded in the backup manifest are not opened: their bot names
+    are taken from the manifest, and they are only rewritten if one of their bots has a different ID.
+
 """
 
 ################ Functions #################
@@ -37,24 +49,19 @@ def check_base_status():
     try: 
         t.log("debug", "\nChecking the status of the backup...")
 
-        backup_info = t.load_from_json(c.BACKUP_INFO)
+        bs.acquire("assign_ids")
+        state = bs.load_state()
 
         t.log("debug", "  Loaded the status file\n")
 
-        main_status = backup_info["status"] + ""
+        main_status = state["status"] + ""
 
         t.log("debug", f"  The current status of the backup is '{main_status}'\n")
 
-        if backup_info["status"] == "running":
-            raise exc.AlreadyRunningError("The export is still running in another process. Exiting...")
-
-        if backup_info["status"] == "failed":
+        if state["status"] == "failed":
             raise exc.DataNotReadyError("The data may be corrupted. Ensure the backup downloaded successfully and try again.")
 
-        backup_info["status"] = "running"
-        backup_info["steps"]["idAssignStatus"] = "running"
-
-        t.save_to_json(backup_info, c.BACKUP_INFO)
+        bs.update_state(status="running", steps={"idAssignStatus": "running"})
 
         return main_status
 
@@ -210,55 +217,136 @@ def get_all_character_ids(name):
     return ids
 
 """
-assign_ids_in_file(data, characters_json, lookup_map)
+collect_names_in_file(file_path)
 
-    Assigns unique IDs to the Tupperbox bots in the given data and updates the ID mapping accordingly.
+    First phase of the ID assignment. Collects the names of all the Tupperbox bots in a channel file,
+    along with the ID of the first message each of them sent.
 
-    This function iterates through the messages in the given data and assigns a unique identifier to each bot character.
-    If the character is not already assigned an ID, a new one is assigned and added to the ID mapping. The function then updates
-    the author's ID in the message.
+    Since Discord message IDs are snowflakes, they grow with time, so the smallest ID is the earliest message.
+    It's meant to run in a worker process, so it doesn't modify anything.
 
     Args:
         file_path (str): The JSON file of the channel, containing a list of messages.
-        characters_json (dict): A dictionary containing character information.
-        lookup_map (dict): A dictionary mapping character names to their respective unique IDs.
 
     Returns:
-        None
+        dict: A dictionary mapping bot names to the ID of their earliest message in the file.
 """
-def assign_ids_in_file(file_path, characters_json, lookup_map):
+def collect_names_in_file(file_path):
 
-    t.log("debug", f"\t    Analysing {file_path}...")
-
-    # Load channel JSON data from file
     data = t.load_from_json(file_path)
 
+    names = {}
+
     for message in data["messages"]:
 
         #only do this for tuppers
         if message["author"]["isBot"]:
             author_name = message["author"]["name"]
+            message_id = int(message["id"])
 
-            # If the character is not already in the list, add it
-            if author_name not in lookup_map:
-                new_id = len(lookup_map) + 1
-                new_character = character_info(new_id, author_name)
-                characters_json.append(new_character)
+            if author_name not in names or message_id < names[author_name]:
+                names[author_name] = message_id
 
-                lookup_map[author_name] = new_id
+    return names
+
+"""
+allocate_new_ids(found_names, characters_json, lookup_map)
+
+    Second phase of the ID assignment. Gives an ID to every bot name that is not in the lookup map yet.
+
+    New names are sorted by their earliest message (and then by name, in case of a tie),
+    so the result is the same on every run no matter in which order the files were processed.
+
+    Args:
+        found_names (dict): A dictionary mapping bot names to the ID of their earliest message in the backup.
+        characters_json (list): A list of JSON objects representing characters.
+        lookup_map (dict): A dictionary mapping character names to their respective unique IDs.
+
+    Returns:
+        int: The number of new characters.
+"""
+def allocate_new_ids(found_names, characters_json, lookup_map):
+
+    new_names = [name for name in found_names if name not in lookup_map]
+    new_names.sort(key=lambda name: (found_names[name], name))
+
+    for author_name in new_names:
+        new_id = len(lookup_map) + 1
+        characters_json.append(character_info(new_id, author_name))
+
+        lookup_map[author_name] = new_id
+
+        t.log("info", f"\t  Found a new Tupper: {author_name} (ID: {new_id})")
+
+    return len(new_names)
+
+"""
+rewrite_ids_in_file(file_path, lookup_map)
+
+    Third phase of the ID assignment. Updates the author ID of every Tupperbox message in a channel file.
+    It's meant to run in a worker process, once all the IDs have been allocated.
+
+    Args:
+        file_path (str): The JSON file of the channel, containing a list of messages.
+        lookup_map (dict): A dictionary mapping character names to their respective unique IDs.
+
+    Returns:
+        dict: The information of the saved file, for the backup manifest.
+"""
+def rewrite_ids_in_file(file_path, lookup_map):
+
+    t.log("debug", "\t    Analysing %s...", file_path)
+
+    data = t.load_from_json(file_path)
+
+    for message in data["messages"]:
+
+        #only do this for tuppers
+        if message["author"]["isBot"]:
 
-                t.log("info", f"\t  Found a new Tupper: {author_name} (ID: {new_id})")
-                t.save_to_json(characters_json, c.CHARACTER_LIST)
-         
             # Update the author's ID in the message
-            message["author"]["id"] = f"{lookup_map[author_name]}"
+            message["author"]["id"] = f"{lookup_map[message['author']['name']]}"
 
     # Save the updated JSON data to the file
     t.save_to_json(data, file_path)
+
+    return bm.describe(file_path, data)
+
+"""
+needs_rewrite(entry, lookup_map)
+
+    Checks if a file recorded in the backup manifest has a bot whose messages don't all have its ID.
+
+"""
+def needs_rewrite(entry, lookup_map):
+    return any(bot["ids"] != [f"{lookup_map[name]}"] for name, bot in entry["bots"].items())
+
+"""
+list_channel_files(search_folder)
+
+    Lists all the channel and thread files in the folder and its subfolders, in a stable order.
+
+    Args:
+        search_folder (str): The folder to search in.
+
+    Returns:
+        list: A sorted list of file paths.
+"""
+def list_channel_files(search_folder):
+
+    file_paths = []
+
+    for root, dirs, files in os.walk(search_folder):
+        for filename in files:
+            if filename.endswith(".json") and not filename.endswith("scenes.json"):
+                file_paths.append(os.path.join(root, filename))
+
+    return sorted(file_paths)
     
 
 ################# Main function #################
 
+@tracing.traced("step")
 def assign_ids(search_folder=c.SEARCH_FOLDER):
 
     try:
@@ -284,16 +372,45 @@ def assign_ids(search_folder=c.SEARCH_FOLDER):
 
         t.log("debug", f"\tIterating over backup files in {search_folder}...\n")  
 
-        # Iterate over all channel JSON files in the folder and its subfolders
-        for root, dirs, files in os.walk(search_folder):
-            for filename in files:
-                if filename.endswith(".json") and not filename.endswith("scenes.json"):
+        file_paths = list_channel_files(search_folder)
+
+        t.log("debug", f"\t  Found {len(file_paths)} files\n")
+
+        with bm.open_manifest() as manifest, ProcessPoolExecutor(max_workers=c.WORKERS) as pool:
+
+            entries = {file_path: bm.lookup(manifest, file_path) for file_path in file_paths}
+            changed_paths = [file_path for file_path, entry in entries.items() if entry is None]
+
+            t.log("debug", f"\t  {len(changed_paths)} files changed since they were recorded\n")
+
+            # Phase 1: collect the bot names of each file in parallel, or from the manifest if it didn't change
+            found_names = {}
+            file_names = [{name: bot["first"] for name, bot in entry["bots"].items()} for entry in entries.values() if entry is not None]
+
+            for names in file_names + list(pool.map(collect_names_in_file, changed_paths, chunksize=8)):
+                for name, first_id in names.items():
+                    if name not in found_names or first_id < found_names[name]:
+                        found_names[name] = first_id
+
+            # Phase 2: give IDs to the new names in a deterministic order
+            new_characters = allocate_new_ids(found_names, characters_json, lookup_map)
+
+            if new_characters > 0:
+                t.save_to_json(characters_json, c.CHARACTER_LIST)
+
+            # Phase 3: rewrite the author IDs of each file in parallel, skipping the files that already have them
+            rewrite_paths = [file_path for file_path, entry in entries.items() if entry is None or needs_rewrite(entry, lookup_map)]
+
+            for file_path, entry in zip(rewrite_paths, pool.map(rewrite_ids_in_file, rewrite_paths, repeat(lookup_map), chunksize=8)):
+                bm.record(manifest, entry, "assign_ids", entries[file_path])
 
-                    file_path = os.path.join(root, filename)
+            rewritten = set(rewrite_paths)
 
-                    # Assign unique IDs to authors in the JSON data
-                    assign_ids_in_file(file_path, characters_json, lookup_map)
+            for file_path, entry in entries.items():
+                if entry is not None and file_path not in rewritten:
+                    bm.record(manifest, entry, "assign_ids", entry)
 
+            t.log("info", f"\tRewrote {len(rewrite_paths)} of {len(file_paths)} files\n")
 
         # debug the dictionary
         t.log("debug", "\tFinal list of character names:")
@@ -312,10 +429,7 @@ def assign_ids(search_folder=c.SEARCH_FOLDER):
     finally:
         try:
             t.log("base", f"### ID assigning finished --- {time.time() - start_time:.2f} seconds --- ###\n")
-            backup_info = t.load_from_json(c.BACKUP_INFO)
-            backup_info["status"] = main_status
-            backup_info["steps"]["idAssignStatus"] = step_status
-            t.save_to_json(backup_info, c.BACKUP_INFO)
+            bs.finish({"idAssignStatus": step_status}, main_status)
 
         except Exception as e:
             t.log("error", f"\tFailed to save the status file: {e}\n")
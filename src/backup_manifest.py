@@ -0,0 +1,385 @@
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import tricks as t
+import exceptions as exc
+import tracing
+t.set_path()
+from res import constants as c
+
+################ File summary #################
+
+"""
+
+This module keeps a manifest of every channel and thread file of the backup, so each step knows what changed since it last ran.
+
+Main functions: lookup(manifest, file_path), record(manifest, entry, step, previous), verify(search_folder)
+
+    For each file, the manifest stores:
+        - its size, modification time and content hash, to know if it's the same version
+        - its number of messages, and the IDs of the first and last ones
+        - the IDs of all the authors that wrote in it
+        - the first message and the author IDs of each bot that wrote in it
+        - the steps that have processed this version of the file
+
+    A step asks for the record of a file with lookup(). If the file didn't change and the step is in its "steps",
+    the step can skip it. When a step processes a file, it records it with record(), and the step is added to the list.
+    The information of a file is taken with describe(), so worker processes can send it back without the whole file.
+
+    If a step rewrites the file itself, the steps that already processed it are kept, since the step knows what it changed.
+    If the file was changed by anything else, like a merge, the list starts over and every step processes it again.
+
+    The size and modification time are checked first. The file is only hashed if they changed,
+    so a file that was touched but not modified keeps its steps.
+
+    The manifest is a SQLite database in BACKUP_MANIFEST, so it's fast to read and update one file at a time.
+    If it's lost or out of date, verify() rebuilds it from the backup, reading the files in parallel:
+        python src/backup_manifest.py verify
+
+"""
+
+################ Functions #################
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS files (
+        path TEXT PRIMARY KEY,
+        channel_id TEXT,
+        size INTEGER,
+        mtime_ns INTEGER,
+        hash TEXT,
+        message_count INTEGER,
+        first_message_id TEXT,
+        last_message_id TEXT,
+        bots TEXT,
+        steps TEXT,
+        authors TEXT
+    )
+"""
+
+COLUMNS = "path, channel_id, size, mtime_ns, hash, message_count, first_message_id, last_message_id, bots, steps, authors"
+
+"""
+open_manifest()
+
+    Opens the backup manifest, and creates it if it doesn't exist.
+    It's used as a context manager, and the changes are saved when it's closed.
+
+"""
+class open_manifest:
+
+    def __enter__(self):
+        os.makedirs(os.path.dirname(c.BACKUP_MANIFEST) or ".", exist_ok=True)
+
+        # other processes may be writing their records, like the workers of find_all_scenes
+        self.connection = sqlite3.connect(c.BACKUP_MANIFEST, timeout=60)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute(SCHEMA)
+
+        # manifests made before the authors were recorded get the column, empty until their files are described again
+        columns = [row["name"] for row in self.connection.execute("PRAGMA table_info(files)")]
+
+        if "authors" not in columns:
+            self.connection.execute("ALTER TABLE files ADD COLUMN authors TEXT")
+
+        return self.connection
+
+    def __exit__(self, exc_type, *exc_info):
+
+        if exc_type is None:
+            self.connection.commit()
+
+        self.connection.close()
+
+"""
+hash_file(file_path)
+
+    Calculates the hash of the content of a file, reading it in blocks.
+
+"""
+def hash_file(file_path):
+
+    digest = hashlib.blake2b(digest_size=16)
+
+    with open(file_path, "rb") as file:
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+"""
+file_key(file_path)
+
+    Gets the key of a file in the manifest: its normalized path, with "/" as separator.
+
+"""
+def file_key(file_path):
+    return os.path.normpath(file_path).replace(os.sep, "/")
+
+"""
+lookup(manifest, file_path)
+
+    Gets the record of a file, if the file is still the same version.
+
+    Args:
+        manifest (sqlite3.Connection): The backup manifest.
+        file_path (str): The path of the channel file.
+
+    Returns:
+        dict or None: The record of the file, with the "steps" that processed it, or None if the file is new or changed.
+                      Its "authors" are None if the file was recorded before the manifest stored them.
+"""
+def lookup(manifest, file_path):
+
+    row = manifest.execute("SELECT * FROM files WHERE path = ?", (file_key(file_path),)).fetchone()
+
+    if row is None or not os.path.exists(file_path):
+        return None
+
+    stat = os.stat(file_path)
+    entry = dict(row)
+
+    if stat.st_size != entry["size"]:
+        return None
+
+    # the file was touched, but it may have the same content
+    if stat.st_mtime_ns != entry["mtime_ns"]:
+
+        if hash_file(file_path) != entry["hash"]:
+            return None
+
+        manifest.execute("UPDATE files SET mtime_ns = ? WHERE path = ?", (stat.st_mtime_ns, entry["path"]))
+        entry["mtime_ns"] = stat.st_mtime_ns
+
+    entry["bots"] = json.loads(entry["bots"])
+    entry["steps"] = json.loads(entry["steps"])
+
+    # None if the file was recorded before the authors were
+    entry["authors"] = json.loads(entry["authors"]) if entry["authors"] is not None else None
+
+    return entry
+
+"""
+is_processed(manifest, file_path, step)
+
+    Checks if a step already processed the current version of a file.
+
+"""
+def is_processed(manifest, file_path, step):
+
+    entry = lookup(manifest, file_path)
+
+    return entry is not None and step in entry["steps"]
+
+"""
+describe(file_path, data)
+
+    Gets the information of a channel file that is stored in the manifest.
+
+    Args:
+        file_path (str): The path of the channel file.
+        data (dict): The content of the channel file, in DCE format.
+
+    Returns:
+        dict: The information of the file, without the steps.
+"""
+def describe(file_path, data):
+
+    stat = os.stat(file_path)
+    messages = data["messages"]
+    authors = set()
+    bots = {}
+
+    for message in messages:
+        authors.add(message["author"]["id"])
+
+        if message["author"].get("isBot"):
+            name = message["author"]["name"]
+
+            if name not in bots:
+                bots[name] = {"first": int(message["id"]), "ids": []}
+
+            bots[name]["first"] = min(bots[name]["first"], int(message["id"]))
+
+            if message["author"]["id"] not in bots[name]["ids"]:
+                bots[name]["ids"].append(message["author"]["id"])
+
+    return {
+        "path": file_key(file_path),
+        "channel_id": data["channel"]["id"],
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "hash": hash_file(file_path),
+        "message_count": len(messages),
+        "first_message_id": messages[0]["id"] if messages else None,
+        "last_message_id": messages[-1]["id"] if messages else None,
+        "bots": bots,
+        "authors": sorted(authors, key=int)
+    }
+
+"""
+record(manifest, entry, step, previous)
+
+    Records that a step processed a file. The entry must be described after the step saved the file, if it changed it.
+
+    Args:
+        manifest (sqlite3.Connection): The backup manifest.
+        entry (dict): The information of the file, from describe().
+        step (str): The name of the step, optionally followed by ":" and what its result depends on.
+        previous (dict or None): The record of the file before the step processed it, from lookup().
+                                 Its steps are kept, since only this step changed the file.
+
+"""
+def record(manifest, entry, step, previous=None):
+
+    # a step can add what its result depends on after ":", so the older versions of it are replaced
+    name = step.split(":")[0]
+
+    steps = [done for done in previous["steps"] if done.split(":")[0] != name] if previous is not None else []
+    steps.append(step)
+
+    save_entry(manifest, entry, steps)
+
+"""
+save_entry(manifest, entry, steps)
+
+    Writes the record of a file in the manifest.
+
+"""
+def save_entry(manifest, entry, steps):
+
+    manifest.execute(
+        f"INSERT OR REPLACE INTO files ({COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (entry["path"], entry["channel_id"], entry["size"], entry["mtime_ns"], entry["hash"], entry["message_count"],
+         entry["first_message_id"], entry["last_message_id"], json.dumps(entry["bots"]), json.dumps(steps),
+         json.dumps(entry["authors"]) if entry["authors"] is not None else None)
+    )
+
+"""
+rename_files(manifest, moves, base_folder)
+
+    Updates the paths of the files that were renamed, so they keep their record.
+
+    Args:
+        manifest (sqlite3.Connection): The backup manifest.
+        moves (list): The renamed files, with the path relative to the backup they were moved "from" and "to".
+        base_folder (str): The folder of the backup.
+
+"""
+def rename_files(manifest, moves, base_folder):
+
+    for move in moves:
+        manifest.execute("UPDATE OR REPLACE files SET path = ? WHERE path = ?",
+                         (file_key(os.path.join(base_folder, move["to"])), file_key(os.path.join(base_folder, move["from"]))))
+
+"""
+describe_file(file_path)
+
+    Reads a channel file and gets its information for the manifest.
+    It's meant to run in a worker process.
+
+"""
+def describe_file(file_path):
+    return describe(file_path, t.load_from_json(file_path))
+
+"""
+list_channel_files(search_folder)
+
+    Lists all the channel and thread files in the folder and its subfolders, in a stable order.
+
+"""
+def list_channel_files(search_folder):
+
+    file_paths = []
+
+    for root, dirs, files in os.walk(search_folder):
+        for filename in files:
+            if filename.endswith(".json") and not filename.endswith("scenes.json"):
+                file_paths.append(os.path.join(root, filename))
+
+    return sorted(file_paths)
+
+
+################ Main function #################
+
+"""
+verify(search_folder)
+
+    Rebuilds the manifest from the files of the backup, reading them in parallel.
+
+    Files with the same content as their record keep their steps. Files that changed lose them,
+    so every step processes them again, and the records of files that don't exist anymore are removed.
+
+    Args:
+        search_folder (str, optional): The folder of the backup.
+
+    Returns:
+        dict: The number of files that were "unchanged", "changed", "new" and "removed".
+"""
+@tracing.traced("step")
+def verify(search_folder=c.SERVER_NAME):
+
+    try:
+        t.log("base", f"\n###  Verifying the backup manifest of {search_folder}...  ###\n")
+
+        start_time = time.time()
+
+        file_paths = list_channel_files(search_folder)
+        counts = {"unchanged": 0, "changed": 0, "new": 0, "removed": 0}
+
+        with open_manifest() as manifest:
+
+            old_entries = {row["path"]: dict(row) for row in manifest.execute("SELECT path, hash, steps FROM files")}
+            folder_key = file_key(search_folder) + "/"
+
+            with ProcessPoolExecutor(max_workers=c.WORKERS) as pool:
+
+                for entry in pool.map(describe_file, file_paths, chunksize=8):
+
+                    old_entry = old_entries.pop(entry["path"], None)
+
+                    if old_entry is None:
+                        counts["new"] += 1
+                        steps = []
+
+                    elif old_entry["hash"] == entry["hash"]:
+                        counts["unchanged"] += 1
+                        steps = json.loads(old_entry["steps"])
+
+                    else:
+                        counts["changed"] += 1
+                        t.log("debug", "\t  %s changed since it was recorded", entry["path"])
+                        steps = []
+
+                    save_entry(manifest, entry, steps)
+                    tracing.add(messages=entry["message_count"])
+
+            # files of the folder that don't exist anymore
+            for path in old_entries:
+                if path.startswith(folder_key):
+                    manifest.execute("DELETE FROM files WHERE path = ?", (path,))
+                    counts["removed"] += 1
+
+        t.log("info", f"\tVerified {len(file_paths)} files: {counts['unchanged']} unchanged, {counts['changed']} changed, "
+                      f"{counts['new']} new and {counts['removed']} removed")
+        t.log("base", f"\n### Finished verifying the manifest --- {time.time() - start_time:.2f} seconds --- ###\n")
+
+        return counts
+
+    except Exception as e:
+        raise exc.BackupManifestError(f"Failed to verify the backup manifest of {search_folder}") from e
+
+
+if __name__ == "__main__":
+
+    try:
+        if len(sys.argv) > 1 and sys.argv[1] != "verify":
+            print("\nOnly 'verify' is supported.\n")
+        else:
+            verify(sys.argv[2] if len(sys.argv) > 2 else c.SERVER_NAME)
+
+    except Exception as e:
+        t.log("error", f"\n{exc.unwrap(e)}\n")
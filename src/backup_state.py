@@ -0,0 +1,400 @@
+import json
+import os
+import socket
+from datetime import datetime
+import tricks as t
+import exceptions as exc
+t.set_path()
+try:
+    import fcntl
+except ImportError:
+    import msvcrt
+    fcntl = None
+from res import constants as c
+
+################ File summary #################
+
+"""
+
+This module keeps the status of the backup and of each of its steps, and makes sure only one process works on the backup at a time.
+
+Main functions: acquire(step), finish(steps, main_status, dates), load_state(), update_state(status, steps, dates)
+
+    The status is kept in an append-only journal, BACKUP_STATE, separate from the list of channels in BACKUP_INFO.
+    The first line is a snapshot of the whole state, and each status change appends a line with only what changed:
+        {"snapshot": {"status": "pending", "steps": {"updateStatus": "success", ...}, "dates": {"updatedAt": "...", ...}}}
+        {"at": "...", "status": "running", "steps": {"idAssignStatus": "running"}}
+
+    The state is the snapshot with the changes applied in order. A line left half written by a crash is ignored.
+    When the journal has more than STATE_SNAPSHOT_EVERY changes, it's replaced by a new snapshot.
+    Backups made before the journal existed start from the status saved in BACKUP_INFO.
+
+    Only one process can work on the backup, so each step takes the lock BACKUP_LOCK before starting.
+    The lock is a lock of the operating system on the open lock file, so only one process can hold it,
+    and it's released by the system if the process crashes, without having to check if the holder is still alive.
+    The file has the process that holds it, and it's emptied when the lock is released, so a file that still has
+    a holder when the lock is taken was left by a crash. The steps it left "running" are marked as "failed",
+    since their files may be half written.
+
+    A process can take the lock again while it holds it, like the pipeline does when it runs every step,
+    and it's released when every step that took it releases it.
+
+"""
+
+################ Functions #################
+
+STEPS = [
+    "updateStatus",
+    "updateCleanStatus",
+    "downloadStatus",
+    "sortingReadStatus",
+    "sortingCleanStatus",
+    "sortingWriteStatus",
+    "mergeStatus",
+    "idAssignStatus",
+    "messageFixStatus"
+]
+
+DATES = ["updatedAt", "exportedAt", "lastGoodUpdate", "lastGoodExport"]
+
+# how many times this process took the lock, and the open lock file while it holds it
+lock_depth = 0
+lock_file = None
+
+# Windows locks ranges of bytes, so a byte far after the content is locked, and the holder can still be read
+LOCK_OFFSET = 0x7FFFFFFF
+
+"""
+new_state()
+
+    Creates the state of a backup that has never run.
+
+"""
+def new_state():
+    return {
+        "status": "pending",
+        "steps": {step: "pending" for step in STEPS},
+        "dates": {date: None for date in DATES}
+    }
+
+"""
+legacy_state()
+
+    Gets the state saved in BACKUP_INFO by the versions before the journal, or a new state if there is none.
+
+"""
+def legacy_state():
+
+    state = new_state()
+
+    try:
+        backup_info = t.load_from_json(c.BACKUP_INFO)
+
+    except (OSError, ValueError):
+        return state
+
+    state["status"] = backup_info.get("status", state["status"])
+    state["steps"].update(backup_info.get("steps", {}))
+    state["dates"].update(backup_info.get("dates", {}))
+
+    return state
+
+"""
+apply_change(state, change)
+
+    Applies a line of the journal to the state.
+
+"""
+def apply_change(state, change):
+
+    if "snapshot" in change:
+        return change["snapshot"]
+
+    if change.get("status") is not None:
+        state["status"] = change["status"]
+
+    state["steps"].update(change.get("steps", {}))
+    state["dates"].update(change.get("dates", {}))
+
+    return state
+
+"""
+read_journal()
+
+    Reads the lines of the journal, ignoring a line left half written by a crash.
+
+    Returns:
+        list or None: The lines of the journal, or None if there is no journal.
+"""
+def read_journal():
+
+    try:
+        with open(c.BACKUP_STATE, "r", encoding="utf-8") as file:
+            lines = file.readlines()
+
+    except FileNotFoundError:
+        return None
+
+    changes = []
+
+    for line in lines:
+
+        if not line.strip():
+            continue
+
+        try:
+            changes.append(json.loads(line))
+
+        except ValueError:
+            t.log("debug", f"\t{t.YELLOW}Ignoring a line of {c.BACKUP_STATE} that was not fully written")
+
+    return changes
+
+"""
+load_state()
+
+    Gets the current status of the backup, its steps and its dates.
+
+    Returns:
+        dict: The "status", the status of each step in "steps", and the "dates" of the last update and export.
+"""
+def load_state():
+
+    changes = read_journal()
+
+    if not changes:
+        return legacy_state()
+
+    state = new_state()
+
+    for change in changes:
+        state = apply_change(state, change)
+
+    return state
+
+"""
+save_snapshot(state)
+
+    Replaces the journal with a single snapshot of the state.
+    It's written to a temporary file first, so the journal is never left half written.
+
+"""
+def save_snapshot(state):
+
+    os.makedirs(os.path.dirname(c.BACKUP_STATE) or ".", exist_ok=True)
+
+    with open(f"{c.BACKUP_STATE}.tmp", "w", encoding="utf-8") as file:
+        file.write(json.dumps({"snapshot": state}) + "\n")
+        file.flush()
+        os.fsync(file.fileno())
+
+    os.replace(f"{c.BACKUP_STATE}.tmp", c.BACKUP_STATE)
+
+"""
+update_state(status, steps, dates)
+
+    Writes down a change of status, appending one line to the journal.
+
+    Args:
+        status (str, optional): The new status of the backup.
+        steps (dict, optional): The new status of the steps that changed.
+        dates (dict, optional): The dates that changed.
+
+"""
+def update_state(status=None, steps=None, dates=None):
+
+    changes = read_journal()
+
+    if not changes:
+        save_snapshot(legacy_state())
+        changes = [None]
+
+    change = {"at": datetime.now().astimezone().isoformat(sep='T', timespec='microseconds')}
+
+    if status is not None:
+        change["status"] = status
+    if steps:
+        change["steps"] = steps
+    if dates:
+        change["dates"] = dates
+
+    # a line left half written by a crash is ended first, so the new one is on its own line
+    with open(c.BACKUP_STATE, "rb") as file:
+        file.seek(-1, os.SEEK_END)
+        prefix = "" if file.read(1) == b"\n" else "\n"
+
+    with open(c.BACKUP_STATE, "a", encoding="utf-8") as file:
+        file.write(prefix + json.dumps(change) + "\n")
+        file.flush()
+        os.fsync(file.fileno())
+
+    if len(changes) >= c.STATE_SNAPSHOT_EVERY:
+        t.log("debug", f"\tCompacting {c.BACKUP_STATE} into a snapshot")
+        save_snapshot(load_state())
+
+"""
+read_lock()
+
+    Reads the lock file, to know which process holds the lock.
+
+    Returns:
+        dict or None: The "pid", "host", "step" and "since" of the holder, or None if it can't be read.
+"""
+def read_lock():
+
+    try:
+        with open(c.BACKUP_LOCK, "r", encoding="utf-8") as file:
+            return json.load(file)
+
+    except (OSError, ValueError):
+        return None
+
+"""
+try_lock(descriptor), unlock(descriptor)
+
+    Functions to take and release the lock of the operating system on the open lock file.
+    try_lock() doesn't wait: it returns False if another process holds the lock.
+
+"""
+def try_lock(descriptor):
+    try:
+        if fcntl is not None:
+            fcntl.flock(descriptor, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            os.lseek(descriptor, LOCK_OFFSET, os.SEEK_SET)
+            msvcrt.locking(descriptor, msvcrt.LK_NBLCK, 1)
+
+        return True
+
+    except OSError:
+        return False
+
+
+def unlock(descriptor):
+    if fcntl is not None:
+        fcntl.flock(descriptor, fcntl.LOCK_UN)
+    else:
+        os.lseek(descriptor, LOCK_OFFSET, os.SEEK_SET)
+        msvcrt.locking(descriptor, msvcrt.LK_UNLCK, 1)
+
+"""
+recover_interrupted()
+
+    Marks as "failed" the steps left "running" by a process that crashed while holding the lock.
+
+"""
+def recover_interrupted():
+
+    state = load_state()
+    running = {step: "failed" for step, status in state["steps"].items() if status == "running"}
+
+    if running or state["status"] == "running":
+        t.log("base", f"{t.YELLOW}\tThe last run was interrupted during {', '.join(running) or 'a step'}. Marking it as failed\n")
+        update_state(status="failed", steps=running)
+
+"""
+acquire(step)
+
+    Takes the lock of the backup before a step starts.
+
+    Args:
+        step (str): The name of the step, written in the lock to know who holds it.
+
+    Raises:
+        AlreadyRunningError: If another process holds the lock.
+"""
+def acquire(step):
+
+    global lock_depth, lock_file
+
+    if lock_depth > 0:
+        lock_depth += 1
+        return
+
+    os.makedirs(os.path.dirname(c.BACKUP_LOCK) or ".", exist_ok=True)
+
+    descriptor = os.open(c.BACKUP_LOCK, os.O_RDWR | os.O_CREAT)
+
+    if not try_lock(descriptor):
+        os.close(descriptor)
+        holder = read_lock()
+        raise exc.AlreadyRunningError(f"The backup is running in another process ({holder['step'] if holder else 'starting'}). Exiting...")
+
+    # the lock is released by emptying the file, so a holder left in it crashed
+    holder = read_lock()
+
+    if holder is not None:
+        t.log("info", f"{t.YELLOW}\tThe process {holder['pid']} that held the lock during {holder['step']} is not running anymore")
+
+    os.ftruncate(descriptor, 0)
+    os.lseek(descriptor, 0, os.SEEK_SET)
+    os.write(descriptor, json.dumps({
+        "pid": os.getpid(),
+        "host": socket.gethostname(),
+        "step": step,
+        "since": datetime.now().astimezone().isoformat(sep='T', timespec='seconds')
+    }).encode("utf-8"))
+
+    lock_file = descriptor
+    lock_depth = 1
+
+    try:
+        recover_interrupted()
+
+    except Exception:
+        release()
+        raise
+
+"""
+release()
+
+    Releases the lock of the backup when a step finishes. It does nothing if this process doesn't hold it,
+    so it can be called even if acquire() failed.
+
+    The lock file is emptied but not removed, so a process waiting for it can't end up with a lock on a removed file.
+
+"""
+def release():
+
+    global lock_depth, lock_file
+
+    if lock_depth == 0:
+        return
+
+    lock_depth -= 1
+
+    if lock_depth == 0:
+        try:
+            os.ftruncate(lock_file, 0)
+            unlock(lock_file)
+
+        finally:
+            os.close(lock_file)
+            lock_file = None
+
+"""
+finish(steps, main_status, dates)
+
+    Writes down how a step finished, and the dates it changed, and releases the lock.
+    Nothing is written if this process doesn't hold the lock, so a step that found another process running
+    doesn't change the status of the other run.
+
+    Args:
+        steps (dict): The status each step finished with, like {"mergeStatus": "success"}.
+        main_status (str): The status of the backup after the step.
+        dates (dict, optional): The dates that changed, like "exportedAt".
+
+"""
+def finish(steps, main_status, dates=None):
+
+    if lock_depth == 0:
+        return
+
+    try:
+        update_state(status=main_status, steps=steps, dates=dates)
+
+    finally:
+        release()
+
+if __name__ == "__main__":
+    print("\nThis module is not intended to be run directly.\n")
@@ -0,0 +1,93 @@
+import contextlib
+import io
+import os
+import tempfile
+import time
+import tricks as t
+t.set_path()
+from res import constants as c
+
+################# File summary #################
+
+"""
+
+This module is used to measure how much time a call to the logger takes.
+
+Main function: benchmark_log()
+
+    This script calls tricks.log many times with different combinations of levels and flags,
+    and prints the average time per call.
+
+    Messages are written to a temporary log file, and printed messages are discarded,
+    so the results only show the overhead of the logger itself and not the speed of the console.
+
+"""
+
+################# Functions #################
+
+CALLS = 100000
+
+"""
+measure(level, message, args)
+
+    Calls the logger CALLS times with the same message and returns the average time per call.
+
+    Returns:
+        float: The average time per call, in microseconds.
+"""
+def measure(level, message, *args):
+
+    with contextlib.redirect_stdout(io.StringIO()):
+
+        start_time = time.perf_counter()
+
+        for i in range(CALLS):
+            t.log(level, message, *args)
+
+        t.flush_log()
+
+        elapsed = time.perf_counter() - start_time
+
+    return elapsed / CALLS * 1e6
+
+
+################# Main function #################
+
+def benchmark_log():
+
+    t.log("base", f"\n## Measuring the logger over {CALLS} calls... ##\n")
+
+    saved_flags = (c.INFO, c.DEBUG, c.LOG, c.LOG_FILE)
+
+    cases = [
+        ("debug message, DEBUG off, LOG off", False, False, "debug", "Skipping system message"),
+        ("debug message, DEBUG off, LOG on",  False, True,  "debug", "Skipping system message"),
+        ("log message, LOG on",               False, True,  "log",   "Skipping system message"),
+        ("log message with args, LOG off",    False, False, "log",   "Analysing %s...", "channel.json"),
+        ("log message with args, LOG on",     False, True,  "log",   "Analysing %s...", "channel.json"),
+        ("debug message, DEBUG on, LOG on",   True,  True,  "debug", "Skipping system message"),
+    ]
+
+    with tempfile.TemporaryDirectory() as folder:
+
+        try:
+            c.LOG_FILE = os.path.join(folder, "log.txt")
+
+            # the message above already opened the real log file, the calls are measured on the temporary one
+            t.close_log()
+
+            for name, debug, log, level, message, *args in cases:
+                c.DEBUG = debug
+                c.LOG = log
+
+                t.log("base", f"\t{name:<40} {measure(level, message, *args):8.3f} µs per call")
+
+        finally:
+            t.close_log()
+            c.INFO, c.DEBUG, c.LOG, c.LOG_FILE = saved_flags
+
+    t.log("base", "\n## Finished measuring the logger ##\n")
+
+
+if __name__ == "__main__":
+    benchmark_log()
@@ -0,0 +1,378 @@
+import os
+import struct
+import sys
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import tricks as t
+import exceptions as exc
+import tracing
+t.set_path()
+from res import constants as c
+
+################ File summary #################
+
+"""
+
+This module creates zip files of the results to download: the HTML scenes of a character, or the server backup.
+
+Main function: bundle(folder, output, since)
+
+    The zip is written as it's created, straight to a file or to any stream, like a socket, without keeping it
+    on disk or in memory first. Only a few chunks of BUNDLE_CHUNK bytes are in memory at the same time,
+    so even the zip of the whole backup can be created on a small host.
+
+    Each file is split in chunks that are compressed in parallel, each one with the end of the previous chunk
+    as its dictionary, so the result is almost as small as compressing the whole file at once (like pigz does).
+
+    If 'since' is given, only the files changed after that date are included, to download only what changed
+    since the last export.
+
+    It can be run from the command line:
+        python src/bundle.py scenes [since] [output]
+        python src/bundle.py backup [since] [output]
+    Use "-" as the output to write the zip to the standard output.
+
+"""
+
+################ Functions #################
+
+DICTIONARY_SIZE = 32768
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP64_VERSION = 45
+FLAGS = 0x0808          # sizes after the data (bit 3) and UTF-8 file names (bit 11)
+
+"""
+list_files(folder, since)
+
+    Lists the files of a folder and its subfolders, in order, with the name they will have in the zip.
+
+    Args:
+        folder (str): The folder to bundle.
+        since (str, optional): A date in ISO format. Only the files changed after it are listed.
+
+    Returns:
+        list: A tuple with the path and the name in the zip of each file.
+"""
+def list_files(folder, since=None):
+
+    since_timestamp = datetime.fromisoformat(since).timestamp() if since is not None else None
+    base = os.path.dirname(os.path.normpath(folder))
+
+    files = []
+
+    for root, dirs, names in os.walk(folder):
+
+        dirs.sort()
+
+        for name in sorted(names):
+            path = os.path.join(root, name)
+
+            if since_timestamp is not None and os.path.getmtime(path) <= since_timestamp:
+                continue
+
+            files.append((path, os.path.relpath(path, base).replace(os.sep, "/")))
+
+    return files
+
+"""
+compress_chunk(data, dictionary, last)
+
+    Compresses a chunk of a file as raw deflate data that can be joined to the chunks before and after it.
+
+    Every chunk but the last one ends with a sync flush, so it ends on a byte boundary and doesn't end the stream.
+    The end of the previous chunk is used as the dictionary, so repeated text across chunks is still compressed.
+
+"""
+def compress_chunk(data, dictionary, last):
+
+    if dictionary:
+        compressor = zlib.compressobj(c.BUNDLE_LEVEL, zlib.DEFLATED, -15, zdict=dictionary)
+    else:
+        compressor = zlib.compressobj(c.BUNDLE_LEVEL, zlib.DEFLATED, -15)
+
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+"""
+dos_date_time(timestamp)
+
+    Converts a timestamp to the date and time format of zip files.
+
+"""
+def dos_date_time(timestamp):
+
+    moment = time.localtime(max(timestamp, 315532800))     # zip dates start in 1980
+
+    dos_time = (moment.tm_hour << 11) | (moment.tm_min << 5) | (moment.tm_sec // 2)
+    dos_date = ((moment.tm_year - 1980) << 9) | (moment.tm_mon << 5) | moment.tm_mday
+
+    return dos_time, dos_date
+
+"""
+ZipStream(stream)
+
+    Writes a zip file to a stream that can't go back, so the sizes of each file go after its data.
+    Zip64 is used for the sizes, so files and zips over 4 GB work.
+
+"""
+class ZipStream:
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.offset = 0
+        self.entries = []
+
+    def write(self, data):
+        self.stream.write(data)
+        self.offset += len(data)
+
+    """
+    start_file(name, timestamp, mode)
+
+        Writes the header of a new file. Its data is written with write(), and finish_file() closes it.
+
+    """
+    def start_file(self, name, timestamp, mode):
+
+        encoded_name = name.encode("utf-8")
+        dos_time, dos_date = dos_date_time(timestamp)
+
+        # the sizes aren't known yet, so they go in the data descriptor after the data
+        extra = struct.pack("<HHQQ", 0x0001, 16, 0, 0)
+
+        self.entries.append({
+            "name": encoded_name,
+            "time": dos_time,
+            "date": dos_date,
+            "mode": mode,
+            "offset": self.offset
+        })
+
+        self.write(struct.pack("<IHHHHHIIIHH", 0x04034b50, ZIP64_VERSION, FLAGS, zlib.DEFLATED, dos_time, dos_date,
+                               0, ZIP64_LIMIT, ZIP64_LIMIT, len(encoded_name), len(extra)) + encoded_name + extra)
+
+    def finish_file(self, crc, compressed_size, size):
+
+        self.entries[-1].update({"crc": crc, "compressedSize": compressed_size, "size": size})
+        self.write(struct.pack("<IIQQ", 0x08074b50, crc, compressed_size, size))
+
+    """
+    close()
+
+        Writes the central directory at the end of the zip, with the list of all files.
+
+    """
+    def close(self):
+
+        directory_offset = self.offset
+
+        for entry in self.entries:
+
+            # values that don't fit in 4 bytes go in the zip64 extra field
+            zip64 = []
+            sizes = []
+
+            for key in ("size", "compressedSize"):
+                if entry[key] >= ZIP64_LIMIT:
+                    zip64.append(entry[key])
+                    sizes.append(ZIP64_LIMIT)
+                else:
+                    sizes.append(entry[key])
+
+            offset = entry["offset"]
+            if offset >= ZIP64_LIMIT:
+                zip64.append(offset)
+                offset = ZIP64_LIMIT
+
+            extra = struct.pack(f"<HH{len(zip64)}Q", 0x0001, 8 * len(zip64), *zip64) if zip64 else b""
+
+            self.write(struct.pack("<IHHHHHHIIIHHHHHII", 0x02014b50, (3 << 8) | ZIP64_VERSION, ZIP64_VERSION, FLAGS,
+                                   zlib.DEFLATED, entry["time"], entry["date"], entry["crc"], sizes[1], sizes[0],
+                                   len(entry["name"]), len(extra), 0, 0, 0, (entry["mode"] & 0xFFFF) << 16, offset)
+                       + entry["name"] + extra)
+
+        directory_size = self.offset - directory_offset
+        count = len(self.entries)
+
+        if count >= 0xFFFF or directory_offset >= ZIP64_LIMIT or directory_size >= ZIP64_LIMIT:
+
+            zip64_offset = self.offset
+
+            self.write(struct.pack("<IQHHIIQQQQ", 0x06064b50, 44, (3 << 8) | ZIP64_VERSION, ZIP64_VERSION, 0, 0,
+                                   count, count, directory_size, directory_offset))
+            self.write(struct.pack("<IIQI", 0x07064b50, 0, zip64_offset, 1))
+
+            count = min(count, 0xFFFF)
+            directory_size = min(directory_size, ZIP64_LIMIT)
+            directory_offset = min(directory_offset, ZIP64_LIMIT)
+
+        self.write(struct.pack("<IHHHHIIH", 0x06054b50, 0, 0, count, count, directory_size, directory_offset, 0))
+        self.stream.flush()
+
+"""
+read_chunks(files, pool)
+
+    Reads the files in chunks and sends each chunk to be compressed, in order.
+
+    Yields:
+        tuple: ("start", path, name) before each file, ("chunk", future, crc, size) for each chunk,
+               and ("end", None, None, None) after each file.
+"""
+def read_chunks(files, pool):
+
+    for path, name in files:
+
+        yield ("start", path, name, None)
+
+        with open(path, "rb") as file:
+
+            data = file.read(c.BUNDLE_CHUNK)
+            dictionary = b""
+            crc = 0
+
+            while True:
+                next_data = file.read(c.BUNDLE_CHUNK)
+                crc = zlib.crc32(data, crc)
+
+                yield ("chunk", pool.submit(compress_chunk, data, dictionary, not next_data), crc, len(data))
+
+                if not next_data:
+                    break
+
+                dictionary = data[-DICTIONARY_SIZE:]
+                data = next_data
+
+        yield ("end", None, None, None)
+
+"""
+write_zip(files, stream, workers)
+
+    Writes the zip of the files to a stream, compressing the chunks in parallel.
+    At most 2 chunks per worker are read ahead, so the memory used doesn't depend on the size of the files.
+
+    Returns:
+        tuple[int, int]: The bytes read from the files and the bytes of the zip.
+"""
+def write_zip(files, stream, workers):
+
+    zip_stream = ZipStream(stream)
+    bytes_read = 0
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+
+        pending = deque()
+        compressed_size = size = crc = 0
+
+        def write_next():
+            nonlocal compressed_size, size, crc, bytes_read
+
+            kind, first, second, third = pending.popleft()
+
+            if kind == "start":
+                zip_stream.start_file(second, os.path.getmtime(first), os.stat(first).st_mode)
+                compressed_size = size = crc = 0
+
+            elif kind == "chunk":
+                data = first.result()
+                zip_stream.write(data)
+                compressed_size += len(data)
+                size += third
+                crc = second
+
+            else:
+                zip_stream.finish_file(crc, compressed_size, size)
+                bytes_read += size
+
+        for item in read_chunks(files, pool):
+            pending.append(item)
+
+            while len(pending) > 2 * workers:
+                write_next()
+
+        while pending:
+            write_next()
+
+    zip_stream.close()
+
+    return bytes_read, zip_stream.offset
+
+
+################ Main function #################
+
+"""
+bundle(folder, output, since)
+
+    Creates a zip file with a folder and its subfolders.
+
+    Args:
+        folder (str): The folder to bundle, like out/[Character] or the server backup folder.
+        output (str or stream): The path of the zip file, or a binary stream to write it to, like a socket.makefile("wb").
+        since (str, optional): A date in ISO format. Only the files changed after it are included.
+
+    Returns:
+        int: The number of files in the zip.
+"""
+@tracing.traced("step")
+def bundle(folder, output, since=None):
+
+    try:
+        t.log("base", f"\n##  Creating a zip of '{folder}'...  ##\n")
+
+        start_time = time.time()
+
+        if not os.path.isdir(folder):
+            raise FileNotFoundError(f"The folder '{folder}' doesn't exist")
+
+        files = list_files(folder, since)
+
+        if since is not None:
+            t.log("info", f"\tFound {len(files)} files changed after {since}")
+        else:
+            t.log("info", f"\tFound {len(files)} files")
+
+        workers = c.WORKERS or os.cpu_count() or 1
+
+        if isinstance(output, str):
+            os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+
+            with open(output, "wb") as file:
+                bytes_read, bytes_written = write_zip(files, file, workers)
+        else:
+            bytes_read, bytes_written = write_zip(files, output, workers)
+
+        tracing.add(bytesRead=bytes_read, bytesWritten=bytes_written)
+
+        t.log("info", f"\tCompressed {bytes_read / 1024 / 1024:.1f} MB into {bytes_written / 1024 / 1024:.1f} MB")
+        t.log("base", f"\n##  Finished creating the zip! --- {time.time() - start_time:.2f} seconds --- ##\n")
+
+        return len(files)
+
+    except Exception as e:
+        raise exc.BundleError(f"Failed to create the zip of '{folder}'") from e
+
+
+if __name__ == "__main__":
+
+    try:
+        kind = sys.argv[1] if len(sys.argv) > 1 else "scenes"
+        since = sys.argv[2] if len(sys.argv) > 2 and sys.argv[2] != "all" else None
+
+        if kind == "backup":
+            folder, output = c.SERVER_NAME, f"out/{c.SERVER_NAME}.zip"
+        else:
+            folder, output = f"out/{c.CHARACTER}", f"out/{c.CHARACTER}.zip"
+
+        if len(sys.argv) > 3 and sys.argv[3] == "-":
+            # the zip goes to the standard output, so the messages go to the standard error
+            t.log_to_stderr()
+            output = sys.stdout.buffer
+
+        elif len(sys.argv) > 3:
+            output = sys.argv[3]
+
+        bundle(folder, output, since)
+
+    except Exception as e:
+        t.log("error", f"\n{exc.unwrap(e)}\n")
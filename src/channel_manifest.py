@@ -0,0 +1,220 @@
+import os
+import time
+from datetime import datetime
+import tricks as t
+import exceptions as exc
+import tracing
+t.set_path()
+from res import constants as c
+
+################ File summary #################
+
+"""
+
+This module keeps track of how far each channel and thread of the backup has been exported.
+
+Main function: record_folder(search_folder)
+
+    For each channel and thread, the manifest stores a watermark: the ID and timestamp of the last message in the backup.
+    The next export of the channel only has to ask DCE for the messages after its own watermark.
+
+    Watermarks are updated every time new messages reach the main backup (merge_exports, or the first full export),
+    so a channel that failed to download or merge keeps its old watermark and is downloaded again from there.
+
+    The manifest also counts how many times the export of each channel stalled and had to be killed,
+    to spot the channels that are always slow.
+
+    It also keeps the statistics of each channel: the number of messages and the date of the first one,
+    updated with the watermarks, and the number of scenes, updated when the scenes are found.
+    update_info adds them up into backup_info.json without opening any channel file.
+
+    The last list of channels writes down how each channel changed since the list before it ("new", "renamed", "moved"
+    or "removed"), so the download knows which channels were just created and need their full history.
+
+    The manifest is saved to CHANNEL_MANIFEST with this format:
+        {
+            "channel ID": {
+                "lastMessageId": "...", "lastMessageAt": "...", "firstMessageAt": "...", "messageCount": 0, "numberOfScenes": 0,
+                "stalls": 0, "lastStallAt": "...", "changes": ["new"]
+            },
+            ...
+        }
+
+"""
+
+################ Functions #################
+
+"""
+load_manifest(), save_manifest(manifest)
+
+    Functions to read and write the channel manifest. If there is no manifest yet, it's empty.
+
+"""
+def load_manifest():
+    try:
+        return t.load_from_json(c.CHANNEL_MANIFEST)
+
+    except FileNotFoundError:
+        return {}
+
+
+def save_manifest(manifest):
+    t.save_to_json(manifest, c.CHANNEL_MANIFEST)
+
+"""
+update_channel(manifest, channel_data)
+
+    Updates the watermark and the statistics of a channel with its backup file.
+    Channels with no messages keep their watermark.
+
+    Args:
+        manifest (dict): The channel manifest.
+        channel_data (dict): The content of the channel file, in DCE format.
+
+"""
+def update_channel(manifest, channel_data):
+
+    entry = manifest.setdefault(channel_data["channel"]["id"], {})
+    entry["messageCount"] = len(channel_data["messages"])
+
+    if not channel_data["messages"]:
+        return
+
+    last_message = channel_data["messages"][-1]
+
+    entry["lastMessageId"] = last_message["id"]
+    entry["lastMessageAt"] = last_message["timestamp"]
+    entry["firstMessageAt"] = channel_data["messages"][0]["timestamp"]
+
+"""
+record_changes(manifest, changes)
+
+    Writes down how each channel changed in the last list of channels, and forgets the changes of the list before it.
+
+    Args:
+        manifest (dict): The channel manifest.
+        changes (dict): The IDs of the channels that are "new", "renamed", "moved" and "removed".
+
+    Returns:
+        bool: True if the manifest changed, so it only has to be saved then.
+"""
+def record_changes(manifest, changes):
+
+    previous = {channel_id: entry.pop("changes") for channel_id, entry in manifest.items() if "changes" in entry}
+
+    for change, channel_ids in changes.items():
+        for channel_id in channel_ids:
+            manifest.setdefault(channel_id, {}).setdefault("changes", []).append(change)
+
+    return previous != {channel_id: entry["changes"] for channel_id, entry in manifest.items() if "changes" in entry}
+
+"""
+record_scenes(manifest, channel_id, count)
+
+    Writes down the number of scenes found in a channel.
+
+    Args:
+        manifest (dict): The channel manifest.
+        channel_id (str): The ID of the channel or thread.
+        count (int): The number of scenes.
+
+"""
+def record_scenes(manifest, channel_id, count):
+    manifest.setdefault(channel_id, {})["numberOfScenes"] = count
+
+"""
+has_watermarks(manifest)
+
+    Checks if any channel of the manifest has a watermark.
+    Backups made before the manifest existed have none until record_folder() seeds them.
+
+    Args:
+        manifest (dict): The channel manifest.
+
+    Returns:
+        bool: True if at least one channel has a watermark.
+"""
+def has_watermarks(manifest):
+    return any("lastMessageId" in entry for entry in manifest.values())
+
+"""
+get_watermark(manifest, channel_id, date, seeded)
+
+    Gets the point from which a channel has to be exported.
+
+    If the channel has a watermark, it's the ID of its last message.
+    If it doesn't, but the manifest has watermarks or the last list of channels found it for the first time,
+    it's a new channel and needs its full history.
+    If there are no watermarks at all (the backup couldn't be seeded), it falls back to the global date.
+
+    Args:
+        manifest (dict): The channel manifest.
+        channel_id (str): The ID of the channel or thread.
+        date (str, optional): The global date of the last export, in ISO format.
+        seeded (bool): Whether the manifest has watermarks, from has_watermarks(). Computed once per download.
+
+    Returns:
+        str or None: A message ID or a date to pass to DCE's --after, or None to export the full history.
+"""
+def get_watermark(manifest, channel_id, date=None, seeded=True):
+
+    entry = manifest.get(channel_id, {})
+
+    if "lastMessageId" in entry:
+        return entry["lastMessageId"]
+
+    if seeded or "new" in entry.get("changes", []):
+        return None
+
+    return date
+
+"""
+record_stall(manifest, channel_id)
+
+    Counts a stalled export of a channel.
+
+    Args:
+        manifest (dict): The channel manifest.
+        channel_id (str): The ID of the channel or thread.
+
+"""
+def record_stall(manifest, channel_id):
+
+    entry = manifest.setdefault(channel_id, {})
+    entry["stalls"] = entry.get("stalls", 0) + 1
+    entry["lastStallAt"] = datetime.now().astimezone().isoformat(sep='T', timespec='microseconds')
+
+
+################# Main function #################
+
+@tracing.traced("step")
+def record_folder(search_folder=c.SERVER_NAME):
+
+    try:
+        t.log("info", f"\tRecording the watermarks of the channels in {search_folder}...")
+
+        start_time = time.time()
+
+        manifest = load_manifest()
+
+        for root, dirs, files in os.walk(search_folder):
+            for filename in files:
+                if filename.endswith(".json") and not filename.endswith("scenes.json"):
+
+                    update_channel(manifest, t.load_from_json(os.path.join(root, filename)))
+
+        save_manifest(manifest)
+
+        t.log("info", f"\tRecorded the watermarks of {len(manifest)} channels --- {time.time() - start_time:.2f} seconds ---\n")
+
+    except Exception as e:
+        raise exc.ChannelManifestError("Failed to record the watermarks of the channels") from e
+
+
+if __name__ == "__main__":
+
+    try:
+        record_folder()
+
+    except Exception as e:
+        t.log("error", f"\n{exc.unwrap(e)}\n")
@@ -0,0 +1,177 @@
+import os
+import sys
+import tempfile
+import time
+import tricks as t
+import exceptions as exc
+import rate_limit as rl
+import download_channels as dc
+t.set_path()
+from res import constants as c
+
+################# File summary #################
+
+"""
+
+This module checks that the download retries failed exports and adapts its concurrency, using the fake DCE.
+
+Main function: check_exports()
+
+    This script runs a few small downloads with run_exports, with DCE_COMMAND pointed to fake_dce.py,
+    and checks the number of retries, rate limits and stalled exports of each one:
+        - "clean": no errors. Nothing is retried, and the concurrency only grows.
+        - "rate limits": the fake DCE allows fewer exports at once than the download starts with.
+                         Every rate limit is retried, the concurrency goes down, and every channel is exported.
+        - "stalls": every export hangs. Each one is killed and retried until it runs out of retries,
+                    every stall is counted in the channel manifest, and the download fails.
+
+    The exports are written to a temporary folder, and the constants it changes are restored at the end.
+    It prints the result of each check, and exits with an error if any of them failed:
+        python src/check_exports.py
+
+"""
+
+################# Functions #################
+
+CHANNELS = 8
+
+"""
+make_exports(folder, count)
+
+    Builds the exports of 'count' made-up channels, like plan_exports() does, with their files in 'folder'.
+
+"""
+def make_exports(folder, count):
+
+    exports = []
+
+    for i in range(count):
+        channel_id = str(1000 + i)
+        path = os.path.join(folder, f"{channel_id}.json")
+
+        exports.append({
+            "id": channel_id,
+            "tag": channel_id,
+            "args": dc.export_command(channel_id, path),
+            "path": path,
+            "range": (None, None),
+            "after": None,
+            "size": 10,
+            "shard": None,
+            "shards": 1,
+            "folder": folder,
+            "category": "Fake category",
+            "group": None
+        })
+
+    return exports
+
+"""
+run_case(folder, name, environment, exports)
+
+    Runs the exports with the fake DCE configured by 'environment', and counts what happened.
+
+    Returns:
+        dict: The number of "exported" channels, "retries", "rateLimits", "decreases" and "stalls",
+              the "lowest" and "highest" concurrency, and whether the download "failed".
+              A failed download doesn't return its results, so its retries are None.
+"""
+def run_case(folder, name, environment, exports):
+
+    t.log("info", f"\n\tRunning '{name}' with {len(exports)} exports...")
+
+    os.environ.update(environment)
+    manifest = {}
+    limiter = rl.AdaptiveConcurrency(c.EXPORT_CONCURRENCY, c.EXPORT_MAX_CONCURRENCY)
+    results = []
+    failed = False
+
+    try:
+        results = dc.run_exports(exports, manifest, limiter)
+
+    except exc.DownloadExportError:
+        failed = True
+
+    finally:
+        for key in environment:
+            os.environ.pop(key, None)
+
+    return {
+        "exported": sum(1 for result in results if result["code"] == 0),
+        "retries": None if failed else sum(result["attempts"] - 1 for result in results),
+        "stalls": sum(entry.get("stalls", 0) for entry in manifest.values()),
+        "failed": failed,
+        **limiter.stats
+    }
+
+"""
+check(name, passed, counts)
+
+    Prints the result of a check.
+
+    Returns:
+        bool: Whether the check passed.
+"""
+def check(name, passed, counts):
+
+    details = ", ".join(f"{key} {value}" for key, value in counts.items())
+    t.log("base", f"\t{t.GREEN + 'PASS' if passed else t.RED + 'FAIL'}{t.RESET} {name}: {details}")
+
+    return passed
+
+
+################# Main function #################
+
+def check_exports():
+
+    t.log("base", "\n## Checking the retries and concurrency of the download with the fake DCE... ##\n")
+
+    start_time = time.time()
+
+    saved = (c.DCE_COMMAND, c.EXPORT_JOURNAL, c.EXPORT_CONCURRENCY, c.EXPORT_MAX_CONCURRENCY, c.EXPORT_RETRIES,
+             c.EXPORT_BACKOFF, c.EXPORT_BACKOFF_MAX, c.EXPORT_STALL_TIMEOUT, c.EXPORTER)
+
+    passed = []
+
+    with tempfile.TemporaryDirectory() as folder:
+
+        try:
+            c.DCE_COMMAND = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_dce.py")]
+            c.EXPORT_JOURNAL = os.path.join(folder, "export_journal.jsonl")
+            c.EXPORTER = "dce"
+            c.EXPORT_CONCURRENCY = 4
+            c.EXPORT_MAX_CONCURRENCY = 6
+            c.EXPORT_BACKOFF = 0.1
+            c.EXPORT_BACKOFF_MAX = 0.5
+            c.EXPORT_STALL_TIMEOUT = 2
+
+            # enough retries for every export to get through the rate limits
+            c.EXPORT_RETRIES = 20
+
+            counts = run_case(folder, "clean", {"FAKE_DCE_LIMIT": "100", "FAKE_DCE_DELAY": "0.2"}, make_exports(folder, CHANNELS))
+            passed.append(check("clean", counts["exported"] == CHANNELS and counts["retries"] == 0 and counts["rateLimits"] == 0
+                                and counts["lowest"] == c.EXPORT_CONCURRENCY and not counts["failed"], counts))
+
+            counts = run_case(folder, "rate limits", {"FAKE_DCE_LIMIT": "2", "FAKE_DCE_DELAY": "0.5"}, make_exports(folder, CHANNELS))
+            passed.append(check("rate limits", counts["exported"] == CHANNELS and counts["rateLimits"] > 0
+                                and counts["retries"] == counts["rateLimits"] and counts["decreases"] > 0
+                                and counts["lowest"] < c.EXPORT_CONCURRENCY and not counts["failed"], counts))
+
+            # each export stalls on every attempt, and is killed each time
+            c.EXPORT_RETRIES = 1
+            stalled = 3
+
+            counts = run_case(folder, "stalls", {"FAKE_DCE_STALL_RATE": "1", "FAKE_DCE_DELAY": "0"}, make_exports(folder, stalled))
+            passed.append(check("stalls", counts["failed"] and counts["stalls"] == stalled * (c.EXPORT_RETRIES + 1), counts))
+
+        finally:
+            (c.DCE_COMMAND, c.EXPORT_JOURNAL, c.EXPORT_CONCURRENCY, c.EXPORT_MAX_CONCURRENCY, c.EXPORT_RETRIES,
+             c.EXPORT_BACKOFF, c.EXPORT_BACKOFF_MAX, c.EXPORT_STALL_TIMEOUT, c.EXPORTER) = saved
+
+    t.log("base", f"\n## Passed {sum(passed)} of {len(passed)} checks --- {time.time() - start_time:.2f} seconds --- ##\n")
+
+    return all(passed)
+
+
+if __name__ == "__main__":
+    sys.exit(0 if check_exports() else 1)
@@ -1,7 +1,15 @@
 from datetime import datetime
+import json
+import os
+import shutil
 import time
 import tricks as t
 import exceptions as exc
+import tracing
+import backup_state as bs
+import channel_manifest as cm
+import rate_limit as rl
+import file_layout as fl
 t.set_path()
 from res import constants as c
 from res import tokens
@@ -16,7 +24,14 @@ This module downloads a backup of all channels from the server.
 
 Main function: download_channels(date=None)
 
-    Opens the channel list in the file backup_info.json, and downloads the channels of each category.
+    Opens the channel list in the file backup_info.json, and downloads all the channels and threads.
+
+    Each channel and thread is exported straight to its final path, with its position in the name (see file_layout).
+    Exports from every category share the same queue, biggest channels first,
+    and a new export starts as soon as any other finishes.
+
+    Every channel that finishes exporting is written down in a journal. If the download is interrupted,
+    the next run resumes it: it keeps the same date, and only exports the channels that weren't finished.
 
     Args:
         date (str, optional): The timestamp of the last export in ISO format. If not provided, downloads the full history.
@@ -40,24 +55,19 @@ def check_base_status():
     try: 
         t.log("debug", "\nChecking the status of the backup...")
 
-        backup_info = t.load_from_json(c.BACKUP_INFO)
+        bs.acquire("download_channels")
+        state = bs.load_state()
 
         t.log("debug", "  Loaded the status file\n")
 
-        if backup_info["status"] == "running":
-            raise exc.AlreadyRunningError("The export is still running in another process. Exiting...")
-        
-        if backup_info["steps"]["updateCleanStatus"] != "success":
+        if state["steps"]["updateCleanStatus"] != "success":
             raise exc.DataNotReadyError("The channel list is not up to date. Ensure the previous step ran and try again.")
 
 
-        t.log("debug", f"  The current status of the backup is '{backup_info["status"]}'\n")
+        t.log("debug", f"  The current status of the backup is '{state["status"]}'\n")
 
-        # flag it as running in case another execution of the script is launched
-        backup_info["status"] = "running"
-        backup_info["steps"]["downloadStatus"] = "running"
-
-        t.save_to_json(backup_info, c.BACKUP_INFO)
+        # flag it as running in case the process is interrupted
+        bs.update_state(status="running", steps={"downloadStatus": "running"})
 
     except (exc.DataNotReadyError, exc.AlreadyRunningError) as e:
         raise e
@@ -66,52 +76,507 @@ def check_base_status():
         raise exc.ExportError("The export status file could not be read") from e
 
 """
-download_category(cat, date, type)
+Export journal
+
+    While downloading, the journal EXPORT_JOURNAL records which channels and threads have finished exporting in the current run.
+    It's a JSON lines file: the first line has the date the run exports from, and each other line is a finished channel.
+    Lines are appended as soon as each export finishes, so the journal survives a crash.
+
+    The journal is deleted when the whole download succeeds. If it still exists, the previous download was interrupted.
+
+"""
+
+"""
+load_journal()
+
+    Loads the journal of an interrupted download.
+
+    Returns:
+        dict or None: The "date" and "startedAt" of the interrupted run, and the channels already exported ("done"), by ID.
+                      None if there is no interrupted download.
+"""
+def load_journal():
+
+    try:
+        with open(c.EXPORT_JOURNAL, "r", encoding="utf-8") as file:
+            lines = [json.loads(line) for line in file if line.strip()]
+
+    except FileNotFoundError:
+        return None
+
+    if not lines:
+        return None
+
+    journal = {
+        "date": lines[0]["date"],
+        "startedAt": lines[0]["startedAt"],
+        "done": {}
+    }
+
+    for entry in lines[1:]:
+        journal["done"][entry["id"]] = entry
+
+    return journal
+
+"""
+start_journal(date, now), record_export(channel_id, after), finish_journal()
+
+    Functions to create the journal of a new download, add a finished channel to it, and delete it when the download succeeds.
+
+"""
+def start_journal(date, now):
+
+    with open(c.EXPORT_JOURNAL, "w", encoding="utf-8") as file:
+        file.write(json.dumps({"date": date, "startedAt": now}) + "\n")
+
+    return {"date": date, "startedAt": now, "done": {}}
+
+
+def record_export(channel_id, after):
+
+    entry = {
+        "id": channel_id,
+        "after": after,
+        "exportedAt": datetime.now().astimezone().isoformat(sep='T', timespec='microseconds')
+    }
+
+    with open(c.EXPORT_JOURNAL, "a", encoding="utf-8") as file:
+        file.write(json.dumps(entry) + "\n")
+
+
+def finish_journal():
+
+    if os.path.exists(c.EXPORT_JOURNAL):
+        os.remove(c.EXPORT_JOURNAL)
+
+"""
+export_command(channel_id, path, date, before)
+
+    Builds the arguments to call DCE to export a single channel or thread in JSON format.
+
+    Args:
+        channel_id (str): The ID of the channel or thread.
+        path (str): The output path. DCE placeholders like %p or %C are replaced, and "%%" is a "%".
+        date (str, optional): Only export messages after this date or message ID. If not provided, exports the full history.
+        before (str, optional): Only export messages before this date or message ID.
+
+    Returns:
+        list: The program to run and its arguments.
+"""
+def export_command(channel_id, path, date=None, before=None):
+
+    args = [*c.DCE_COMMAND, "export", "-c", channel_id, "-t", tokens.DISCORD_BOT, "-f", "Json", "-o", path, "--locale", "en-GB", "--fuck-russia"]
+
+    if date is not None:
+        args.extend(["--after", date])
+
+    if before is not None:
+        args.extend(["--before", before])
+
+    return args
+
+"""
+start_of_export(channel_id, after)
+
+    Gets the date of the first message a channel export can contain:
+    the date of the watermark, the global date, or the creation date of the channel for a full export.
+
+"""
+def start_of_export(channel_id, after=None):
+
+    if after is None:
+        return t.snowflake_to_datetime(channel_id)
+
+    if after.isdigit():
+        return t.snowflake_to_datetime(after)
 
-    Downloads set of channels or threads.
+    return datetime.fromisoformat(after).astimezone()
 
-    For each channel, DCE is called to download the messages and store them in JSON format, either the full history or from a specified date.
-    Downloads are run in parallel in groups of 3 or 5 to improve performance.
+"""
+expected_messages(channel, after, now)
+
+    Estimates how many messages an export will download, from the number of messages of the channel in the last backup.
+    Messages are assumed to be spread evenly over the life of the channel.
 
     Args:
-        cat (dict): The category data in JSON format.
+        channel (dict): The channel data from the channel list.
+        after (str, optional): The watermark or date the export starts from. If not provided, the full history.
+        now (datetime): The moment of the export.
+
+    Returns:
+        int: The expected number of messages.
+"""
+def expected_messages(channel, after, now):
+
+    total = channel.get("numberOfMessages", 0)
+
+    if after is None or total == 0:
+        return total
+
+    lifetime = (now - t.snowflake_to_datetime(channel["id"])).total_seconds()
+    exported = (now - start_of_export(channel["id"], after)).total_seconds()
+
+    if lifetime <= 0:
+        return total
+
+    return int(total * min(1, max(0, exported / lifetime)))
+
+"""
+shard_ranges(channel_id, after, shards, now)
+
+    Splits the export of a channel into date ranges of the same length.
+
+    The limits of the ranges are the smallest Discord IDs of each date. Each range exports the messages
+    before its end (--before), and after the ID right before its start (--after), so no message is left out.
+
+    Args:
+        channel_id (str): The ID of the channel or thread.
+        after (str, optional): The watermark or date the export starts from. If not provided, the full history.
+        shards (int): The number of ranges.
+        now (datetime): The moment of the export.
+
+    Returns:
+        list: The (after, before) arguments of each range, in order.
+"""
+def shard_ranges(channel_id, after, shards, now):
+
+    start = start_of_export(channel_id, after)
+    step = (now - start) / shards
+
+    limits = [t.datetime_to_snowflake(start + step * shard) for shard in range(1, shards)]
+
+    starts = [after] + [str(int(limit) - 1) for limit in limits]
+    ends = limits + [None]
+
+    return list(zip(starts, ends))
+
+"""
+plan_exports(backup_info, date, manifest, done)
+
+    Builds the list of exports of a download: one for each channel and thread of every category.
+
+    Each channel is exported either with its full history or only the messages after its own watermark
+    (see channel_manifest.get_watermark). Channels already exported in this run are skipped.
+
+    Channels expected to download more than SHARD_MESSAGES messages are split in up to SHARD_COUNT date ranges (shards),
+    exported at the same time into SHARD_FOLDER and joined when all of them finish.
+
+    Exports are sorted by the number of messages they are expected to download, biggest first,
+    so the longest exports start right away and the small ones fill the gaps at the end.
+    Exports of the same size keep the order of the channel list.
+
+    Args:
+        backup_info (dict): The channel list in JSON format.
         date (str, optional): The timestamp of the last export in ISO format. If not provided, downloads the full history.
-        type (str, optional): The type of channels to download, should be "channels" or "threads". Defaults to "channels".
+        manifest (dict): The channel manifest, with the watermark of each channel.
+        done (dict): The channels already exported in this run, by ID.
 
     Returns:
-        None, but saves the downloaded messages to JSON files.
+        list: The exports to run, with the ID of the channel ("id") and of the export ("tag"), the DCE "args",
+              the output "path" and the (after, before) "range" of the export,
+              the "after" watermark of the channel, the expected "size", the "shard" number and total "shards",
+              the "folder" of the channel file and, for DM categories, a "group" to limit how many of them run at once.
 """
-def download_category(cat, date, type="channels"):
+def plan_exports(backup_info, date, manifest, done):
 
-    try:
+    folder = c.SERVER_NAME if date is None else "Update"
+    now = datetime.now().astimezone()
+    layout = fl.plan_layout(backup_info)
+    seeded = cm.has_watermarks(manifest)
+    exports = []
+    skipped = 0
+
+    for cat in backup_info["categories"]:
         category = cat["category"].replace(":", "_")
-        folder = c.SERVER_NAME if date is None else "Update"
-        date = "" if date is None else "--after " + date
+        group = "DM" if category in c.DM_CATEGORIES else None
 
-        path = f"{folder}/{cat["position"]}# {category}/%p# %C.json" if type == "channels" else f"{folder}/{cat["position"]}# {category}/Threads/%p# %C.json"
-        group_size = 3 if category in c.DM_CATEGORIES else 5
+        for type in ("channels", "threads"):
 
-        channels = cat[type]
-        for i in range(0, len(channels), group_size):
+            for channel in cat[type]:
 
-            group = channels[i:i + group_size]
+                if channel["id"] in done:
+                    skipped += 1
+                    continue
 
-            channel_ids = ""
-            for channel in group:
-                channel_ids = channel_ids + " " + channel["id"]
+                after = None if date is None else cm.get_watermark(manifest, channel["id"], date, seeded)
+                size = expected_messages(channel, after, now)
+
+                # each file is exported with its final name, so DCE placeholders in channel names are escaped
+                channel_folder, filename = os.path.split(f"{folder}/{layout[channel['id']]['path']}")
+                path = f"{channel_folder}/{filename}".replace("%", "%%")
+
+                export = {
+                    "id": channel["id"],
+                    "tag": channel["id"],
+                    "args": export_command(channel["id"], path, after),
+                    "path": path,
+                    "range": (after, None),
+                    "after": after,
+                    "size": size,
+                    "shard": None,
+                    "shards": 1,
+                    "folder": channel_folder,
+                    "category": cat["category"],
+                    "group": group
+                }
+
+                shards = min(c.SHARD_COUNT, size // c.SHARD_MESSAGES + 1) if c.SHARD_MESSAGES else 1
+
+                if shards < 2:
+                    exports.append(export)
+                    continue
+
+                # start from scratch, in case a previous download left some shards behind
+                shutil.rmtree(os.path.join(c.SHARD_FOLDER, channel["id"]), ignore_errors=True)
+
+                for shard, (shard_after, shard_before) in enumerate(shard_ranges(channel["id"], after, shards, now)):
+
+                    shard_path = f"{c.SHARD_FOLDER}/{channel["id"]}/{shard}/{filename}".replace("%", "%%")
+
+                    exports.append({
+                        **export,
+                        "tag": f"{channel["id"]}/{shard}",
+                        "args": export_command(channel["id"], shard_path, shard_after, shard_before),
+                        "path": shard_path,
+                        "range": (shard_after, shard_before),
+                        "size": size // shards,
+                        "shard": shard,
+                        "shards": shards
+                    })
+
+    if skipped > 0:
+        t.log("info", f"\tSkipping {skipped} channels and threads already exported in this run")
+
+    exports.sort(key=lambda x: x["size"], reverse=True)
+
+    return exports
+
+"""
+join_shards(export)
+
+    Joins the shards of a channel into a single channel file, in order, and deletes them.
+
+    The file name is the one DCE gave to the last shard. Messages that appear in two shards are only kept once,
+    and messages out of order are an error, since the ranges should never overlap.
+
+    Args:
+        export (dict): Any of the exports of the channel, from plan_exports().
+
+    Returns:
+        int: The number of messages of the channel file.
+"""
+def join_shards(export):
+
+    try:
+        channel_data = None
+        filename = None
+        seen = set()
+        duplicates = 0
+
+        for shard in range(export["shards"]):
+
+            shard_folder = os.path.join(c.SHARD_FOLDER, export["id"], str(shard))
+            files = [file for file in os.listdir(shard_folder) if file.endswith(".json")] if os.path.exists(shard_folder) else []
+
+            # DCE may not write a file for a range without messages
+            if not files:
+                continue
+
+            filename = files[0]
+            shard_data = t.load_from_json(os.path.join(shard_folder, filename))
+
+            if channel_data is None:
+                channel_data = {**shard_data, "messages": []}
+
+            last_id = int(channel_data["messages"][-1]["id"]) if channel_data["messages"] else -1
+
+            for message in shard_data["messages"]:
+
+                if message["id"] in seen:
+                    duplicates += 1
+                    continue
+
+                if int(message["id"]) < last_id:
+                    raise exc.ShardJoinError(f"Message {message['id']} of shard {shard} is older than the previous shard")
+
+                seen.add(message["id"])
+                channel_data["messages"].append(message)
+                last_id = int(message["id"])
+
+            channel_data["channel"] = shard_data["channel"]
+            channel_data.setdefault("dateRange", {})["before"] = shard_data.get("dateRange", {}).get("before")
+
+        if channel_data is None:
+            raise exc.ShardJoinError(f"No shard of {export['id']} has a channel file")
+
+        channel_data["messageCount"] = len(channel_data["messages"])
+
+        os.makedirs(export["folder"], exist_ok=True)
+        t.save_to_json(channel_data, os.path.join(export["folder"], filename))
+
+        shutil.rmtree(os.path.join(c.SHARD_FOLDER, export["id"]))
+
+        if duplicates > 0:
+            t.log("debug", f"\t\t  Dropped {duplicates} duplicated messages at the limits of the shards of {export['id']}")
+
+        return channel_data["messageCount"]
+
+    except exc.ShardJoinError as e:
+        raise e
 
-            cli_command = f'dotnet DCE/DiscordChatExporter.Cli.dll export --parallel {group_size} -c {channel_ids} -t {tokens.DISCORD_BOT} -f Json -o "{path}" --locale "en-GB" {date} --fuck-russia'
-            t.run_command(cli_command, group_size)
-            t.log("info", f"\t\tExported {i+group_size} {type} out of {len(channels)}")
-    
     except Exception as e:
-        raise exc.DownloadExportError(f"An error occurred while downloading '{category}' {type}") from e
+        raise exc.ShardJoinError(f"Failed to join the shards of {export['id']}") from e
+
+"""
+run_exports(exports, manifest)
+
+    Runs the exports of a download from a single shared queue.
+
+    DCE exports run at the same time, and a new one starts as soon as any other finishes, no matter the category.
+    Exports from DM categories also never go over DM_EXPORT_CONCURRENCY at once.
+
+    Exports that fail because of a rate limit or a network error are retried up to EXPORT_RETRIES times,
+    after a jittered backoff. The number of exports at the same time starts at EXPORT_CONCURRENCY,
+    grows up to EXPORT_MAX_CONCURRENCY while there are no rate limits, and is halved on each rate limit (see rate_limit.py).
+
+    An export that doesn't print any progress for EXPORT_STALL_TIMEOUT seconds is killed and queued again
+    from the same watermark. Stalls are counted in the channel manifest and in the trace of the run.
+
+    If EXPORTER is "native", the channels are exported with discord.py in this same process instead (see native_exporter.py),
+    with the same retries and concurrency limits.
+
+    The shards of a channel are joined as soon as the last one finishes.
+    Each channel is added to the journal as soon as it's exported.
+
+    Args:
+        exports (list): The exports to run, from plan_exports().
+        manifest (dict): The channel manifest, to count the stalls of each channel.
+        limiter (AdaptiveConcurrency, optional): The limit of exports at the same time, with the statistics of the rate limits.
+                                                 A new one is created if not provided.
+
+    Returns:
+        list: The result of each export, with its "tag", the DCE return "code", "output", "duration" and "attempts".
+"""
+def run_exports(exports, manifest, limiter=None):
+
+    try:
+        by_tag = {export["tag"]: export for export in exports}
+        channels = len({export["id"] for export in exports})
+        pending_shards = {}
+        failed = []
+        finished = 0
+        retries = 0
+        stalls = {}
+
+        for export in exports:
+            pending_shards[export["id"]] = pending_shards.get(export["id"], 0) + 1
+
+        if limiter is None:
+            limiter = rl.AdaptiveConcurrency(c.EXPORT_CONCURRENCY, c.EXPORT_MAX_CONCURRENCY)
+
+        # decide if a failed export is worth retrying, and adapt the concurrency
+        def retry(result, attempt):
+            nonlocal retries
+
+            outcome = rl.classify(result)
+
+            if outcome == "success":
+                limiter.success()
+                return None
+
+            if outcome == "stall":
+                channel_id = by_tag[result["tag"]]["id"]
+                stalls[channel_id] = stalls.get(channel_id, 0) + 1
+                cm.record_stall(manifest, channel_id)
+
+            if outcome == "rate_limit":
+                limiter.rate_limited(time.monotonic() - result["duration"])
+
+            if outcome == "fatal" or attempt >= c.EXPORT_RETRIES:
+                return None
+
+            delay = rl.backoff(attempt)
+            retries += 1
+
+            t.log("info", f"\t\t{t.YELLOW}Export of {result['tag']} failed ({outcome.replace('_', ' ')}). Retrying in {delay:.1f} seconds...")
+
+            return delay
+
+        # write down each channel as soon as it's exported
+        def checkpoint(result):
+            nonlocal finished
+
+            export = by_tag[result["tag"]]
+
+            tracing.record(result["tag"], "channel", result["duration"], category=export["category"], expectedMessages=export["size"],
+                           attempts=result["attempts"], stalls=stalls.get(export["id"], 0), status="success" if result["code"] == 0 else "failed")
+
+            if result["code"] != 0:
+                if export["id"] not in failed:
+                    failed.append(export["id"])
+                    finished += 1
+                    t.log("info", f"\t\t{t.RED}Failed to export {result['tag']} from '{export['category']}' ({finished}/{channels})")
+                return
+
+            pending_shards[export["id"]] -= 1
+
+            if pending_shards[export["id"]] > 0 or export["id"] in failed:
+                return
+
+            if export["shard"] is not None:
+                try:
+                    messages = join_shards(export)
+                    t.log("info", f"\t\tJoined {export['shards']} shards of {export['id']} ({messages} messages)")
+
+                except exc.ShardJoinError as e:
+                    failed.append(export["id"])
+                    finished += 1
+                    t.log("error", f"\t\t{exc.unwrap(e)}")
+                    return
+
+            finished += 1
+            record_export(export["id"], export["after"])
+            t.log("info", f"\t\tExported {export['id']} from '{export['category']}' ({finished}/{channels}) --- {result['duration']:.2f} seconds ---")
+
+        try:
+            if c.EXPORTER == "native":
+                # discord.py is only needed for this exporter
+                import native_exporter as ne
+                results = ne.export_channels(exports, c.EXPORT_CONCURRENCY, checkpoint, limiter, retry, c.EXPORT_STALL_TIMEOUT)
+
+            else:
+                results = t.run_commands(exports, c.EXPORT_CONCURRENCY, c.EXPORT_CONCURRENCY, checkpoint, {"DM": c.DM_EXPORT_CONCURRENCY},
+                                         limiter, retry, c.EXPORT_STALL_TIMEOUT)
+
+        finally:
+            # keep the stall counts even if the download is interrupted
+            if stalls:
+                cm.save_manifest(manifest)
+
+        t.log("info", f"\n\tExported {channels - len(failed)} channels and threads out of {channels}")
+        t.log("info", f"\t  {retries} retries, {limiter.stats['rateLimits']} rate limits, {sum(stalls.values())} stalled exports. "
+                      f"Exported between {limiter.stats['lowest']} and {limiter.stats['highest']} channels at the same time\n")
+
+        if stalls:
+            t.log("info", f"\t  Stalled exports: {', '.join(f'{tag} ({count})' for tag, count in sorted(stalls.items(), key=lambda x: x[1], reverse=True))}\n")
+
+        if failed:
+            raise exc.DownloadExportError(f"DCE failed to export {len(failed)} channels and threads: {', '.join(failed)}")
+
+        return results
+
+    except exc.DownloadExportError as e:
+        raise e
+
+    except Exception as e:
+        raise exc.DownloadExportError("An error occurred while running the exports") from e
 
 
 
 ################# Main function ################
 
 
+@tracing.traced("step")
 def download_channels(date=None):
 
     try:
@@ -124,42 +589,46 @@ def download_channels(date=None):
         check_base_status()
 
         backup_info = t.load_from_json(c.BACKUP_INFO)
-        
-        channel_count = 0
+        manifest = cm.load_manifest()
+
+        # resume the previous download if it was interrupted
+        journal = load_journal()
+
+        if journal is None:
+            journal = start_journal(date, now)
 
-        # for each category, get channel and thread list
-        for cat in backup_info["categories"]:
+        else:
+            t.log("info", f"\tResuming the download started at {journal['startedAt']}: {len(journal['done'])} channels were already exported\n")
+            date = journal["date"]
 
-            channels_in_category = cat["numberOfChannels"]
-            threads_in_category = cat["numberOfThreads"]
-            total_channels = channels_in_category + threads_in_category
+        # backups made before the manifest existed get their watermarks from the channel files
+        if date is not None and not cm.has_watermarks(manifest) and os.path.exists(c.SERVER_NAME):
+            cm.record_folder(c.SERVER_NAME)
+            manifest = cm.load_manifest()
 
-            t.log("info", f"\n\tExporting {total_channels} channels and threads from '{cat['category']}'...")
+        exports = plan_exports(backup_info, date, manifest, journal["done"])
 
-            download_category(cat, date, "channels")
-            channel_count += channels_in_category
+        t.log("info", f"\n\tExporting {len({export['id'] for export in exports})} channels and threads in {len(exports)} exports, biggest first...")
 
-            if threads_in_category > 0:
-                download_category(cat, date, "threads")
-                channel_count += threads_in_category
+        run_exports(exports, manifest)
 
-            t.log("info", f"\n\tExported {channel_count} channels out of {backup_info['numberOfChannels']}\n")
+        step_status = "success"
+        main_status = "pending"
+        dates = {"exportedAt": now, "lastGoodExport": now}
 
-        backup_info["steps"]["downloadStatus"] = "success"
-        backup_info["status"] = "pending"
-        backup_info["dates"]["lastGoodExport"] = now
+        finish_journal()
 
     # this covers both ExportError and built-in exceptions like OSError and JSON-related ones
     except Exception as e:
-        backup_info["steps"]["downloadStatus"] = "failed"
-        backup_info["status"] = "failed"
+        step_status = "failed"
+        main_status = "failed"
+        dates = {"exportedAt": now}
         raise exc.ExportError(f"An error occurred while exporting the backup") from e
     
     finally:
         try:
             t.log("base", f"### Downloading finished --- {time.time() - start_time:.2f} seconds --- ###\n")
-            backup_info["dates"]["exportedAt"] = now
-            t.save_to_json(backup_info, c.BACKUP_INFO)
+            bs.finish({"downloadStatus": step_status}, main_status, dates)
 
         except Exception as e:
             t.log("error", f"\tFailed to save the backup status: {e}\n")
@@ -38,6 +38,9 @@ class ExportError(Exception):
 class DownloadExportError(ExportError):
     pass
 
+class ShardJoinError(DownloadExportError):
+    pass
+
 class FileSortingError(Exception):
     pass
 
@@ -59,8 +62,26 @@ class MergeError(Exception):
 class FixMessagesError(Exception):
     pass
 
+class MessageIndexError(Exception):
+    pass
+
+class ChannelManifestError(Exception):
+    pass
+
 class UpdateInfoError(Exception):
     pass
 
 class FindScenesError(Exception):
+    pass
+
+class ExportScenesError(Exception):
+    pass
+
+class BundleError(Exception):
+    pass
+
+class BackupManifestError(Exception):
+    pass
+
+class PipelineError(Exception):
     pass
\ No newline at end of file
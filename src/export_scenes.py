@@ -1,7 +1,12 @@
 import datetime
 import time
 import os
+import re
+import shutil
 import tricks as t
+import channel_manifest as cm
+import scene_cache as sc
+from render_scenes import render_scenes, scene_filename
 t.set_path()
 from res import constants as c
 from res import tokens
@@ -14,9 +19,17 @@ This module downloads all the found scenes from a given character as HTML files.
 
 Main function: export_scenes()
 
-    This script reads the scene starts and ends from the JSON files created by the find_scenes script.
-    It creates a folder for the character and downloads each scene as an HTML file, using the DiscordChatExporter.
+    This script reads the scene starts and ends from the JSON files created by the find_scenes script,
+    and creates a folder for the character with each scene as an HTML file.
+
+    If SCENE_RENDERER is "local", the scenes are rendered from the server backup, without downloading anything (see render_scenes.py).
+
+    If it's "dce", the scenes are downloaded with the DiscordChatExporter, with one hour of margin before and after.
     If the scene doesn't have an end message, it will download the whole channel from the scene's start date.
+    Scenes of the same channel that overlap are downloaded together, several downloads run at the same time,
+    and each download is then split into the files of its scenes.
+
+    Either way, exported scenes are kept in the scene cache, and only the scenes that are new or got new messages are exported again.
     
 """
 
@@ -57,9 +70,154 @@ def set_hour(adjustment, timestamp_str):
     return new_timestamp_str
 
 
-################# Main function ################
+"""
+plan_windows(scenes)
 
-def export_scenes():
+    Groups the scenes of each channel into download windows, so scenes that are close to each other are downloaded together.
+
+    Each scene needs the messages from one hour before its start to one hour after its end, or until the end of the channel
+    if it has no end. Windows of the same channel that overlap are merged into one.
+
+    Args:
+        scenes (list): The scenes, from the scenes file.
+
+    Returns:
+        list: The windows, each with the "channelId", the padded "after" and "before" dates ("before" is None for no end),
+              and the "scenes" it contains.
+"""
+def plan_windows(scenes):
+
+    by_channel = {}
+
+    for scene in scenes:
+        by_channel.setdefault(scene["channelId"], []).append(scene)
+
+    windows = []
+
+    for channel_id, channel_scenes in by_channel.items():
+
+        channel_scenes.sort(key=lambda x: int(x["start"]["id"]))
+        current = None
+
+        for scene in channel_scenes:
+
+            after = datetime.datetime.fromisoformat(set_hour("before", scene["start"]["timestamp"]))
+            before = datetime.datetime.fromisoformat(set_hour("after", scene["end"]["timestamp"])) if scene.get("end") else None
+
+            # merge it with the previous window if they overlap
+            if current is not None and (current["before"] is None or after <= current["before"]):
+                if current["before"] is not None and (before is None or before > current["before"]):
+                    current["before"] = before
+                current["scenes"].append(scene)
+                continue
+
+            current = {"channelId": channel_id, "after": after, "before": before, "scenes": [scene]}
+            windows.append(current)
+
+    return windows
+
+"""
+scene_command(channel_id, path, after, before)
+
+    Builds the arguments to call DCE to download part of a channel in HTML format.
+
+"""
+def scene_command(channel_id, path, after, before=None):
+
+    args = [*c.DCE_COMMAND, "export", "-c", channel_id, "-t", tokens.DISCORD_BOT, "-f", "HtmlDark", "-o", path,
+            "--locale", "en-GB", "--after", after.isoformat(), "--fuck-russia"]
+
+    if before is not None:
+        args.extend(["--before", before.isoformat()])
+
+    return args
+
+"""
+    These regex patterns find the message groups, messages and footer of a DCE HTML export.
+    DCE may write the attributes without quotes when it minifies the HTML.
+
+"""
+group_pattern = re.compile(r'<div class="?chatlog__message-group"?>')
+container_pattern = re.compile(r'<div [^>]*\bid="?chatlog__message-container-(\d+)"?')
+postamble_pattern = re.compile(r'<div class="?postamble"?')
+
+"""
+split_window(window_html, scenes)
+
+    Splits the HTML of a window into one HTML page per scene.
+
+    Each page keeps the header and footer of the window, and only the messages from the start to the end of the scene.
+    Message groups that are cut by the start of a scene keep their opening, with the author header,
+    so the first message of every page shows who wrote it.
+
+    Args:
+        window_html (str): The HTML file of the window.
+        scenes (list): The scenes of the window.
+
+    Returns:
+        list: The HTML page of each scene, in the same order, or None if the file doesn't look like a DCE export.
+"""
+def split_window(window_html, scenes):
+
+    groups = [match.start() for match in group_pattern.finditer(window_html)]
+
+    if not groups:
+        return None
+
+    postamble = postamble_pattern.search(window_html, groups[-1])
+    chatlog_end = window_html.rfind("</div>", groups[-1], postamble.start() if postamble else len(window_html))
+
+    if chatlog_end == -1:
+        return None
+
+    # list the messages of each group, with their text
+    parsed_groups = []
+
+    for start, end in zip(groups, groups[1:] + [chatlog_end]):
+
+        chunk = window_html[start:end].rstrip()
+        if chunk.endswith("</div>"):
+            chunk = chunk[:-len("</div>")]
+
+        containers = list(container_pattern.finditer(chunk))
+        messages = []
+
+        for i, container in enumerate(containers):
+            container_end = containers[i + 1].start() if i + 1 < len(containers) else len(chunk)
+            messages.append((int(container.group(1)), chunk[container.start():container_end]))
+
+        parsed_groups.append((chunk[:containers[0].start()] if containers else chunk, messages))
+
+    header = window_html[:groups[0]]
+    footer = window_html[chatlog_end:]
+
+    pages = []
+
+    for scene in scenes:
+
+        first = int(scene["start"]["id"])
+        last = int(scene["end"]["id"]) if scene.get("end") else None
+
+        body = []
+
+        for opening, messages in parsed_groups:
+            selected = [text for message_id, text in messages if message_id >= first and (last is None or message_id <= last)]
+
+            if selected:
+                body.append(opening + "".join(selected) + "</div>\n")
+
+        pages.append(header + "".join(body) + footer)
+
+    return pages
+
+"""
+download_scenes()
+
+    Downloads the scenes with DCE, one download per window of scenes, several windows at the same time.
+    Then each window is split into the HTML files of its scenes.
+
+"""
+def download_scenes():
 
     t.log("base", f"\n##  Exporting all scenes with '{c.CHARACTER}'...  ##\n")
     t.log("base", "This may take a few minutes...\n")
@@ -72,40 +230,86 @@ def export_scenes():
     t.log("info", f"\tLoaded scene information for {len(scenes)} scenes\n")
 
     folder = f"out/{c.CHARACTER}"
-    os.makedirs(folder, exist_ok=True)
+    windows_folder = os.path.join(folder, ".windows")
+    os.makedirs(windows_folder, exist_ok=True)
+
+    # scenes that were already downloaded, for this or another character, come from the cache
+    manifest = cm.load_manifest()
+    used_names = set()
+    pending = []
+    cached = 0
 
-    # for each scene
-    for i, scene in enumerate(scenes):
+    for scene in scenes:
 
-        t.log("info", f"\tDownloading scene {i+1} out of {len(scenes)}...")
+        scene["outputPath"] = os.path.join(folder, scene_filename(scene, used_names))
+        scene["cacheKey"] = sc.lookup(scene, "HtmlDark", manifest)
 
-        # get start date
-        date = set_hour("before", scene['start']['timestamp'])
-        channel = scene['channelId']
+        if sc.fetch(scene["cacheKey"], scene["outputPath"]):
+            cached += 1
+        else:
+            pending.append(scene)
 
-        t.log("debug", f"\t  Scene in '{scene['channel']}' starts at {date}")
-        
-        # find if it has an end message
-        end = scene.get('end', None)
+    if cached > 0:
+        t.log("info", f"\tReused {cached} scenes from the cache")
 
-        if end == None or end == "":
-            t.log("debug", f"\t  Scene has no end message")
-            has_end = ""
+    windows = plan_windows(pending)
 
-        else:
-            # find end date
-            end_date = set_hour("after", scene['end']['timestamp'])
+    t.log("info", f"\tDownloading {len(pending)} scenes in {len(windows)} windows...")
 
-            t.log("debug", f"\t  Scene ends at {end_date}")
-            has_end = f"--before {end_date}"
+    commands = []
 
-        # download channel from date to end_date
-        cli_command = f'dotnet DCE/DiscordChatExporter.Cli.dll export -c {channel} -t {tokens.DISCORD_BOT} -f HtmlDark -o "{folder}/%a - %C.html" --locale "en-GB" --after {date} {has_end} --fuck-russia'
-        t.run_command(cli_command, 2)
+    for i, window in enumerate(windows):
+        window["path"] = os.path.join(windows_folder, f"{window['channelId']}-{i}.html")
+        commands.append({"tag": str(i), "args": scene_command(window["channelId"], window["path"], window["after"], window["before"])})
 
-        t.log("debug", f"\tScene downloaded\n")
-    
+    results = t.run_commands(commands, c.EXPORT_CONCURRENCY, 2)
+
+    saved = cached
+
+    for window, result in zip(windows, results):
+
+        if result["code"] != 0 or not os.path.exists(window["path"]):
+            t.log("info", f"\t{t.RED}Failed to download the scenes of channel {window['channelId']} from {window['after']}")
+            continue
+
+        with open(window["path"], "r", encoding="utf-8") as file:
+            window_html = file.read()
+
+        pages = split_window(window_html, window["scenes"])
+
+        # if the file can't be split, each scene gets the whole window
+        if pages is None:
+            t.log("info", f"\t{t.YELLOW}Could not split the download of channel {window['channelId']}. Saving the whole window for each scene")
+            pages = [window_html] * len(window["scenes"])
+
+        for scene, page in zip(window["scenes"], pages):
+
+            sc.prepare(scene["outputPath"])
+
+            with open(scene["outputPath"], "w", encoding="utf-8") as file:
+                file.write(page)
+
+            sc.store(scene["cacheKey"], scene["outputPath"], scene)
+            saved += 1
+
+        os.remove(window["path"])
+
+    shutil.rmtree(windows_folder, ignore_errors=True)
+
+    t.log("info", f"\n\tSaved {saved} scenes out of {len(scenes)} into {folder}")
     t.log("base", f"\n##  Finished downloading all scenes! --- {time.time() - start_time:.2f} seconds --- ##\n")
-        
+
+
+################# Main function ################
+
+def export_scenes():
+
+    if c.SCENE_RENDERER == "local":
+        render_scenes()
+
+    else:
+        download_scenes()
+
+
 if __name__ == "__main__":
     export_scenes()
\ No newline at end of file
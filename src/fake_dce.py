@@ -0,0 +1,190 @@
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+################# File summary #################
+
+"""
+
+This module pretends to be DCE, to test the download without calling Discord.
+
+Main function: fake_export(args)
+
+    This script takes the same arguments as a DCE export, waits a bit as if it was downloading,
+    and writes a channel file with a few made-up messages in DCE format.
+
+    It can also fail like DCE does when Discord has problems:
+        - If more than FAKE_DCE_LIMIT exports run at the same time, it fails with a rate limit (HTTP 429).
+        - With a probability of FAKE_DCE_ERROR_RATE, it fails with a server error (HTTP 503).
+        - With a probability of FAKE_DCE_STALL_RATE, it hangs without printing anything.
+
+    To use it, point DCE_COMMAND in res/constants.py to it:
+        DCE_COMMAND = ["python", "src/fake_dce.py"]
+
+    It's configured with environment variables:
+        FAKE_DCE_LIMIT: exports allowed at the same time before rate limiting. Defaults to 3
+        FAKE_DCE_ERROR_RATE: probability of a server error, between 0 and 1. Defaults to 0
+        FAKE_DCE_STALL_RATE: probability of hanging, between 0 and 1. Defaults to 0
+        FAKE_DCE_DELAY: seconds each export takes. Defaults to 0.5
+        FAKE_DCE_MESSAGES: messages written to each channel file. Defaults to 10
+
+    Only the standard library is used, so each call starts fast.
+
+    check_exports.py uses it to check the retries and the concurrency of the download.
+
+"""
+
+################# Functions #################
+
+DISCORD_EPOCH = 1420070400000
+
+"""
+get_option(args, name, default)
+
+    Gets the value of a command line option, like "-c 1234".
+
+"""
+def get_option(args, name, default=None):
+
+    if name in args and args.index(name) + 1 < len(args):
+        return args[args.index(name) + 1]
+
+    return default
+
+"""
+snowflake(moment)
+
+    Creates a Discord ID for a message sent at the given time.
+
+"""
+def snowflake(moment):
+    return str((int(moment.timestamp() * 1000) - DISCORD_EPOCH) << 22)
+
+"""
+running_exports(state_folder)
+
+    Context manager that registers this process as a running export while it's open,
+    and tells how many exports are running at the same time, this one included.
+
+"""
+class running_exports:
+
+    def __init__(self, state_folder):
+        self.marker = os.path.join(state_folder, str(os.getpid()))
+        os.makedirs(state_folder, exist_ok=True)
+
+    def __enter__(self):
+        open(self.marker, "w").close()
+
+        running = 0
+
+        # exports that were killed leave their marker behind, so only count the live ones
+        for name in os.listdir(os.path.dirname(self.marker)):
+            try:
+                os.kill(int(name), 0)
+                running += 1
+            except (OSError, ValueError):
+                try:
+                    os.remove(os.path.join(os.path.dirname(self.marker), name))
+                except OSError:
+                    pass
+
+        return running
+
+    def __exit__(self, *exc_info):
+        os.remove(self.marker)
+
+"""
+fake_channel(channel_id, after, before, count)
+
+    Creates the content of a channel file in DCE format, with 'count' messages sent between 'after' and 'before'.
+
+"""
+def fake_channel(channel_id, after, before, count):
+
+    end = (int(before) >> 22) + DISCORD_EPOCH if before is not None and before.isdigit() else int(time.time() * 1000)
+
+    if after is not None and after.isdigit():
+        start = (int(after) >> 22) + DISCORD_EPOCH + 1
+    else:
+        start = end - count * 60000
+
+    messages = []
+
+    for i in range(count):
+        moment = datetime.fromtimestamp((start + (end - start) * i // count) / 1000, timezone.utc)
+
+        messages.append({
+            "id": snowflake(moment),
+            "type": "Default",
+            "timestamp": moment.isoformat(),
+            "content": f"Fake message {i + 1}",
+            "author": {"id": "1", "name": "Fake Writer", "isBot": False},
+            "mentions": []
+        })
+
+    return {
+        "guild": {"id": "0", "name": "Fake server"},
+        "channel": {"id": channel_id, "type": "GuildTextChat", "category": "Fake category", "name": f"channel-{channel_id}"},
+        "dateRange": {"after": after, "before": before},
+        "messages": messages,
+        "messageCount": len(messages)
+    }
+
+
+################# Main function #################
+
+def fake_export(args):
+
+    channel_id = get_option(args, "-c")
+    path = get_option(args, "-o")
+    after = get_option(args, "--after")
+    before = get_option(args, "--before")
+
+    limit = int(os.environ.get("FAKE_DCE_LIMIT", 3))
+    error_rate = float(os.environ.get("FAKE_DCE_ERROR_RATE", 0))
+    stall_rate = float(os.environ.get("FAKE_DCE_STALL_RATE", 0))
+    delay = float(os.environ.get("FAKE_DCE_DELAY", 0.5))
+    count = int(os.environ.get("FAKE_DCE_MESSAGES", 10))
+
+    with running_exports(os.path.join(tempfile.gettempdir(), "fake_dce")) as running:
+
+        print(f"Exporting channel {channel_id}...", flush=True)
+
+        if random.random() < stall_rate:
+            time.sleep(24 * 60 * 60)
+
+        time.sleep(delay)
+
+        if running > limit:
+            print("ERROR: Response status code does not indicate success: 429 (Too Many Requests).", flush=True)
+            return 1
+
+        if random.random() < error_rate:
+            print("ERROR: Response status code does not indicate success: 503 (Service Unavailable).", flush=True)
+            return 1
+
+        channel = fake_channel(channel_id, after, before, count)
+
+        file_path = path.replace("%p", "1").replace("%C", channel["channel"]["name"]).replace("%c", channel["channel"]["category"])
+        os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
+
+        with open(file_path, "w", encoding="utf-8") as file:
+            json.dump(channel, file, indent=4)
+
+        print(f"Successfully exported {count} messages.", flush=True)
+
+    return 0
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) < 2 or sys.argv[1] != "export":
+        print("\nOnly 'export' is supported by the fake DCE.\n")
+        sys.exit(1)
+
+    sys.exit(fake_export(sys.argv[2:]))
@@ -0,0 +1,192 @@
+import json
+import re
+import sys
+import threading
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+################# File summary #################
+
+"""
+
+This module pretends to be the Discord API, to test the native exporter without Discord.
+
+Main function: start_server(port, messages, rate_limit_every)
+
+    This script starts a local HTTP server that answers the few requests the native exporter makes:
+    the bot user, channels, servers, and pages of messages.
+
+    Any channel ID exists. Each channel has 'messages' made-up messages, one per minute since the channel was created,
+    and channels with an ID that ends in an odd number are threads of the channel with the ID before it.
+
+    Every 'rate_limit_every' requests, it answers with a rate limit (HTTP 429), like Discord does.
+
+    To use it, start it and point DISCORD_API in res/constants.py to it:
+        python src/fake_discord.py 8080 250 10
+        DISCORD_API = "http://127.0.0.1:8080/api/v10"
+
+    Only the standard library is used.
+
+"""
+
+################# Functions #################
+
+DISCORD_EPOCH = 1420070400000
+GUILD_ID = "1000000000000000000"
+
+message_pattern = re.compile(r"^/api/v\d+/channels/(\d+)/messages$")
+channel_pattern = re.compile(r"^/api/v\d+/channels/(\d+)$")
+guild_pattern = re.compile(r"^/api/v\d+/guilds/(\d+)$")
+
+"""
+fake_messages(channel_id, count)
+
+    Creates the messages of a channel, in the format of the Discord API, from the oldest to the newest.
+
+"""
+def fake_messages(channel_id, count):
+
+    start = (int(channel_id) >> 22) + DISCORD_EPOCH
+    messages = []
+
+    for i in range(count):
+        milliseconds = start + (i + 1) * 60000
+        bot = i % 3 != 0
+
+        messages.append({
+            "id": str(((milliseconds - DISCORD_EPOCH) << 22) + i % 4096),
+            "type": 0,
+            "channel_id": channel_id,
+            "content": f"Fake message {i + 1}",
+            "timestamp": datetime.fromtimestamp(milliseconds / 1000, timezone.utc).isoformat(),
+            "edited_timestamp": None,
+            "pinned": False,
+            "author": {
+                "id": str(2000 + i % 2) if bot else "3000",
+                "username": f"Character {i % 2}" if bot else "Writer",
+                "discriminator": "0000",
+                "avatar": None,
+                "bot": bot
+            },
+            "attachments": [],
+            "embeds": [],
+            "mentions": []
+        })
+
+    return messages
+
+"""
+fake_channel(channel_id)
+
+    Creates a channel in the format of the Discord API.
+
+"""
+def fake_channel(channel_id):
+
+    thread = int(channel_id) % 2 == 1
+
+    return {
+        "id": channel_id,
+        "type": 11 if thread else 0,
+        "guild_id": GUILD_ID,
+        "parent_id": str(int(channel_id) - 1) if thread else "900",
+        "name": f"thread-{channel_id}" if thread else f"channel-{channel_id}",
+        "position": int(channel_id) % 50,
+        "topic": None
+    }
+
+
+class FakeDiscordHandler(BaseHTTPRequestHandler):
+
+    messages = 250
+    rate_limit_every = 0
+    requests = 0
+    lock = threading.Lock()
+    cache = {}
+
+    def send_json(self, status, data, headers=None):
+
+        body = json.dumps(data).encode("utf-8")
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+
+        with self.lock:
+            FakeDiscordHandler.requests += 1
+            rate_limited = self.rate_limit_every and FakeDiscordHandler.requests % self.rate_limit_every == 0
+
+        # discord.py only trusts rate limits that come through Discord's proxy, so it's faked too
+        if rate_limited:
+            self.send_json(429, {"message": "You are being rate limited.", "retry_after": 0.05, "global": False},
+                           {"Retry-After": "0.05", "X-RateLimit-Scope": "user", "Via": "1.1 google"})
+            return
+
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+
+        if url.path.endswith("/users/@me"):
+            self.send_json(200, {"id": "1", "username": "Socrates", "discriminator": "0000", "avatar": None, "bot": True})
+
+        elif match := message_pattern.match(url.path):
+            channel_id = match.group(1)
+
+            if channel_id not in self.cache:
+                self.cache[channel_id] = fake_messages(channel_id, self.messages)
+
+            limit = int(query.get("limit", ["50"])[0])
+            after = int(query.get("after", ["0"])[0])
+
+            # the API returns the oldest messages after the ID, from the newest to the oldest
+            page = [message for message in self.cache[channel_id] if int(message["id"]) > after][:limit]
+            self.send_json(200, page[::-1])
+
+        elif match := channel_pattern.match(url.path):
+            self.send_json(200, fake_channel(match.group(1)))
+
+        elif match := guild_pattern.match(url.path):
+            self.send_json(200, {"id": match.group(1), "name": "Fake server", "icon": None})
+
+        else:
+            self.send_json(404, {"message": "404: Not Found", "code": 0})
+
+    def log_message(self, format, *args):
+        pass
+
+
+################# Main function #################
+
+def start_server(port=0, messages=250, rate_limit_every=0):
+
+    FakeDiscordHandler.messages = messages
+    FakeDiscordHandler.rate_limit_every = rate_limit_every
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), FakeDiscordHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
+
+
+if __name__ == "__main__":
+
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
+    messages = int(sys.argv[2]) if len(sys.argv) > 2 else 250
+    rate_limit_every = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+
+    server = start_server(port, messages, rate_limit_every)
+
+    print(f"\nFake Discord API running on http://127.0.0.1:{server.server_address[1]}/api/v10 (Ctrl+C to stop)\n")
+
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
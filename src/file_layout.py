@@ -0,0 +1,269 @@
+import os
+import re
+import tricks as t
+t.set_path()
+from res import constants as c
+
+################ File summary #################
+
+"""
+
+This module decides the final name of every channel and thread file of the backup, before they are exported.
+
+Main functions: plan_layout(backup_info), move_files(base_folder, layout, paths)
+
+    The name of each file has the position of the channel inside its category, and threads also have their position
+    inside their channel, so the files are in the same order as in the server:
+        [category position]# [category]/[position]# [channel].json
+        [category position]# [category]/Threads/[position]-[thread position]# [thread].json
+
+    The positions come from the list of channels, so the paths are known before exporting,
+    and DCE writes each file with its final name.
+
+    When channels are added, moved or renamed in the server, the files of the main backup are renamed once to their new path,
+    so the updates can be merged into them. Files of channels that are not in the list anymore are moved to the "Removed" folder
+    if another channel takes their path, with the ID of the channel in their name, so they never replace an older removed file.
+    The paths are kept in LAYOUT_MANIFEST with this format:
+        {
+            "paths": { "channel ID": "2# Category/1# channel.json", ... },
+            "moves": [ { "id": "...", "from": "...", "to": "..." }, ... ],
+            "phase": null
+        }
+
+    Files are first moved to a staging folder and then to their new path, so two files can swap names.
+    The pending moves are saved before any file is touched, so if the renaming is interrupted,
+    the next run finishes it from the same "phase" instead of leaving the backup half renamed.
+
+"""
+
+################ Functions #################
+
+STAGING_FOLDER = ".layout"
+REMOVED_FOLDER = "Removed"
+
+"""
+    This regex pattern finds the characters that can't be in a file name, which DCE replaces with "_".
+
+"""
+invalid_characters_pattern = re.compile(r'[\x00-\x1f"<>|:*?\\/]')
+
+"""
+escape_filename(name)
+
+    Replaces the characters that can't be in a file name, like DCE does.
+
+"""
+def escape_filename(name):
+    return invalid_characters_pattern.sub("_", name)
+
+"""
+sort_threads_in_channel(threads)
+
+    In DCE, threads can only be sorted by alphabetical order.
+    This method sorts them by channel and then by date of creation, and assigns them a thread position.
+
+    The date of creation is taken from the ID of the thread: Discord IDs start with the time they were created,
+    so no thread file has to be opened.
+
+    Args:
+        threads (list): The list of threads to be sorted.
+
+"""
+def sort_threads_in_channel(threads):
+
+    # sort the list by position, then by creation time
+    threads.sort(key=lambda x: (x["position"], int(x["id"])))
+
+    # for each position (associated with a channel), assign thread positions
+    thread_positions = {}
+
+    for thread in threads:
+        thread_positions[thread["position"]] = thread_positions.get(thread["position"], 0) + 1
+        thread["threadPosition"] = thread_positions[thread["position"]]
+
+"""
+plan_layout(backup_info)
+
+    Calculates the final path of every channel and thread file from the list of channels.
+
+    Channels keep the order of the list, which DCE gives by position. Threads take the position of their channel,
+    and are numbered inside it by date of creation. The list of channels is not modified.
+
+    Args:
+        backup_info (dict): The list of channels.
+
+    Returns:
+        dict: The "path", "position" and, for threads, "threadPosition" of each channel and thread, by ID.
+              Paths are relative to the backup folder, with "/" as separator.
+"""
+def plan_layout(backup_info):
+
+    layout = {}
+
+    for category in backup_info["categories"]:
+
+        folder = f"{category['position']}# {category['category'].replace(':', '_')}"
+        positions = {}
+
+        for position, channel in enumerate(sorted(category["channels"], key=lambda x: x["position"]), start=1):
+
+            positions.setdefault(channel["channel"], position)
+
+            layout[channel["id"]] = {
+                "path": f"{folder}/{position}# {escape_filename(channel['channel'])}.json",
+                "position": position
+            }
+
+        threads = [
+            {"id": thread["id"], "thread": thread["thread"], "position": positions.get(thread["channel"], len(positions) + 1)}
+            for thread in category["threads"]
+        ]
+
+        sort_threads_in_channel(threads)
+
+        for thread in threads:
+            layout[thread["id"]] = {
+                "path": f"{folder}/Threads/{thread['position']}-{thread['threadPosition']}# {escape_filename(thread['thread'])}.json",
+                "position": thread["position"],
+                "threadPosition": thread["threadPosition"]
+            }
+
+    return layout
+
+"""
+load_layout(), save_layout(layout)
+
+    Functions to read and write the layout manifest. If there is no manifest yet, it's empty.
+
+    The manifest is written to a temporary file first and then replaces the old one,
+    so it's never left half written.
+
+"""
+def load_layout():
+    try:
+        return t.load_from_json(c.LAYOUT_MANIFEST)
+
+    except FileNotFoundError:
+        return {"paths": {}, "moves": [], "phase": None}
+
+
+def save_layout(layout):
+    t.save_to_json(layout, f"{c.LAYOUT_MANIFEST}.tmp")
+    os.replace(f"{c.LAYOUT_MANIFEST}.tmp", c.LAYOUT_MANIFEST)
+
+"""
+finish_moves(base_folder, layout)
+
+    Moves the files of the pending moves of the layout, in two phases: first to the staging folder, then to their new path.
+    Each move is skipped if it was already done, so it can be run again after an interruption.
+
+"""
+def finish_moves(base_folder, layout):
+
+    staging_folder = os.path.join(base_folder, STAGING_FOLDER)
+
+    if layout["phase"] == "staging":
+
+        os.makedirs(staging_folder, exist_ok=True)
+
+        for move in layout["moves"]:
+            source = os.path.join(base_folder, move["from"])
+
+            if os.path.exists(source):
+                os.replace(source, os.path.join(staging_folder, f"{move['id']}.json"))
+
+        layout["phase"] = "placing"
+        save_layout(layout)
+
+    if layout["phase"] == "placing":
+
+        for move in layout["moves"]:
+            staged = os.path.join(staging_folder, f"{move['id']}.json")
+            destination = os.path.join(base_folder, move["to"])
+
+            if os.path.exists(staged):
+                os.makedirs(os.path.dirname(destination), exist_ok=True)
+                os.replace(staged, destination)
+                t.log("log", "\tRenamed file: %s → %s", move["from"], move["to"])
+
+        # remove the folders left empty, like the folder of a category that changed position
+        for folder in {os.path.dirname(os.path.join(base_folder, move["from"])) for move in layout["moves"]} | {staging_folder}:
+            while os.path.normpath(folder) != os.path.normpath(base_folder) and os.path.isdir(folder) and not os.listdir(folder):
+                os.rmdir(folder)
+                folder = os.path.dirname(folder)
+
+    for move in layout["moves"]:
+        layout["paths"][move["id"]] = move["to"]
+
+    layout["moves"] = []
+    layout["phase"] = None
+    save_layout(layout)
+
+"""
+removed_path(base_folder, path, channel_id)
+
+    Gets a free path in the "Removed" folder for the file of a channel that is not in the list anymore:
+        Removed/[path without .json] [channel ID].json
+    If a file of the same channel was already removed with that name, a number is added after the ID.
+
+"""
+def removed_path(base_folder, path, channel_id):
+
+    stem = f"{REMOVED_FOLDER}/{path.removesuffix('.json')} [{channel_id}]"
+    removed = f"{stem}.json"
+    copy = 1
+
+    while os.path.exists(os.path.join(base_folder, removed)):
+        copy += 1
+        removed = f"{stem} ({copy}).json"
+
+    return removed
+
+"""
+move_files(base_folder, layout, paths)
+
+    Renames the files of the backup whose path changed, so each file is renamed only once.
+    Moves left pending by an interrupted run are finished first.
+
+    Args:
+        base_folder (str): The folder of the backup.
+        layout (dict): The layout manifest, with the current "paths" of the files.
+        paths (dict): The new path of each channel and thread, by ID.
+
+    Returns:
+        list: The moves done, with the channel "id" and the path it was moved "from" and "to".
+"""
+def move_files(base_folder, layout, paths):
+
+    if layout["moves"]:
+        t.log("info", f"\tFinishing {len(layout['moves'])} renames left pending by an interrupted run...")
+        finish_moves(base_folder, layout)
+
+    moves = [
+        {"id": channel_id, "from": layout["paths"][channel_id], "to": path}
+        for channel_id, path in paths.items()
+        if layout["paths"].get(channel_id, path) != path and os.path.exists(os.path.join(base_folder, layout["paths"][channel_id]))
+    ]
+
+    # files of channels that are not in the list anymore are moved out of the way of the channels that take their path
+    claimed = set(paths.values())
+
+    for channel_id, path in layout["paths"].items():
+        if channel_id not in paths and path in claimed and os.path.exists(os.path.join(base_folder, path)):
+            moves.append({"id": channel_id, "from": path, "to": removed_path(base_folder, path, channel_id)})
+
+    # save the pending moves before touching any file
+    layout["moves"] = moves
+    layout["phase"] = "staging"
+    save_layout(layout)
+
+    finish_moves(base_folder, layout)
+
+    layout["paths"].update(paths)
+    save_layout(layout)
+
+    return moves
+
+
+if __name__ == "__main__":
+    print("\nThis module is not intended to be run directly.\n")
@@ -1,10 +1,15 @@
 import os
 import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import tricks as t
 import exceptions as exc
+import tracing
+import backup_state as bs
+import channel_manifest as cm
+import backup_manifest as bm
 from assign_ids import get_character_name
 from find_scenes import find_character_scenes_in_channel
-from update_info import update_info
+from update_info import fold_category, add_up_categories
 t.set_path()
 from res import constants as c
 
@@ -25,6 +30,12 @@ Main function: find_all_scenes()
     Once it has searched through all the channels of a category, it aggregates all the scenes and saves them to a JSON file.
     
     To finish, it aggregates all the scenes found in all the categories and saves them to a JSON file.
+
+    Channels that didn't change since the last time their scenes were found, according to the backup manifest,
+    are not searched again: their scenes are taken from the scenes file of their category.
+
+    Categories are searched at the same time, each one in a worker process. As soon as a category is done,
+    its statistics are added up in the list of channels, while the other categories are still being searched.
 """
 
 ################# Functions #################
@@ -43,16 +54,14 @@ def check_base_status():
 
         t.log("debug", "\nChecking the status of the backup...")
 
-        backup_info = t.load_from_json(c.BACKUP_INFO)
+        bs.acquire("find_all_scenes")
+        state = bs.load_state()
 
         t.log("debug", "  Loaded the status file\n")
 
-        t.log("debug", f"  The current status of the backup is '{backup_info["status"]}'\n")
+        t.log("debug", f"  The current status of the backup is '{state["status"]}'\n")
 
-        if backup_info["status"] == "running":
-            raise exc.AlreadyRunningError("The export is still running in another process. Exiting...")
-        
-        if backup_info["status"] != "success":
+        if state["status"] != "success":
             raise exc.DataNotReadyError("The data may be corrupted or incomplete. Ensure the backup downloaded successfully and try again.")
 
     except (exc.AlreadyRunningError, exc.DataNotReadyError) as e:
@@ -166,10 +175,14 @@ def find_all_scenes_in_channel(channel, category_pos=1, channel_pos=1, thread_po
     if len(characters_in_channel) == 0:
         return [], []
 
+    # the names of the characters are read from the character list, so they're only looked up if they're shown
+    verbose = t.log_enabled("debug")
+
     # find the scenes for each character
     for character in characters_in_channel:
 
-        t.log("debug", f"\t  Finding scenes with '{get_character_name(character)}'...")
+        if verbose:
+            t.log("debug", f"\t  Finding scenes with '{get_character_name(character)}'...")
 
         scenes, discard_id = find_character_scenes_in_channel(channel, [character], 0, True)
 
@@ -179,7 +192,8 @@ def find_all_scenes_in_channel(channel, category_pos=1, channel_pos=1, thread_po
                 scene_starts_lookup.append(scene["start"]["id"])
                 total_scenes.append(scene)
     
-        t.log("debug", f"\t    Found {len(scenes)} scenes with '{get_character_name(character)}', adding up to {len(total_scenes)} total scenes\n")
+        if verbose:
+            t.log("debug", f"\t    Found {len(scenes)} scenes with '{get_character_name(character)}', adding up to {len(total_scenes)} total scenes\n")
 
     # sort the scenes by start time
     total_scenes.sort(key=lambda x: x["start"]["index"])
@@ -194,10 +208,59 @@ def find_all_scenes_in_channel(channel, category_pos=1, channel_pos=1, thread_po
 
     return total_scenes, total_scenes_debug
 
-def prep_channel(channel, category):
+"""
+prep_channel(channel, category, manifest, file_manifest, previous_scenes):
+
+    Finds all the scenes in a channel or thread file, and writes down its statistics in the channel manifest.
+
+    If the file didn't change since its scenes were found in the same position, the scenes found then are used.
+    If it didn't change and none of its authors is a character, it has no scenes and isn't opened.
+
+    Args:
+        channel (dict): The channel or thread, from the list of channels.
+        category (dict): The category of the channel.
+        manifest (dict): The channel manifest.
+        file_manifest (sqlite3.Connection): The backup manifest.
+        previous_scenes (dict): The scenes and debug scenes of the last run, by channel ID.
+
+    Returns:
+        tuple[list, list]: The scenes and the debug scenes of the channel.
+"""
+def prep_channel(channel, category, manifest, file_manifest, previous_scenes):
 
     file_path = os.path.join(c.SEARCH_FOLDER, channel["path"])
-    t.log("log", f"  Analysing {channel.get('thread', channel['channel'])}...")
+    t.log("log", "  Analysing %s...", channel.get("thread", channel["channel"]))
+
+    # the IDs of the scenes depend on the position of the file
+    step = f"find_all_scenes:{category['position']}-{channel['position']}-{channel.get('threadPosition', 0)}"
+    entry = bm.lookup(file_manifest, file_path)
+
+    if entry is not None and channel["id"] in manifest:
+
+        # channels without scenes aren't in the scenes of the category, any other missing channel has to be found again
+        cached = previous_scenes.get(channel["id"])
+
+        if cached is None and manifest[channel["id"]].get("numberOfScenes") == 0:
+            cached = ([], [])
+
+        if step in entry["steps"] and cached is not None:
+
+            scenes, scenes_debug = cached
+            tracing.add(scenes=len(scenes))
+
+            t.log("log", "\tThe channel didn't change, reusing its %d scenes", len(scenes))
+
+            return scenes, scenes_debug
+
+        # characters have IDs under 1000, a file without them has no scenes wherever it is
+        if entry["authors"] is not None and all(int(author) >= 1000 for author in entry["authors"]):
+
+            cm.record_scenes(manifest, channel["id"], 0)
+            bm.record(file_manifest, entry, step, entry)
+
+            t.log("log", "\tThe channel has no characters, skipping it")
+
+            return [], []
 
     # Load JSON channel from file
     json_data = t.load_from_json(file_path)
@@ -205,22 +268,56 @@ def prep_channel(channel, category):
     # Find scene starts and ends involving character
     scenes, scenes_debug = find_all_scenes_in_channel(json_data, category["position"], channel["position"], channel.get("threadPosition", 0))
 
+    tracing.add(messages=len(json_data["messages"]), scenes=len(scenes))
+
+    # keep the statistics of the channel up to date, so update_info doesn't have to open the files again
+    cm.update_channel(manifest, json_data)
+    cm.record_scenes(manifest, channel["id"], len(scenes))
+    bm.record(file_manifest, bm.describe(file_path, json_data), step, entry)
+
     # save the file
     scenes_file = file_path.replace(".json", "_scenes.json")
-    scenes_path = scenes_path = scenes_file.replace("\\Threads\\", "\\Scenes\\") if "\\Threads\\" in scenes_file else os.path.join(os.path.dirname(scenes_file), "Scenes", os.path.basename(scenes_file))
+    folder, filename = os.path.split(os.path.normpath(scenes_file))
+
+    # the scenes of threads go in the Scenes folder of their category, next to the Threads folder
+    if os.path.basename(folder) == "Threads":
+        folder = os.path.dirname(folder)
+
+    scenes_path = os.path.join(folder, "Scenes", filename)
 
     # TODO this is temporary to find the ones that need fixing. save evrything later
     if len(scenes_debug) > 0:
         t.save_to_json(scenes, scenes_path)
         t.save_to_json(scenes_debug, scenes_path.replace("_scenes.json", "_debug_scenes.json"))
 
-    t.log("log", f"\tSaved {len(scenes)} scenes to {scenes_file}")
+    t.log("log", "\tSaved %d scenes to %s", len(scenes), scenes_file)
 
     return scenes, scenes_debug
 
 
 """
-find_scenes_in_category(folder_path):
+load_previous_scenes(folder_path)
+
+    Loads the scenes and debug scenes saved for a category in the last run, grouped by channel ID.
+
+"""
+def load_previous_scenes(folder_path):
+
+    previous_scenes = {}
+
+    for position, filename in enumerate(["scenes.json", "debug_scenes.json"]):
+        try:
+            for scene in t.load_from_json(os.path.join(folder_path, filename)):
+                previous_scenes.setdefault(scene["channelId"], ([], []))[position].append(scene)
+
+        except FileNotFoundError:
+            pass
+
+    return previous_scenes
+
+
+"""
+find_scenes_in_category(category, manifest, file_manifest):
 
     Function to find all scenes in a category.
 
@@ -230,25 +327,37 @@ find_scenes_in_category(folder_path):
     Once all the scenes in a category are gathered, they are reordered and saved to a JSON file.
 
     Args:
-        folder_path (str): The path to the category folder.
+        category (dict): The category, from the list of channels.
+        manifest (dict): The channel manifest, where the number of scenes of each channel is written down.
+        file_manifest (sqlite3.Connection): The backup manifest, to skip the files that didn't change.
 
     Returns:
-        list: A list of scenes.
+        tuple[list, list]: A list of scenes, and the spans of its channels.
 """
 
-def find_scenes_in_category(category):
+def find_scenes_in_category(category, manifest, file_manifest):
 
     start_time = time.time()
 
+    folder_path = os.path.join(c.SEARCH_FOLDER, category["path"])
+    previous_scenes = load_previous_scenes(folder_path)
+
     # Create an empty list to store scene starts and ends
     all_scenes = []
     all_scenes_debug = []
 
+    spans = []
+
     t.log("info", f"\n    ## Finding scenes in {category['category']}... ##")
 
     for channel in category["channels"]:
 
-        scenes, scenes_debug = prep_channel(channel, category)
+        with tracing.span(channel["path"], "channel") as span:
+            scenes, scenes_debug = prep_channel(channel, category, manifest, file_manifest, previous_scenes)
+
+        # the records of each file are saved right away, so the workers of other categories can write theirs
+        file_manifest.commit()
+        spans.append(span)
 
         # Add the messages to the respective lists, can be more than one per channel
         all_scenes.extend(scenes)
@@ -258,7 +367,11 @@ def find_scenes_in_category(category):
 
     for thread in category["threads"]:
 
-        scenes, scenes_debug = prep_channel(thread, category)
+        with tracing.span(thread["path"], "channel") as span:
+            scenes, scenes_debug = prep_channel(thread, category, manifest, file_manifest, previous_scenes)
+
+        file_manifest.commit()
+        spans.append(span)
 
         # Add the messages to the respective lists, can be more than one per channel
         all_scenes.extend(scenes)
@@ -273,18 +386,39 @@ def find_scenes_in_category(category):
     for i, scene in enumerate(all_scenes):
         scene["index"] = i+1
 
-    folder_path = os.path.join(c.SEARCH_FOLDER, category["path"])
-
     t.save_to_json(all_scenes, f"{folder_path}/scenes.json")
     t.save_to_json(all_scenes_debug, f"{folder_path}/debug_scenes.json")
 
     t.log("debug", f"\n    Saved {len(all_scenes)} scenes to {folder_path}/scenes.json")
     t.log("info", f"\n    ## Finished finding scenes in {folder_path} --- {time.time() - start_time:.2f} seconds --- ##\n")
 
-    return all_scenes
+    return all_scenes, spans
+
+"""
+index_category(category, entries)
+
+    Finds all the scenes in a category in a worker process, with its own connection to the backup manifest.
+
+    Args:
+        category (dict): The category, from the list of channels.
+        entries (dict): The entries of the channel manifest of the channels and threads of the category.
+
+    Returns:
+        tuple[list, dict, list, float]: The scenes of the category, the entries of its channels with their new statistics,
+                                        the spans of its channels, and how long it took.
+"""
+def index_category(category, entries):
+
+    start_time = time.perf_counter()
+
+    with bm.open_manifest() as file_manifest:
+        scenes, spans = find_scenes_in_category(category, entries, file_manifest)
+
+    return scenes, entries, spans, time.perf_counter() - start_time
 
 ################ Main function #################
 
+@tracing.traced("step")
 def find_all_scenes():
 
     try:
@@ -297,21 +431,45 @@ def find_all_scenes():
         full_scenes = []
 
         backup_info = t.load_from_json(c.BACKUP_INFO)
+        manifest = cm.load_manifest()
 
-        for category in backup_info["categories"]:
+        # TODO temporarily skip some categories to speed things up
+        categories = [category for category in backup_info["categories"] if category["position"] == 11]
 
-            # TODO temporarily skip some categories to speed things up
-            if category["position"] != 11:
-                continue
+        for category in categories:
 
             # create Scenes folder if it doesn't exist
             if not os.path.exists(f"{c.SEARCH_FOLDER}/{category["path"]}/Scenes"):
                 os.makedirs(f"{c.SEARCH_FOLDER}/{category["path"]}/Scenes")
 
-            scenes = find_scenes_in_category(category)
+        with bm.open_manifest() as file_manifest, ProcessPoolExecutor(max_workers=c.WORKERS) as pool:
+
+            futures = {}
+
+            for category in categories:
+                channel_ids = [channel["id"] for channel in category["channels"] + category["threads"]]
+                futures[pool.submit(index_category, category, {channel_id: manifest[channel_id] for channel_id in channel_ids if channel_id in manifest})] = category
+
+            for future in as_completed(futures):
+
+                category = futures[future]
+                scenes, entries, spans, duration = future.result()
+
+                manifest.update(entries)
+
+                for span in spans:
+                    tracing.record(span["name"], "channel", span["duration"], **{counter: span[counter] for counter in tracing.COUNTERS})
+
+                tracing.record(category["category"], "category", duration)
+
+                # the statistics of this category are added up while the other categories are still being searched
+                fold_category(category, manifest, file_manifest)
+                file_manifest.commit()
+
+                full_scenes.extend(scenes)
+                t.log("info", f"  Found {len(scenes)} scenes in {category["path"]}, adding up to {len(full_scenes)} total scenes\n")
 
-            full_scenes.extend(scenes)
-            t.log("info", f"  Found {len(scenes)} scenes in {category["path"]}, adding up to {len(full_scenes)} total scenes\n")
+        add_up_categories(backup_info)
 
         # sort the scenes by start time
         full_scenes.sort(key=lambda x: x["start"]["timestamp"])
@@ -320,14 +478,17 @@ def find_all_scenes():
         for i, scene in enumerate(full_scenes):
             scene["index"] = i+1
 
-        t.save_to_json(full_scenes, f"{c.SEARCH_FOLDER}\\scenes.json")
+        t.save_to_json(full_scenes, os.path.join(c.SEARCH_FOLDER, "scenes.json"))
+        cm.save_manifest(manifest)
+        t.save_to_json(backup_info, c.BACKUP_INFO)
 
-        t.log("info", f"\n  Saved {len(full_scenes)} scenes to {c.SEARCH_FOLDER}\\scenes.json")
+        t.log("info", f"\n  Saved {len(full_scenes)} scenes to {os.path.join(c.SEARCH_FOLDER, 'scenes.json')}")
 
     except Exception as e:
         raise exc.FindScenesError("Failed to find all scenes") from e
 
     finally:
+        bs.release()
         t.log("base", f"\n# Scene indexing finished --- {time.time() - start_time:.2f} seconds --- #\n")
 
 
@@ -1,3 +1,4 @@
+import os
 import re
 import time
 import unicodedata
@@ -126,6 +127,7 @@ find_real_start(messages, found_scene, batch=False):
 def find_real_start(channel, found_scene, batch=False):
 
     log_level = "log" if batch else "debug"
+    verbose = t.log_enabled(log_level)
 
     messages = channel["messages"]
     t.log(log_level, "\t    Looking for the real start of the scene...")
@@ -163,7 +165,8 @@ def find_real_start(channel, found_scene, batch=False):
         
         # if the previous message has an character found in 'characters', index-1 and repeat
         if int(messages[index-1]["author"]["id"]) in characters or messages[index-1]["type"] != "Default":
-            t.log(log_level, "\t\tFound a known character in the previous message. Looking for the real start...")
+            if verbose:
+                t.log(log_level, "\t\tFound a known character in the previous message. Looking for the real start...")
             index = index-1
  
     # this should not trigger, but just in case
@@ -189,6 +192,7 @@ find_real_end(messages, found_scene, batch=False):
 def find_real_end(channel, found_scene, batch=False):
 
     log_level = "log" if batch else "debug"
+    verbose = t.log_enabled(log_level)
 
     messages = channel["messages"]
     t.log(log_level, "\t    Looking for the real end of the scene...")
@@ -210,7 +214,8 @@ def find_real_end(channel, found_scene, batch=False):
             found_scene["end"] = message_info(messages[index], channel, index)
             return index
 
-        t.log(log_level, "\t\tDid not find any participating characters. Looking for the real end...")
+        if verbose:
+            t.log(log_level, "\t\tDid not find any participating characters. Looking for the real end...")
         index = index-1
  
     # this should not trigger, but just in case
@@ -293,6 +298,9 @@ def find_character_scenes_in_channel(channel, main_character_list, scene_id, bat
 
     log_level = "log" if batch else "info"
 
+    # the logs of each message are only built if they're going to be printed or saved
+    verbose = t.log_enabled(log_level)
+
     # create arrays, in case there is more than one scene in a channel
     scenes = []
 
@@ -316,7 +324,8 @@ def find_character_scenes_in_channel(channel, main_character_list, scene_id, bat
 
             # skip system messages
             if message["type"] != "Default":
-                t.log(log_level, f"Skipping system message")
+                if verbose:
+                    t.log(log_level, "Skipping system message")
                 continue
             
             character = int(message["author"]["id"])
@@ -426,7 +435,7 @@ def find_scenes():
     for category in backup["categories"]:
         for channel in category["channels"]:
 
-            file_path = f"{folder_path}\\{channel['path']}"
+            file_path = os.path.join(folder_path, channel["path"])
             t.log("log", f"\tAnalysing {channel['channel']}...")
 
             json_data = t.load_from_json(file_path)
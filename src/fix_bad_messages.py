@@ -1,8 +1,11 @@
-import os
 import time
 import re
 import tricks as t
 import exceptions as exc
+import tracing
+import backup_state as bs
+import message_index as mi
+import backup_manifest as bm
 from find_scenes import has_end_tag
 t.set_path()
 from res import constants as c
@@ -15,8 +18,14 @@ This module fixes messages in the backup that have bad formatting.
 
 Main function: fix_bad_messages()
 
-    This function traverses all JSON files in the specified folder and its subdirectories to
-    find messages with bad formatting and replace them with the corresponding fixed versions.
+    This function looks up the known bad messages in the message index, and replaces them with
+    the corresponding fixed versions, only opening the files that contain them.
+
+    Then it traverses all JSON files in the specified folder and its subdirectories to
+    remove unneeded messages and list the messages that need to be reviewed.
+
+    Files that didn't change since this step processed them, according to the backup manifest, are not opened again,
+    and the messages to review found in them last time are kept.
 
 """
 
@@ -33,30 +42,25 @@ def check_base_status():
     try: 
         t.log("debug", "\nChecking the status of the backup...")
 
-        backup_info = t.load_from_json(c.BACKUP_INFO)
+        bs.acquire("fix_bad_messages")
+        state = bs.load_state()
 
         t.log("debug", "  Loaded the status file\n")
 
-        t.log("debug", f"  The current status of the backup is '{backup_info["status"]}'\n")
+        t.log("debug", f"  The current status of the backup is '{state["status"]}'\n")
 
-        main_status = backup_info["status"] + ""
+        main_status = state["status"] + ""
 
-        if backup_info["status"] == "running":
-            raise exc.AlreadyRunningError("The export is still running in another process. Exiting...")
-        
-        if backup_info["status"] == "failed":
+        if state["status"] == "failed":
             raise exc.DataNotReadyError("The data may be corrupted. Ensure the backup downloaded successfully and try again.")
         
-        if backup_info["steps"]["idAssignStatus"] != "success":
+        if state["steps"]["idAssignStatus"] != "success":
             raise exc.DataNotReadyError("The backup is not fully updated. Ensure the ID assignment process ran and try again.")
 
-        if backup_info["steps"]["mergeStatus"] != "success":
+        if state["steps"]["mergeStatus"] != "success":
             raise exc.DataNotReadyError("The backup is not fully updated. Ensure the merge process ran and try again.")
 
-        backup_info["status"] = "running"
-        backup_info["steps"]["messageFixStatus"] = "running"
-
-        t.save_to_json(backup_info, c.BACKUP_INFO)
+        bs.update_state(status="running", steps={"messageFixStatus": "running"})
 
         return main_status
 
@@ -68,97 +72,247 @@ def check_base_status():
     
 
 """
-fix_messages_in_channel(file_path, fixed_messages)
+    This regex pattern matches messages that only contain a mention,
+    including mentions of roles that no longer exist.
+
+"""
+mention_pattern = re.compile(r"^(?:@[\w ]+|@deleted-role|@unknown-role)$")
+
+
+"""
+message_link(channel, message)
 
-    This function traverses through all the messages in a channel and,
-    if it finds a message that has a fixed version in the fixed_messages dictionary,
-    it will replace it with the corresponding message from the dictionary.
+    Builds the Discord link to a message.
+
+"""
+def message_link(channel, message):
+    return f"https://discord.com/channels/{channel['guild']['id']}/{channel['channel']['id']}/{message['id']}"
+
+
+"""
+apply_fixed_messages(fixed_messages, index)
 
-    It also deletes messages from non-bot users if they only have a mention.
+    Replaces the known bad messages with their fixed versions.
+
+    It uses the message index to find the files that contain them, so only those files are opened,
+    and they are only saved if a message actually changed.
+
+    Messages that are not in the index, or not where the index says, are returned,
+    so they can be patched while the files are traversed (see patch_message).
 
     Args:
-        file_path (str): The path to the channel JSON file.
+        fixed_messages (dict): The fixed versions of the known bad messages, by message ID.
+        index (dict): The message index.
 
     Returns:
-        channel (dict): The modified channel dictionary.
+        tuple[int, set, dict]: The number of messages that were patched, the files that were saved,
+                               and the fixed messages that couldn't be located, by message ID.
 """
-def fix_messages_in_channel(file_path):
+def apply_fixed_messages(fixed_messages, index):
 
-    channel = t.load_from_json(file_path)
-    fixed_messages = t.load_from_json(c.FIXED_MESSAGES)
+    # group the fixes by the file that contains them
+    fixes_by_file = {}
+    pending = {}
 
-    messages_to_remove = []
+    for message_id in fixed_messages:
+        location = mi.locate(index, message_id)
 
-    for message in channel["messages"]:
+        if location is None:
+            t.log("debug", "\t%sBad message %s is not in the message index. Looking for it later...", t.YELLOW, message_id)
+            pending[message_id] = fixed_messages[message_id]
+            continue
 
-        # if ID in fixed_messages, replace it
-        if message["id"] in fixed_messages:
-            
-            t.log("debug", f"\tFound bad message {message['id']} from {message['author']['name']}.")
-            t.log("debug", f"\t    Replacing it with fixed message from {fixed_messages[message['id']]['author']['name']}.")
+        file_path, position = location
+        fixes_by_file.setdefault(file_path, []).append((message_id, position))
 
-            message["content"] = fixed_messages[message["id"]]["content"]
-            message["author"] = fixed_messages[message["id"]]["author"]
-        
+    patched = 0
+    patched_files = set()
 
-        # regex that match mentions
-        pattern = r"^@[\w ]+$"
-        pattern2 = r"^@deleted-role$"
-        pattern3 = r"^@unknown-role$"
-        
-        # if the message has a only a mention, remove it
-        if re.search(pattern, message["content"]) or re.search(pattern2, message["content"]) or re.search(pattern3, message["content"]):
+    for file_path, fixes in fixes_by_file.items():
+
+        channel = t.load_from_json(file_path)
+        changed = False
+
+        for message_id, position in fixes:
+
+            message = channel["messages"][position] if position < len(channel["messages"]) else None
+
+            if message is None or message["id"] != message_id:
+                t.log("debug", "\t%sThe message index is out of date for %s. Looking for it later...", t.YELLOW, message_id)
+                pending[message_id] = fixed_messages[message_id]
+                continue
+
+            if patch_message(message, fixed_messages[message_id]):
+                changed = True
+                patched += 1
+
+        if changed:
+            t.log("debug", f"\tSaving channel to {file_path}")
+            t.save_to_json(channel, file_path)
+            patched_files.add(file_path)
+
+    return patched, patched_files, pending
+
+"""
+patch_message(message, fixed_message)
+
+    Replaces the content and the author of a bad message with the ones of its fixed version.
+
+    Returns:
+        bool: True if the message changed.
+"""
+def patch_message(message, fixed_message):
+
+    if message["content"] == fixed_message["content"] and message["author"] == fixed_message["author"]:
+        return False
+
+    if t.log_enabled("debug"):
+        t.log("debug", f"\tFound bad message {message['id']} from {message['author']['name']}.")
+        t.log("debug", f"\t    Replacing it with fixed message from {fixed_message['author']['name']}.")
+
+    message["content"] = fixed_message["content"]
+    message["author"] = fixed_message["author"]
+
+    return True
+
+"""
+may_contain(entry, message_ids)
+
+    Checks if a file may contain any of the given messages, by the IDs of its first and last messages.
+    Discord IDs grow with time, so a message can only be in a file if its ID is between them.
+
+    Args:
+        entry (dict): The record of the file in the backup manifest.
+        message_ids (iterable): The IDs of the messages.
+
+    Returns:
+        bool: True if any of the messages may be in the file.
+"""
+def may_contain(entry, message_ids):
+
+    if entry["first_message_id"] is None:
+        return False
+
+    first, last = int(entry["first_message_id"]), int(entry["last_message_id"])
+
+    return any(first <= int(message_id) <= last for message_id in message_ids)
+
+"""
+    This regex pattern extracts the channel ID from the link of a message to review.
 
-            t.log("debug", f"\tFound message with only a mention '{message['content']}' from {message['author']['name']}.")
+"""
+link_channel_pattern = re.compile(r"/channels/\d+/(\d+)/\d+$")
+
+"""
+keep_previous_reviews(file_path, channel_ids)
+
+    Loads the messages to review found in the last run, and keeps the ones of the given channels.
+
+"""
+def keep_previous_reviews(file_path, channel_ids):
+
+    try:
+        previous = t.load_from_json(file_path)
+
+    except FileNotFoundError:
+        return {}
+
+    kept = {}
+
+    for message_id, bad_message in previous.items():
+        match = link_channel_pattern.search(bad_message["link"])
 
-            # remove message from messages
-            messages_to_remove.append(message)
+        if match and match.group(1) in channel_ids:
+            kept[message_id] = bad_message
+
+    return kept
+
+"""
+fix_messages_in_channel(file_path, index, bad_messages, bad_end_messages, pending_fixes)
 
+    This function traverses through all the messages in a channel and
+    deletes messages from non-bot users if they only have a mention, and thread creation messages.
+    The list of messages is rebuilt in a single pass, keeping only the messages that are not deleted.
+
+    The known bad messages that the message index couldn't locate are patched here if they're found,
+    and removed from pending_fixes. The file is only saved if some message was deleted or patched.
+
+    Messages from non-tupper users are gathered in the bad_messages and bad_end_messages dictionaries,
+    so they can be saved all at once when every channel has been analysed.
+
+    Args:
+        file_path (str): The path to the channel JSON file.
+        index (dict): The message index, which is updated with the positions of the remaining messages.
+        bad_messages (dict): The messages from non-tupper users found so far.
+        bad_end_messages (dict): The messages from non-tupper users with an end tag found so far.
+        pending_fixes (dict): The fixed messages that are still to be applied, by message ID.
+
+    Returns:
+        channel (dict): The modified channel dictionary.
+"""
+def fix_messages_in_channel(file_path, index, bad_messages, bad_end_messages, pending_fixes):
+
+    channel = t.load_from_json(file_path)
+    verbose = t.log_enabled("debug")
+
+    kept_messages = []
+    patched = 0
+
+    for message in channel["messages"]:
+
+        if message["id"] in pending_fixes:
+            patched += patch_message(message, pending_fixes.pop(message["id"]))
 
         # if message is from a non-tupper user
         if message["type"] == "Default" and int(message["author"]["id"]) >= 10000:
 
-            t.log("debug", f"\tFound message from non-tupper user '{message['author']['name']}'.")
+            if verbose:
+                t.log("debug", f"\tFound message from non-tupper user '{message['author']['name']}'.")
 
-            if has_end_tag(message):
-                bad_end_list = t.load_from_json(c.BAD_END_MESSAGES)
-                bad_end_list[message["id"]] = {
-                    "content": message["content"],
-                    "author": message["author"],
-                    "link": f"https://discord.com/channels/{channel['guild']['id']}/{channel['channel']['id']}/{message['id']}"
-                }
-                t.save_to_json(bad_end_list, c.BAD_END_MESSAGES)
-                t.log("debug", f"\t    Saved message with an end tag to {c.BAD_END_MESSAGES}")
+            bad_message = {
+                "content": message["content"],
+                "author": message["author"],
+                "link": message_link(channel, message)
+            }
 
+            if has_end_tag(message):
+                bad_end_messages[message["id"]] = bad_message
             else:
-                # append to c.BAD_MESSAGES
-                bad_message_list = t.load_from_json(c.BAD_MESSAGES)
-                bad_message_list[message["id"]] = {
-                    "content": message["content"],
-                    "author": message["author"],
-                    "link": f"https://discord.com/channels/{channel['guild']['id']}/{channel['channel']['id']}/{message['id']}"
-                }
-                t.save_to_json(bad_message_list, c.BAD_MESSAGES)
-                t.log("debug", f"\t    Saved message to {c.BAD_MESSAGES}")
-        
+                bad_messages[message["id"]] = bad_message
+
+        # if the message has a only a mention, remove it
+        if mention_pattern.search(message["content"]):
+
+            if verbose:
+                t.log("debug", f"\tFound message with only a mention '{message['content']}' from {message['author']['name']}.")
+            continue
+
         # if message is a thread creation, delete it
         if message["type"] == "ThreadCreated":
-            t.log("debug", f"\tFound thread creation message {message['id']} from {message['author']['name']}.")
-            messages_to_remove.append(message)
+            if verbose:
+                t.log("debug", f"\tFound thread creation message {message['id']} from {message['author']['name']}.")
+            continue
+
+        kept_messages.append(message)
+
+    removed = len(channel["messages"]) - len(kept_messages)
+
+    if removed > 0 or patched > 0:
+        t.log("debug", f"\t      Removed {removed} messages and patched {patched}.")
+        channel["messages"] = kept_messages
+
+        # save channel
+        t.log("debug", f"\tSaving channel to {file_path}")
 
-    if len(messages_to_remove) > 0:
-        t.log("debug", f"\t      Found {len(messages_to_remove)} messages to remove.")
-        # remove messages from channel
-        for message in messages_to_remove:
-            channel["messages"].remove(message)
+        t.save_to_json(channel, file_path)
 
-    # save channel
-    t.log("debug", f"\tSaving channel to {file_path}")
+    mi.index_file(index, file_path, channel["messages"])
 
-    t.save_to_json(channel, file_path)
+    return channel
 
 ################# Main function #################
 
+@tracing.traced("step")
 def fix_bad_messages():
 
     try:
@@ -177,21 +331,60 @@ def fix_bad_messages():
 
         t.log("info", f"    Found {len(fixed_messages)} messages to patch\n")
 
-        # clean the bad messages files
-        t.save_to_json({}, c.BAD_MESSAGES)
-        t.save_to_json({}, c.BAD_END_MESSAGES)
+        index = mi.load_index()
+
+        with bm.open_manifest() as manifest:
+
+            # the records are read before patching, so the patched files keep the steps that processed them
+            entries = {file_path: bm.lookup(manifest, file_path) for file_path in bm.list_channel_files(c.SEARCH_FOLDER)}
+
+            patched, patched_files, pending_fixes = apply_fixed_messages(fixed_messages, index)
+
+            t.log("info", f"    Patched {patched} messages\n")
+
+            if pending_fixes:
+                t.log("info", f"    {len(pending_fixes)} messages to patch could not be located with the message index. Looking for them in the files...\n")
+
+            # files that may hold a message the index couldn't locate are traversed again
+            skipped = {
+                file_path: entry for file_path, entry in entries.items()
+                if entry is not None and "fix_bad_messages" in entry["steps"] and file_path not in patched_files
+                and not may_contain(entry, pending_fixes)
+            }
+            skipped_channels = {entry["channel_id"] for entry in skipped.values()}
+
+            t.log("info", f"    Skipping {len(skipped)} files that didn't change\n")
+
+            bad_messages = keep_previous_reviews(c.BAD_MESSAGES, skipped_channels)
+            bad_end_messages = keep_previous_reviews(c.BAD_END_MESSAGES, skipped_channels)
+
+            # Iterate over all channel JSON files in the folder and its subfolders
+            for file_path, entry in entries.items():
+
+                if file_path in skipped:
+                    continue
+
+                t.log("log", f"\t    Analysing {file_path}...")
+
+                # find and fix bad messages
+                with tracing.span(file_path, "channel"):
+                    channel = fix_messages_in_channel(file_path, index, bad_messages, bad_end_messages, pending_fixes)
+                    tracing.add(messages=len(channel["messages"]))
+
+                bm.record(manifest, bm.describe(file_path, channel), "fix_bad_messages", entry)
 
-        # Iterate over all channel JSON files in the folder and its subfolders
-        for root, dirs, files in os.walk(c.SEARCH_FOLDER):
-            for filename in files:
-                if filename.endswith(".json") and not filename.endswith("scenes.json"):
+        if pending_fixes:
+            t.log("info", f"    {t.YELLOW}{len(pending_fixes)} messages to patch were not found in the backup: {', '.join(pending_fixes)}\n")
 
-                    file_path = os.path.join(root, filename)
+        # the positions of the messages change when some are removed
+        mi.save_index(index)
 
-                    t.log("log", f"\t    Analysing {file_path}...")
+        # save the messages that need to be reviewed
+        t.save_to_json(bad_messages, c.BAD_MESSAGES)
+        t.save_to_json(bad_end_messages, c.BAD_END_MESSAGES)
 
-                    # find and fix bad messages
-                    fix_messages_in_channel(file_path)
+        t.log("info", f"    Saved {len(bad_messages)} messages to {c.BAD_MESSAGES}")
+        t.log("info", f"    Saved {len(bad_end_messages)} messages with an end tag to {c.BAD_END_MESSAGES}\n")
 
         step_status = "success"
         main_status = "success"
@@ -204,10 +397,7 @@ def fix_bad_messages():
     finally:
         try:
             t.log("base", f"### Finished fixing messages --- {time.time() - start_time:.2f} seconds --- ###\n")
-            backup_info = t.load_from_json(c.BACKUP_INFO)
-            backup_info["status"] = main_status
-            backup_info["steps"]["messageFixStatus"] = step_status
-            t.save_to_json(backup_info, c.BACKUP_INFO)
+            bs.finish({"messageFixStatus": step_status}, main_status)
 
         except Exception as e:
             t.log("error", f"\tFailed to save the status file: {e}\n")
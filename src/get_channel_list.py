@@ -2,6 +2,9 @@ import time
 from datetime import datetime
 import tricks as t
 import exceptions as exc
+import tracing
+import backup_state as bs
+import channel_manifest as cm
 t.set_path()
 from res import constants as c
 from res import tokens
@@ -20,7 +23,11 @@ Main function: get_channel_list()
     Then it reads the list of categories to ignore from the config file,
     and removes the entries from the JSON data that have matching categories.
 
-    Finally, the function saves the data to a JSON file.
+    It compares the new list with the previous one, and reports which channels are new, renamed, moved or removed.
+    The changes are written down in the channel manifest, where the download finds the new channels.
+
+    Finally, the function saves the data to a JSON file, only if the list changed. The previous list also has
+    the positions and statistics added by the next steps, so keeping it lets them skip the work they already did.
 
     The function does not return any value, but it saves the data to the specified JSON file.
 
@@ -31,8 +38,8 @@ Main function: get_channel_list()
 """
 load_last_update()
 
-    Loads the previous list of channels from a JSON file.
-    If there is no previous list of channels, returns None.
+    Takes the lock of the backup, and loads the dates of the previous update from the state of the backup.
+    If there is no previous update, the dates are None.
 
     Args:
         None
@@ -46,46 +53,34 @@ def load_last_update():
     try:
         t.log("debug", "\t\nChecking the status of the backup...")
 
-        # Load the JSON file
-        last_channel_list = t.load_from_json(c.BACKUP_INFO)
+        bs.acquire("get_channel_list")
+        state = bs.load_state()
 
         t.log("debug", "\t  Loaded the status file\n")
 
-        if last_channel_list["status"] == "running":
-            raise exc.AlreadyRunningError("The export is still running in another process. Exiting...")
-        
-        t.log("debug", f"\t  The current status of the backup is '{last_channel_list['status']}'\n")
+        t.log("debug", f"\t  The current status of the backup is '{state['status']}'\n")
 
-        try:
-            last_update = last_channel_list["dates"]["updatedAt"]
-            last_export = last_channel_list["dates"]["exportedAt"]
-        except Exception as e:
-            last_update = None
-            last_export = None
+        last_update = state["dates"]["updatedAt"]
+        last_export = state["dates"]["exportedAt"]
 
         t.log("debug", f"\t  The last update was downloaded at {last_update}")
 
         # If the update failed, use the previous update
-        if last_channel_list["steps"]["updateStatus"] == "failed" or last_channel_list["steps"]["updateCleanStatus"] == "failed":
+        if state["steps"]["updateStatus"] == "failed" or state["steps"]["updateCleanStatus"] == "failed":
             t.log("debug", "\t  The previous update failed. Will use the last good update\n")
-            last_update = last_channel_list["dates"]["lastGoodUpdate"]
+            last_update = state["dates"]["lastGoodUpdate"]
 
-        # flag it as running in case another execution of the script is launched
-        last_channel_list["status"] = "running"
-        last_channel_list["steps"]["updateStatus"] = "running"
-        t.save_to_json(last_channel_list, c.BACKUP_INFO)
+        # flag it as running in case the process is interrupted
+        bs.update_state(status="running", steps={"updateStatus": "running"})
 
         return last_update, last_export
 
     except exc.AlreadyRunningError as e:
         raise e
     
-    except OSError as e:
-        t.log("debug", f"\tNo status file could be loaded: {e}\n")
-        return None, None
-    
     except Exception as e:
         t.log("debug", f"\tThe status file could not be read: {e}\n")
+        bs.release()
         raise e
 
 """
@@ -93,6 +88,9 @@ parse_output(output)
 
     Parses the output of the DiscordChatExporter CLI tool and returns a list of channel data.
 
+    The categories and the number of threads of each channel are kept in dictionaries while parsing,
+    so each line is added in constant time.
+
     Args:
         output (str): The output of the DiscordChatExporter CLI tool.
 
@@ -116,28 +114,27 @@ def parse_output(output):
         "categories": []
     }
 
-    category_list = []
+    # category name -> category data, and (category, channel) -> number of threads
+    categories = {}
+    thread_counts = {}
     
     try:
-        lines = output.strip().split("\n")
-
         # Saving the 'parent channel' in case we encounter threads  
         parent_channel = None
-        for line in lines:
 
-            t.log("debug", f"\t\t Analyzing line: {line}")
+        for line in output.strip().split("\n"):
 
             parts = line.split(" | ")
             
             # If it's a channel
             if len(parts) == 2:
 
-                t.log("debug", "\t\t\t It's a channel")
+                category_name, channel_name = parts[1].split(" / ")[:2]
 
                 entry = {
                     "id": parts[0].strip(),
-                    "category": parts[1].split(" / ")[0].strip(),
-                    "channel": parts[1].split(" / ")[1].strip(),
+                    "category": category_name.strip(),
+                    "channel": channel_name.strip(),
                     "isThread": False,
                     "thread": "",
                 }
@@ -145,9 +142,7 @@ def parse_output(output):
                 parent_channel = entry
             
             # If it's a thread
-            if len(parts) == 3:
-
-                t.log("debug", "\t\t\t It's a thread")
+            elif len(parts) == 3:
 
                 entry = {
                     "id": parts[0].replace('*', '').strip(),
@@ -157,53 +152,59 @@ def parse_output(output):
                     "thread": parts[1].split(" / ")[1].strip(),
                 }
 
-            # If we encountered a new category
-            if entry["category"] not in category_list:
+            else:
+                t.log("debug", "\t\t Skipping line: %s", line)
+                continue
 
-                t.log("debug", f"\t\t\t It's a new category: {entry['category']}")
+            t.log("debug", "\t\t Found %s: %s", "thread" if entry["isThread"] else "channel", line)
 
-                # Save it in the list
-                category_list.append(entry["category"])
+            category_data = categories.get(entry["category"])
+
+            # If we encountered a new category
+            if category_data is None:
+
+                t.log("debug", "\t\t\t It's a new category: %s", entry["category"])
 
                 # Create a new category
                 category_data = {
                     "category": entry["category"],
-                    "position": len(category_list) + 1,
+                    "position": len(categories) + 2,
                     "numberOfChannels": 0,
                     "numberOfThreads": 0,
                     "numberOfScenes": 0,
-                    "path": f"{len(category_list) + 1}# {entry['category'].replace(':', '_')}",
+                    "path": f"{len(categories) + 2}# {entry['category'].replace(':', '_')}",
                     "channels": [],
                     "threads": []
                 }
 
                 # Add it to the data
+                categories[entry["category"]] = category_data
                 backup_data["categories"].append(category_data)
 
             channel_data = {
                 "id": entry["id"],
                 "channel": entry["channel"],
-                "position": len(backup_data["categories"][category_list.index(entry["category"])]["channels"]) + 1,
+                "position": len(category_data["channels"]) + 1,
             }
 
             # Add the channel to the category
             if entry["isThread"]:
                 channel_data["thread"] = entry["thread"]
 
-                # calculate "threadPosition" based on how many threads in the category have the same channel
-                thread_position = 1
-                for thread in backup_data["categories"][category_list.index(entry["category"])]["threads"]:
-                    if thread["channel"] == entry["channel"]:
-                        thread_position += 1
-                channel_data["threadPosition"] = thread_position
+                # "threadPosition" is how many threads in the category have the same channel, this one included
+                key = (entry["category"], entry["channel"])
+                thread_counts[key] = thread_counts.get(key, 0) + 1
+
+                channel_data["threadPosition"] = thread_counts[key]
                 channel_data["numberOfMessages"] = 0
                 
-                backup_data["categories"][category_list.index(entry["category"])]["threads"].append(channel_data)
+                category_data["threads"].append(channel_data)
             
             else:
                 channel_data["numberOfScenes"] = 0
                 channel_data["numberOfMessages"] = 0
-                backup_data["categories"][category_list.index(entry["category"])]["channels"].append(channel_data)
+                category_data["channels"].append(channel_data)
+
             backup_data["numberOfChannels"] += 1
 
         t.log("info", f"\tFound {backup_data['numberOfChannels']} channels in {len(backup_data['categories'])} categories\n")
@@ -291,9 +292,145 @@ def clean_channel_list(backup_info):
         raise exc.CleanChannelListError("Failed to clean the list of channels") from e
 
 
+"""
+load_last_channel_list()
+
+    Loads the previous list of channels, to compare it with the new one.
+    If there is no previous list of channels, returns None.
+
+"""
+def load_last_channel_list():
+
+    try:
+        return t.load_from_json(c.BACKUP_INFO)
+
+    except OSError:
+        return None
+
+"""
+index_channels(backup_info)
+
+    Indexes the channels and threads of a list of channels by their ID.
+
+    Returns:
+        dict: The category name and the channel data of each channel and thread, by ID.
+"""
+def index_channels(backup_info):
+
+    channels = {}
+
+    for category in backup_info.get("categories", []):
+        for channel in category["channels"] + category["threads"]:
+            channels[channel["id"]] = (category["category"], channel)
+
+    return channels
+
+"""
+carry_over_counts(backup_info, last_channels)
+
+    Copies the number of messages and scenes of each channel and thread from the previous channel list.
+    The new list is built from scratch, and the download uses these numbers to export the biggest channels first.
+
+    Args:
+        backup_info (dict): The new list of channel data in JSON format.
+        last_channels (dict): The channels of the previous list, from index_channels.
+
+    Returns:
+        dict: The same list, with the counts of the channels that were already in the backup.
+"""
+def carry_over_counts(backup_info, last_channels):
+
+    for category in backup_info["categories"]:
+        for channel in category["channels"] + category["threads"]:
+
+            if channel["id"] not in last_channels:
+                continue
+
+            last_channel = last_channels[channel["id"]][1]
+
+            for key in ("numberOfMessages", "numberOfScenes"):
+                if key in channel and key in last_channel:
+                    channel[key] = last_channel[key]
+
+    t.log("debug", f"\t  Carried over the counts of {len(last_channels)} channels from the previous list\n")
+
+    return backup_info
+
+"""
+diff_channel_lists(backup_info, last_channels)
+
+    Compares the new list of channels with the previous one, and reports the channels that changed.
+
+    A channel or thread is:
+        - "new" if it wasn't in the previous list.
+        - "renamed" if its name changed.
+        - "moved" if it's in another category, or a thread of another channel.
+        - "removed" if it's not in the new list.
+
+    Args:
+        backup_info (dict): The new list of channel data in JSON format.
+        last_channels (dict): The channels of the previous list, from index_channels.
+
+    Returns:
+        dict: The IDs of the channels and threads that are "new", "renamed", "moved" and "removed".
+"""
+def diff_channel_lists(backup_info, last_channels):
+
+    changes = {"new": [], "renamed": [], "moved": [], "removed": []}
+    channels = index_channels(backup_info)
+
+    for channel_id, (category, channel) in channels.items():
+
+        if channel_id not in last_channels:
+            changes["new"].append(channel_id)
+            continue
+
+        last_category, last_channel = last_channels[channel_id]
+
+        if "thread" in channel:
+            renamed = channel["thread"] != last_channel.get("thread")
+            moved = category != last_category or channel["channel"] != last_channel["channel"]
+        else:
+            renamed = channel["channel"] != last_channel["channel"]
+            moved = category != last_category
+
+        if renamed:
+            changes["renamed"].append(channel_id)
+            t.log("debug", "\t\t Renamed: '%s' -> '%s'", last_channel.get("thread") or last_channel["channel"], channel.get("thread") or channel["channel"])
+
+        if moved:
+            changes["moved"].append(channel_id)
+            t.log("debug", "\t\t Moved: '%s' from '%s' to '%s'", channel.get("thread") or channel["channel"], last_category, category)
+
+    changes["removed"] = [channel_id for channel_id in last_channels if channel_id not in channels]
+
+    t.log("info", f"\t  Compared with the previous list: {len(changes['new'])} new, {len(changes['renamed'])} renamed, "
+                  f"{len(changes['moved'])} moved and {len(changes['removed'])} removed channels\n")
+
+    return changes
+
+
+"""
+channel_order(backup_info)
+
+    Gets the order of the categories, and of the channels and threads inside them, to know if any of them moved.
+    Threads are ordered by their ID, like the next steps do.
+
+"""
+def channel_order(backup_info):
+
+    return [
+        (category["category"],
+         [channel["id"] for channel in sorted(category["channels"], key=lambda x: x["position"])],
+         sorted(thread["id"] for thread in category["threads"]))
+        for category in backup_info.get("categories", [])
+    ]
+
+
 ################# Main function #################
 
 
+@tracing.traced("step")
 def get_channel_list():
 
     t.log("base", f"\n###  Getting a list of all channels from the server {c.SERVER_NAME}...  ###\n")
@@ -332,6 +469,25 @@ def get_channel_list():
 
         backup_info = clean_channel_list(backup_info)
 
+        last_channel_list = load_last_channel_list()
+        last_channels = index_channels(last_channel_list) if last_channel_list is not None else {}
+
+        backup_info = carry_over_counts(backup_info, last_channels)
+        changes = diff_channel_lists(backup_info, last_channels)
+
+        # the download reads the changes from the channel manifest, to give new channels their full history
+        manifest = cm.load_manifest()
+
+        if cm.record_changes(manifest, changes):
+            cm.save_manifest(manifest)
+
+        if last_channel_list is not None and not any(changes.values()) and channel_order(backup_info) == channel_order(last_channel_list):
+            t.log("info", f"\tThe list of channels didn't change. Keeping {c.BACKUP_INFO}\n")
+
+        else:
+            t.save_to_json(backup_info, c.BACKUP_INFO)
+            t.log("info", f"\t\nSaved the list of channels to {c.BACKUP_INFO}\n")
+
         update_status["updateCleanStatus"] = "success"
         main_status = "pending"
         update_history["lastGoodUpdate"] = datetime.now().astimezone().isoformat(sep='T', timespec='microseconds')
@@ -349,24 +505,15 @@ def get_channel_list():
         update_status["updateCleanStatus"] = "pending"
         main_status = "failed"
 
-        if last_update is not None:
-            backup_info = t.load_from_json(c.BACKUP_INFO)
-        else:
-            backup_info = {}         
-
         raise exc.ChannelListError from e
 
 
     finally:
         try:
-            backup_info["status"] = main_status
-            backup_info["steps"] = update_status
-            backup_info["dates"] = update_history
-            t.save_to_json(backup_info, c.BACKUP_INFO)
-            t.log("info", f"\t\nSaved the list of channels to {c.BACKUP_INFO}\n")
+            bs.finish(update_status, main_status, update_history)
             
         except Exception as e:
-            t.log("error", f"\tFailed to save the list of channels: {e}\n")
+            t.log("error", f"\tFailed to save the status of the backup: {e}\n")
 
         t.log("base", f"\n### Channel list finished --- {time.time() - start_time:.2f} seconds --- ###\n")
 
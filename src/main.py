@@ -1,17 +1,24 @@
 import os
 import tricks as t
+import exceptions as exc
+import backup_state as bs
 t.set_path()
 from res import constants as c
+from pipeline import run_pipeline
 
 def print_status():
     print(f"{t.YELLOW}\n## Current status ##\n{t.RESET}")
 
     backup_info = t.load_from_json(c.BACKUP_INFO)
+    state = bs.load_state()
 
     print(f"Number of categories: {backup_info['numberOfCategories']}")
     print(f"Number of channels: {backup_info['numberOfChannels']}")
+    print(f"Number of messages: {backup_info.get('numberOfMessages', 0)}")
+    print(f"Number of scenes: {backup_info.get('numberOfScenes', 0)}")
 
-    print(f"Last exported: {backup_info['dates']['exportedAt']}")
+    print(f"Status: {state['status']}")
+    print(f"Last exported: {state['dates']['exportedAt']}")
 
 def print_main_menu():
     
@@ -39,7 +46,11 @@ def main():
             print("Configuration")
 
         elif choice == "3":
-            print("Run the pipeline")
+            try:
+                run_pipeline()
+
+            except Exception as e:
+                t.log("error", f"\n{exc.unwrap(e)}\n")
 
         elif choice == "4":
             break
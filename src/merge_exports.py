@@ -4,6 +4,10 @@ import shutil
 import time
 import tricks as t
 import exceptions as exc
+import tracing
+import backup_state as bs
+import message_index as mi
+import channel_manifest as cm
 t.set_path()
 from res import constants as c
 
@@ -24,6 +28,8 @@ Main function: merge_exports()
     If not, it will create the necessary subfolders in "Old" to maintain the same directory tree
     and copy the file from "Update" to "Old".
 
+    The message index is updated with the new position of the messages of every merged file.
+
     Finally, it will debug a message indicating that all channels have been merged.
 
 """
@@ -41,27 +47,22 @@ def check_base_status():
     try: 
         t.log("debug", "\nChecking the status of the backup...")
 
-        backup_info = t.load_from_json(c.BACKUP_INFO)
+        bs.acquire("merge_exports")
+        state = bs.load_state()
 
         t.log("debug", "  Loaded the status file\n")
 
-        t.log("debug", f"  The current status of the backup is '{backup_info["status"]}'\n")
+        t.log("debug", f"  The current status of the backup is '{state["status"]}'\n")
 
-        main_status = backup_info["status"] + ""
+        main_status = state["status"] + ""
 
-        if backup_info["status"] == "running":
-            raise exc.AlreadyRunningError("The export is still running in another process. Exiting...")
-        
-        if backup_info["status"] == "failed":
+        if state["status"] == "failed":
             raise exc.DataNotReadyError("The data may be corrupted. Ensure the backup downloaded successfully and try again.")
         
-        if backup_info["steps"]["sortingWriteStatus"] != "success":
+        if state["steps"]["sortingWriteStatus"] != "success":
             raise exc.DataNotReadyError("Update files have not been sorted. Ensure the sorting process ran and try again.")
 
-        backup_info["status"] = "running"
-        backup_info["steps"]["mergeStatus"] = "running"
-
-        t.save_to_json(backup_info, c.BACKUP_INFO)
+        bs.update_state(status="running", steps={"mergeStatus": "running"})
 
         return main_status
 
@@ -97,31 +98,31 @@ def find_index(messages, id, base=0):
 
 
 """
-merge_channel(old, update)
+merge_channel(old, update_data)
 
-    This function merges the channel data from an update file into an existing old file.
+    This function merges the channel data of an update file into an existing old file.
 
-    It loads both files in JSON format, and iterates through the channel history update's messages.
+    It loads the old file in JSON format, and iterates through the channel history update's messages.
     If the message is found in the old channel history, it is updated (to account for edited content).
     If the message is not found, the rest of the update is appended to the old channel history.
+
+    If the update starts after the last message of the old file (it was exported from the channel's watermark),
+    there is no overlap, and the update is appended directly without searching.
     
     The merged data is then saved back to the `old` file, maintaining a complete and up-to-date channel history.
 
     Args:
         old (str): The file path to the existing channel history file.
-        update (str): The file path to the new channel update file.
+        update_data (dict): The content of the channel update file, already loaded to check if it has new messages.
 
     Returns:
-        None, but saves the merged data to the `old` file.
+        dict: The merged channel data. It's also saved to the `old` file.
 """
-def merge_channel(old, update):
+def merge_channel(old, update_data):
     
     # Load data from old file
     old_data = t.load_from_json(old)
 
-    # Load data from update file
-    update_data = t.load_from_json(update)
-
     # Extract messages from both JSONs
     full_messages = old_data["messages"]
     update_messages = update_data["messages"]
@@ -130,8 +131,11 @@ def merge_channel(old, update):
     full_index = 0
     update_index = 0
 
+    # Snowflake IDs grow with time, so an update that starts after our last message can't overlap
+    overlaps = full_messages and update_messages and int(update_messages[0]["id"]) <= int(full_messages[-1]["id"])
+
     # For each new message in the update
-    for i, new_message in enumerate(update_messages):
+    for i, new_message in enumerate(update_messages if overlaps else []):
         
         # keep track of the message being evaluated
         update_index = i
@@ -164,9 +168,12 @@ def merge_channel(old, update):
     # save merged data to json
     t.save_to_json(old_data, old)
 
+    return old_data
+
 
 ################# Main function ################
 
+@tracing.traced("step")
 def merge_exports():
     
     try:
@@ -180,17 +187,34 @@ def merge_exports():
 
         main_status = check_base_status()
 
+        index = mi.load_index()
+        manifest = cm.load_manifest()
+
         for foldername, subfolders, filenames in os.walk(update_folder):
             for filename in filenames:
                 update_file_path = os.path.join(foldername, filename)
                 old_file_path = os.path.join(old_folder, os.path.relpath(update_file_path, start=update_folder))
 
+                # the update is only loaded once, for this check and the merge
+                update_data = t.load_from_json(update_file_path)
+
+                # Skip channels with no new messages
+                if update_data["messageCount"] == 0:
+                    t.log("debug", "\tNo new messages in %s. Skipping...", update_file_path)
+                    continue
+
                 # Check if an equivalent file exists in the "Old" folder
                 
                 # If it does, merge the two files
                 if os.path.exists(old_file_path):
-                    t.log("debug", f"\tMerging {update_file_path} into {old_file_path}")
-                    merge_channel(old_file_path, update_file_path)
+                    t.log("debug", "\tMerging %s into %s", update_file_path, old_file_path)
+
+                    with tracing.span(old_file_path, "channel"):
+                        merged_data = merge_channel(old_file_path, update_data)
+                        tracing.add(messages=merged_data["messageCount"])
+
+                    mi.index_file(index, old_file_path, merged_data["messages"], old_folder)
+                    cm.update_channel(manifest, merged_data)
 
                 else:
                     # If not, create the necessary subfolders in "Old" to maintain the same directory tree
@@ -199,6 +223,13 @@ def merge_exports():
                     # Copy the file from "Update" to "Old"
                     shutil.copy2(update_file_path, old_file_path)
                     t.log("info", f"\tFound new file: Moving {update_file_path} to {old_file_path}")
+
+                    mi.index_file(index, old_file_path, update_data["messages"], old_folder)
+                    cm.update_channel(manifest, update_data)
+
+        # keep the message index and the watermarks up to date with the merged files
+        mi.save_index(index)
+        cm.save_manifest(manifest)
     
         step_status = "success"
 
@@ -210,10 +241,7 @@ def merge_exports():
     finally:
         try:
             t.log("base", f"### Merging finished --- {time.time() - start_time:.2f} seconds --- ###\n")
-            backup_info = t.load_from_json(c.BACKUP_INFO)
-            backup_info["status"] = main_status
-            backup_info["steps"]["mergeStatus"] = step_status
-            t.save_to_json(backup_info, c.BACKUP_INFO)
+            bs.finish({"mergeStatus": step_status}, main_status)
 
         except Exception as e:
             t.log("error", f"\tFailed to save the status file: {e}\n")
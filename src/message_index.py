@@ -0,0 +1,287 @@
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import tricks as t
+import exceptions as exc
+import tracing
+t.set_path()
+from res import constants as c
+
+################ File summary #################
+
+"""
+
+This module keeps a global index of where every message of the backup lives.
+
+Main function: build_index(search_folder)
+
+    This function traverses all JSON files in the server backup and writes down, for each message ID,
+    the channel file that contains it and its position in the list of messages.
+
+    Other steps keep the index up to date as they modify files (merge_exports, fix_bad_messages),
+    so any tool can find a message from its ID or its Discord link without searching the whole backup.
+
+    The index is saved to MESSAGE_INDEX with this format:
+        {
+            "files": ["2# Category/1# channel.json", ...],
+            "messages": { "message ID": [file number, position], ... }
+        }
+
+    It's saved compact, since it has one entry per message. While it's loaded, it also has the number of each file
+    by path ("numbers"), so the files are found without searching the list. It isn't saved.
+
+"""
+
+################ Functions #################
+
+"""
+    This regex pattern extracts the message ID from a Discord message link.
+
+"""
+link_pattern = re.compile(r"discord(?:app)?\.com/channels/\d+/\d+/(\d+)")
+
+
+"""
+new_index()
+
+    Creates an empty index.
+
+"""
+def new_index():
+    return {"files": [], "messages": {}, "numbers": {}}
+
+"""
+load_index(), save_index(index)
+
+    Functions to read and write the message index.
+    If there is no index yet, load_index() builds it from the backup.
+
+"""
+def load_index():
+    try:
+        index = t.load_from_json(c.MESSAGE_INDEX)
+        index["numbers"] = {path: number for number, path in enumerate(index["files"])}
+
+        return index
+
+    except FileNotFoundError:
+        t.log("info", f"\tNo message index was found. Building it...\n")
+        return build_index()
+
+
+def save_index(index):
+    t.save_to_json({"files": index["files"], "messages": index["messages"]}, c.MESSAGE_INDEX, compact=True)
+
+"""
+index_file(index, file_path, messages, base_folder)
+
+    Registers the position of every message of a channel file in the index.
+    It should be called every time the messages of a file are modified.
+
+    Messages that were removed from the file may keep a stale entry,
+    which is detected when trying to find them.
+
+    Args:
+        index (dict): The message index.
+        file_path (str): The path to the channel JSON file.
+        messages (list): The messages of the file, in order.
+        base_folder (str, optional): The folder of the backup.
+
+"""
+def index_file(index, file_path, messages, base_folder=c.SERVER_NAME):
+
+    relative_path = os.path.relpath(file_path, base_folder)
+
+    file_number = index["numbers"].get(relative_path)
+
+    if file_number is None:
+        file_number = len(index["files"])
+        index["files"].append(relative_path)
+        index["numbers"][relative_path] = file_number
+
+    for position, message in enumerate(messages):
+        index["messages"][message["id"]] = [file_number, position]
+
+"""
+rename_files(index, moves)
+
+    Updates the paths of the files that were renamed, so their messages can still be found.
+
+    Args:
+        index (dict): The message index.
+        moves (list): The renamed files, with the path relative to the backup they were moved "from" and "to".
+
+"""
+def rename_files(index, moves):
+
+    file_numbers = {os.path.normpath(path): number for number, path in enumerate(index["files"])}
+
+    for move in moves:
+        file_number = file_numbers.get(os.path.normpath(move["from"]))
+
+        if file_number is not None:
+            index["numbers"].pop(index["files"][file_number], None)
+            index["files"][file_number] = os.path.normpath(move["to"])
+            index["numbers"][index["files"][file_number]] = file_number
+
+"""
+read_message_ids(file_path)
+
+    Reads the ID of every message of a channel file, in order.
+    It's meant to run in a worker process.
+
+"""
+def read_message_ids(file_path):
+    return [message["id"] for message in t.load_from_json(file_path)["messages"]]
+
+"""
+message_id_from(link_or_id)
+
+    Gets a message ID from a Discord message link, or returns the same string if it's already an ID.
+
+"""
+def message_id_from(link_or_id):
+
+    match = link_pattern.search(link_or_id)
+
+    return match.group(1) if match else link_or_id.strip()
+
+"""
+locate(index, link_or_id, base_folder)
+
+    Finds where a message lives in the backup.
+
+    Args:
+        index (dict): The message index.
+        link_or_id (str): The ID of the message, or its Discord link.
+        base_folder (str, optional): The folder of the backup.
+
+    Returns:
+        tuple[str, int] or None: The path to the channel file and the position of the message in it,
+                                 or None if the message is not in the index.
+"""
+def locate(index, link_or_id, base_folder=c.SERVER_NAME):
+
+    entry = index["messages"].get(message_id_from(link_or_id))
+
+    if entry is None:
+        return None
+
+    file_number, position = entry
+    return os.path.join(base_folder, index["files"][file_number]), position
+
+"""
+resolve(index, link_or_id, base_folder, loaded_files)
+
+    Gets the content of a message from its ID or its Discord link.
+
+    Args:
+        index (dict): The message index.
+        link_or_id (str): The ID of the message, or its Discord link.
+        base_folder (str, optional): The folder of the backup.
+        loaded_files (dict, optional): A cache of channel files already loaded, by path.
+                                       Useful to resolve many messages from the same channels.
+
+    Returns:
+        dict or None: The message, or None if it's not in the backup or the index is out of date.
+"""
+def resolve(index, link_or_id, base_folder=c.SERVER_NAME, loaded_files=None):
+
+    location = locate(index, link_or_id, base_folder)
+
+    if location is None:
+        return None
+
+    file_path, position = location
+
+    if loaded_files is None:
+        loaded_files = {}
+
+    if file_path not in loaded_files:
+        try:
+            loaded_files[file_path] = t.load_from_json(file_path)
+        except FileNotFoundError:
+            t.log("debug", "\t%sThe message index is out of date: %s does not exist", t.YELLOW, file_path)
+            return None
+
+    messages = loaded_files[file_path]["messages"]
+    message_id = message_id_from(link_or_id)
+
+    if position >= len(messages) or messages[position]["id"] != message_id:
+        t.log("debug", "\t%sThe message index is out of date: %s is not at position %d of %s", t.YELLOW, message_id, position, file_path)
+        return None
+
+    return messages[position]
+
+
+################# Main function #################
+
+@tracing.traced("step")
+def build_index(search_folder=c.SERVER_NAME):
+
+    try:
+        t.log("base", f"\n###  Indexing all the messages in {search_folder}...  ###\n")
+
+        start_time = time.time()
+
+        file_paths = []
+
+        for root, dirs, files in os.walk(search_folder):
+            for filename in files:
+                if filename.endswith(".json") and not filename.endswith("scenes.json"):
+                    file_paths.append(os.path.join(root, filename))
+
+        file_paths.sort()
+
+        index = new_index()
+
+        # read the files in parallel, and index them in order
+        with ProcessPoolExecutor(max_workers=c.WORKERS) as pool:
+            for file_path, message_ids in zip(file_paths, pool.map(read_message_ids, file_paths, chunksize=8)):
+
+                relative_path = os.path.relpath(file_path, search_folder)
+                file_number = len(index["files"])
+                index["files"].append(relative_path)
+                index["numbers"][relative_path] = file_number
+
+                for position, message_id in enumerate(message_ids):
+                    index["messages"][message_id] = [file_number, position]
+
+                tracing.add(messages=len(message_ids), bytesRead=os.path.getsize(file_path))
+
+        save_index(index)
+
+        t.log("info", f"\tIndexed {len(index['messages'])} messages in {len(index['files'])} files\n")
+
+        return index
+
+    except Exception as e:
+        raise exc.MessageIndexError("Failed to index the messages of the backup") from e
+
+    finally:
+        t.log("base", f"### Message indexing finished --- {time.time() - start_time:.2f} seconds --- ###\n")
+
+
+if __name__ == "__main__":
+
+    try:
+        # with no arguments, rebuild the index. Otherwise, look up the given links or IDs
+        if len(sys.argv) == 1:
+            build_index()
+
+        else:
+            index = load_index()
+            loaded_files = {}
+
+            for link_or_id in sys.argv[1:]:
+                message = resolve(index, link_or_id, loaded_files=loaded_files)
+
+                if message is None:
+                    t.log("error", f"Message {link_or_id} was not found in the backup")
+                else:
+                    t.log("base", f"{message['author']['name']} ({message['timestamp']}):\n{message['content']}\n")
+
+    except Exception as e:
+        t.log("error", f"\n{exc.unwrap(e)}\n")
@@ -0,0 +1,399 @@
+import asyncio
+import os
+import re
+import time
+from datetime import datetime
+import discord
+import tricks as t
+import rate_limit as rl
+t.set_path()
+from res import constants as c
+from res import tokens
+
+################ File summary #################
+
+"""
+
+This module exports channels with discord.py, without calling DCE.
+
+Main function: export_channels(exports, concurrency, on_result)
+
+    Instead of starting a new DCE process for each channel, all the channels are exported from the same process,
+    on the same event loop, through a single HTTP session with Discord. discord.py takes care of the rate limits.
+
+    The history of each channel is read in pages of 100 messages, from the oldest to the newest,
+    and saved in the same JSON format DCE uses, so the rest of the steps work the same way.
+
+    A channel that fails doesn't stop the others: the error is returned as its result, and classified and retried
+    like a DCE export (see rate_limit.py). A page of messages that takes longer than the stall timeout counts as a stall.
+
+    It's used by download_channels when EXPORTER is "native". DISCORD_API can point it to another server,
+    like the fake one in fake_discord.py, to test it without Discord.
+
+"""
+
+################ Functions #################
+
+PAGE_SIZE = 100
+
+MESSAGE_TYPES = {
+    0: "Default", 1: "RecipientAdd", 2: "RecipientRemove", 3: "Call", 4: "ChannelNameChange", 5: "ChannelIconChange",
+    6: "ChannelPinnedMessage", 7: "GuildMemberJoin", 18: "ThreadCreated", 19: "Reply", 20: "Default"
+}
+
+CHANNEL_TYPES = {
+    0: "GuildTextChat", 1: "DirectTextChat", 2: "GuildVoiceChat", 3: "DirectGroupTextChat", 4: "GuildCategory",
+    5: "GuildNewsChat", 10: "GuildNewsThread", 11: "GuildPublicThread", 12: "GuildPrivateThread", 13: "GuildStageVoice", 15: "GuildForum"
+}
+
+"""
+format_timestamp(timestamp)
+
+    Converts a Discord timestamp to the format DCE uses: local time, with milliseconds.
+
+"""
+def format_timestamp(timestamp):
+
+    if timestamp is None:
+        return None
+
+    return datetime.fromisoformat(timestamp).astimezone().isoformat(timespec="milliseconds")
+
+"""
+convert_user(user, member)
+
+    Converts a Discord user to the format DCE uses for authors and mentions.
+
+"""
+def convert_user(user, member=None):
+
+    if user.get("avatar"):
+        avatar_url = f"https://cdn.discordapp.com/avatars/{user['id']}/{user['avatar']}.png?size=512"
+    else:
+        avatar_url = f"https://cdn.discordapp.com/embed/avatars/{(int(user['id']) >> 22) % 6}.png"
+
+    return {
+        "id": user["id"],
+        "name": user["username"],
+        "discriminator": user.get("discriminator", "0000"),
+        "nickname": (member or user.get("member") or {}).get("nick") or user.get("global_name") or user["username"],
+        "color": None,
+        "isBot": user.get("bot", False),
+        "roles": [],
+        "avatarUrl": avatar_url
+    }
+
+"""
+convert_embed(embed)
+
+    Converts a Discord embed to the format DCE uses.
+
+"""
+def convert_embed(embed):
+
+    return {
+        "title": embed.get("title", ""),
+        "url": embed.get("url"),
+        "timestamp": format_timestamp(embed.get("timestamp")),
+        "description": embed.get("description", ""),
+        "color": f"#{embed['color']:06X}" if "color" in embed else None,
+        "author": {"name": embed["author"].get("name", ""), "url": embed["author"].get("url")} if "author" in embed else None,
+        "thumbnail": {"url": embed["thumbnail"]["url"]} if "thumbnail" in embed else None,
+        "images": [{"url": embed["image"]["url"]}] if "image" in embed else [],
+        "fields": [{"name": field["name"], "value": field["value"], "isInline": field.get("inline", False)} for field in embed.get("fields", [])],
+        "footer": {"text": embed["footer"].get("text", "")} if "footer" in embed else None
+    }
+
+"""
+convert_message(message)
+
+    Converts a message from the Discord API to the format DCE uses.
+
+    Args:
+        message (dict): The message, as returned by the Discord API.
+
+    Returns:
+        dict: The message in DCE format.
+"""
+def convert_message(message):
+
+    converted = {
+        "id": message["id"],
+        "type": MESSAGE_TYPES.get(message["type"], str(message["type"])),
+        "timestamp": format_timestamp(message["timestamp"]),
+        "timestampEdited": format_timestamp(message.get("edited_timestamp")),
+        "callEndedTimestamp": None,
+        "isPinned": message.get("pinned", False),
+        "content": message.get("content", ""),
+        "author": convert_user(message["author"], message.get("member")),
+        "attachments": [
+            {"id": attachment["id"], "url": attachment["url"], "fileName": attachment["filename"], "fileSizeBytes": attachment.get("size", 0)}
+            for attachment in message.get("attachments", [])
+        ],
+        "embeds": [convert_embed(embed) for embed in message.get("embeds", [])],
+        "stickers": [
+            {"id": sticker["id"], "name": sticker["name"], "format": sticker.get("format_type"), "sourceUrl": f"https://cdn.discordapp.com/stickers/{sticker['id']}.png"}
+            for sticker in message.get("sticker_items", [])
+        ],
+        "reactions": [
+            {"emoji": {"id": reaction["emoji"].get("id") or "", "name": reaction["emoji"]["name"], "code": reaction["emoji"]["name"],
+                       "isAnimated": reaction["emoji"].get("animated", False)},
+             "count": reaction["count"]}
+            for reaction in message.get("reactions", [])
+        ],
+        "mentions": [convert_user(user) for user in message.get("mentions", [])]
+    }
+
+    if "message_reference" in message:
+        converted["reference"] = {
+            "messageId": message["message_reference"].get("message_id"),
+            "channelId": message["message_reference"].get("channel_id"),
+            "guildId": message["message_reference"].get("guild_id")
+        }
+
+    return converted
+
+"""
+get_channel_info(http, channel_id, cache)
+
+    Gets the data of a channel from Discord, and the data of its parent and its server, to fill in the channel file.
+    Everything is cached, since many channels share the same parent and server.
+
+    Returns:
+        tuple[dict, dict, dict]: The channel, its parent (or None) and its server.
+"""
+async def get_channel_info(http, channel_id, cache):
+
+    async def get(key, request):
+        if key not in cache:
+            cache[key] = asyncio.ensure_future(request())
+
+        try:
+            return await cache[key]
+
+        except Exception:
+            # a failed request is not kept, so a retry asks again
+            cache.pop(key, None)
+            raise
+
+    channel = await get(("channel", channel_id), lambda: http.get_channel(channel_id))
+
+    parent = None
+    if channel.get("parent_id"):
+        parent = await get(("channel", channel["parent_id"]), lambda: http.get_channel(channel["parent_id"]))
+
+    guild = await get(("guild", channel["guild_id"]), lambda: http.get_guild(channel["guild_id"]))
+
+    return channel, parent, guild
+
+"""
+resolve_path(path, channel, parent, guild)
+
+    Replaces the DCE placeholders of an output path with the data of the channel.
+
+"""
+def resolve_path(path, channel, parent, guild):
+
+    placeholders = {
+        "%g": guild["id"],
+        "%G": guild["name"],
+        "%t": parent["id"] if parent else "",
+        "%T": parent["name"] if parent else "",
+        "%c": channel["id"],
+        "%C": channel["name"],
+        "%p": str(channel.get("position", 0)),
+        "%P": str(parent.get("position", 0)) if parent else "0",
+        "%d": datetime.now().strftime("%Y-%m-%d"),
+        "%%": "%"
+    }
+
+    # in one pass, so an escaped "%%" followed by a letter is not taken as a placeholder
+    path = re.sub(r"%.", lambda match: placeholders.get(match.group(0), match.group(0)), path)
+
+    return path
+
+"""
+to_snowflake(limit)
+
+    Gets the Discord ID to pass to the API from a message ID or a date, like DCE's --after and --before.
+
+"""
+def to_snowflake(limit):
+
+    if limit is None:
+        return None
+
+    if limit.isdigit():
+        return int(limit)
+
+    return int(t.datetime_to_snowflake(datetime.fromisoformat(limit).astimezone()))
+
+"""
+export_channel(http, export, cache, stall_timeout)
+
+    Exports a channel or thread, from the oldest to the newest message, and saves it in DCE format.
+
+    Args:
+        http (discord.http.HTTPClient): The HTTP session with Discord.
+        export (dict): The export, with the channel "id", the output "path" and the (after, before) "range".
+        cache (dict): The channels and servers already requested.
+        stall_timeout (float, optional): The seconds a page of messages can take before the export is considered stalled.
+
+    Returns:
+        int: The number of messages exported.
+"""
+async def export_channel(http, export, cache, stall_timeout=None):
+
+    channel, parent, guild = await get_channel_info(http, export["id"], cache)
+
+    after, before = export["range"]
+    cursor = to_snowflake(after) or 0
+    end = to_snowflake(before)
+
+    messages = []
+
+    while True:
+        page = await asyncio.wait_for(http.logs_from(export["id"], PAGE_SIZE, after=cursor), stall_timeout)
+
+        # the API can return the page in any order
+        page.sort(key=lambda x: int(x["id"]))
+
+        if end is not None:
+            page_in_range = [message for message in page if int(message["id"]) < end]
+        else:
+            page_in_range = page
+
+        messages.extend(convert_message(message) for message in page_in_range)
+
+        if len(page) < PAGE_SIZE or len(page_in_range) < len(page):
+            break
+
+        cursor = int(page[-1]["id"])
+
+    channel_data = {
+        "guild": {
+            "id": guild["id"],
+            "name": guild["name"],
+            "iconUrl": f"https://cdn.discordapp.com/icons/{guild['id']}/{guild['icon']}.png" if guild.get("icon") else None
+        },
+        "channel": {
+            "id": channel["id"],
+            "type": CHANNEL_TYPES.get(channel["type"], str(channel["type"])),
+            "categoryId": parent["id"] if parent else None,
+            "category": parent["name"] if parent else None,
+            "name": channel["name"],
+            "topic": channel.get("topic")
+        },
+        "dateRange": {"after": after, "before": before},
+        "exportedAt": datetime.now().astimezone().isoformat(timespec="milliseconds"),
+        "messages": messages,
+        "messageCount": len(messages)
+    }
+
+    file_path = resolve_path(export["path"], channel, parent, guild)
+    os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
+
+    t.save_to_json(channel_data, file_path)
+
+    return len(messages)
+
+
+################# Main function #################
+
+"""
+export_channels(exports, concurrency, on_result, limiter, retry, stall_timeout)
+
+    Exports several channels and threads at the same time with discord.py.
+
+    Any error of a channel is returned as its result, so it doesn't stop the other exports.
+    A failed export can be run again, the same way as in tricks.run_commands.
+
+    Args:
+        exports (list): The exports to run, with a "tag", the channel "id", the output "path" and the (after, before) "range".
+        concurrency (int, optional): The maximum number of channels exported at once.
+        on_result (function, optional): A function called with the result of each export as soon as it finishes.
+        limiter (optional): An async context manager that limits the exports running at once, used instead of 'concurrency'.
+        retry (function, optional): A function that decides if an export has to be run again, and when.
+        stall_timeout (float, optional): The seconds a page of messages can take before the export is considered stalled.
+
+    Returns:
+        list: The results, in the same format as tricks.run_commands, with the "tag", the return "code",
+              the "output" and the "duration" of the last run of each export, whether it "stalled", and the number of "attempts".
+"""
+def export_channels(exports, concurrency=5, on_result=None, limiter=None, retry=None, stall_timeout=None):
+    return asyncio.run(export_channels_async(exports, concurrency, on_result, limiter, retry, stall_timeout))
+
+
+async def export_channels_async(exports, concurrency=5, on_result=None, limiter=None, retry=None, stall_timeout=None):
+
+    if c.DISCORD_API is not None:
+        discord.http.Route.BASE = c.DISCORD_API
+
+    http = discord.http.HTTPClient(asyncio.get_running_loop())
+    await http.static_login(tokens.DISCORD_BOT)
+
+    semaphore = limiter if limiter is not None else asyncio.Semaphore(concurrency)
+    cache = {}
+
+    async def run_once(export):
+
+        async with semaphore:
+            start_time = time.monotonic()
+            stalled = False
+
+            try:
+                count = await export_channel(http, export, cache, stall_timeout)
+                code, output = 0, f"Exported {count} messages from {export['id']}\n"
+
+            except asyncio.TimeoutError:
+                code, output, stalled = 1, f"ERROR: No messages received in {stall_timeout} seconds\n", True
+
+            except Exception as e:
+                code, output = 1, f"ERROR: {type(e).__name__}: {e}\n"
+
+        t.log("console", f"[{export['tag']}] {output}")
+
+        return {
+            "tag": export["tag"],
+            "code": code,
+            "output": output,
+            "duration": time.monotonic() - start_time,
+            "stalled": stalled
+        }
+
+    async def run_in_slot(export):
+        attempt = 0
+
+        while True:
+            result = await run_once(export)
+            delay = retry(result, attempt) if retry is not None else None
+
+            if delay is None:
+                break
+
+            attempt += 1
+            await asyncio.sleep(delay)
+
+        result["attempts"] = attempt + 1
+
+        if on_result is not None:
+            on_result(result)
+
+        return result
+
+    try:
+        results = await asyncio.gather(*(run_in_slot(export) for export in exports), return_exceptions=True)
+
+        # an error outside of the export itself, like in on_result, only fails its channel
+        return [
+            result if not isinstance(result, Exception) else
+            {"tag": export["tag"], "code": 1, "output": f"ERROR: {type(result).__name__}: {result}\n", "duration": 0, "stalled": False, "attempts": 1}
+            for export, result in zip(exports, results)
+        ]
+
+    finally:
+        await http.close()
+
+
+if __name__ == "__main__":
+    print("\nThis module is not intended to be run directly.\n")
@@ -0,0 +1,437 @@
+import hashlib
+import os
+import shutil
+import sys
+import time
+from datetime import datetime, timedelta
+import tricks as t
+import exceptions as exc
+import tracing
+import backup_state as bs
+import backup_manifest as bm
+import channel_manifest as cm
+t.set_path()
+from res import constants as c
+from get_channel_list import get_channel_list
+from download_channels import download_channels, load_journal
+from sort_exported_files import sort_exported_files
+from assign_ids import assign_ids
+from merge_exports import merge_exports
+from fix_bad_messages import fix_bad_messages
+from update_info import update_info
+from find_all_scenes import find_all_scenes
+
+################ File summary #################
+
+"""
+
+This module runs the whole pipeline, skipping the steps that have nothing new to do.
+
+Main function: run_pipeline(force)
+
+    Each step declares the files and folders it reads ("inputs") and writes ("outputs").
+    Every step reads what the step before it writes, so they run in this order:
+        get_channel_list → download → sort → assign_ids → merge → fix → update_info → find_all_scenes
+
+    The work inside a step runs at the same time where it can: channels are exported together, files are read
+    by several processes, and find_all_scenes searches each category in its own process, adding up the statistics
+    of each category as soon as it's done, while the other categories are still being searched.
+
+    When a step finishes, a fingerprint of its inputs is saved in PIPELINE_STATE. Files are fingerprinted by their content,
+    and folders by the size and modification time of their channel files, so they don't have to be read.
+    The fingerprint is taken after the step, so what the step writes itself doesn't count as a change.
+    Next time, if the fingerprint is the same and its outputs exist, the step is skipped.
+    The steps that read from Discord ("always") always run, since their inputs can't be checked,
+    but get_channel_list only rewrites the list of channels if it changed.
+
+    If a step fails, the next run resumes from it: the steps that finished in the failed run are not run again,
+    and the update that was downloaded is kept. A run that finished starts from the beginning.
+
+    PIPELINE_STATE has this format:
+        {
+            "steps": { "sort": { "status": "success", "inputs": "fingerprint", "finishedAt": "..." }, ... },
+            "run": { "startedAt": "...", "date": "...", "done": ["get_channel_list", ...], "failed": "merge" }
+        }
+
+    It can be run from the command line. Use "force" to run every step:
+        python src/pipeline.py [force]
+
+"""
+
+################ Functions #################
+
+"""
+clean()
+
+    Function to clean up old temporary files and logs.
+
+"""
+def clean():
+
+    t.log("debug", "\n# Cleaning up old temporary files...  #\n")
+
+    # if log file is bigger than 10 MB, delete it
+    if os.path.exists(c.LOG_FILE) and os.path.getsize(c.LOG_FILE) > 10 * 1024 * 1024:
+        t.close_log()
+        os.remove(c.LOG_FILE)
+        t.log("debug", f"\tDeleted log file: {c.LOG_FILE}")
+
+    # if there's an "Update" folder, delete it, unless it belongs to an interrupted download that will be resumed
+    if os.path.exists("Update") and load_journal() is not None:
+        t.log("debug", "\tKept 'Update' folder to resume the interrupted download")
+
+    elif os.path.exists("Update"):
+        t.log("debug", "\tDeleted 'Update' folder")
+        os.system(f"rm -rf Update")
+
+    # the shards of channels exported in parts are always exported again
+    if os.path.exists(c.SHARD_FOLDER):
+        t.log("debug", f"\tDeleted '{c.SHARD_FOLDER}' folder")
+        shutil.rmtree(c.SHARD_FOLDER)
+
+
+"""
+set_day_before(timestamp_str)
+
+    Adjusts the given timestamp by subtracting one day to ensure downloading the whole update.
+
+    Args:
+        timestamp_str (str): The original timestamp in ISO format.
+
+    Returns:
+        str: The adjusted timestamp in ISO format, representing the day before the original.
+"""
+def set_day_before(timestamp_str):
+
+    # Parse the timestamp into a datetime object
+    timestamp = datetime.fromisoformat(timestamp_str)
+
+    # Subtract one day (24 hours) from the timestamp
+    new_timestamp = timestamp - timedelta(days=1)
+
+    # Format the new timestamp back into the original format
+    new_timestamp_str = new_timestamp.isoformat()
+
+    return new_timestamp_str
+
+"""
+set_export_date()
+
+    Returns the date of the last export in ISO format as a string or None if there is no previous backup.
+
+    The date is retrieved from the state of the backup.
+
+    If the previous download was interrupted, returns the date it was using, so it can be resumed.
+
+    Note: Each channel is exported from its own watermark, kept in the channel manifest, so interrupted exports are safe.
+          This date is only used to know if there is a previous backup, and as a fallback for backups made before the manifest existed.
+"""
+def set_export_date():
+    
+    date = None
+
+    # if the previous download was interrupted, resume it from the same date
+    journal = load_journal()
+
+    if journal is not None:
+        t.log("info", f'\tResuming the interrupted download started at {journal["startedAt"]}\n')
+        return journal["date"]
+
+    state = bs.load_state()
+
+    # if the previous export failed, use the last good export date
+    if state["steps"]["downloadStatus"] == "failed":
+        state["dates"]["exportedAt"] = state["dates"]["lastGoodExport"]
+        bs.update_state(dates={"exportedAt": state["dates"]["exportedAt"]})
+
+    # Check if there is a previous backup
+    if state["dates"]["exportedAt"] is not None:
+
+        t.log("info", f'\tThe last backup was downloaded at {state["dates"]["exportedAt"]}')
+        date = set_day_before(state["dates"]["exportedAt"])
+        t.log("info", f'\tWill download updates after {date}\n')
+
+    else:
+        t.log("info", '\tNo previous backup was found. Will download the full history\n')
+    
+    return date
+
+def skip_merge():
+    t.log("info", "\tNo previous backup was found. Skipping the merge step.\n")
+
+    bs.update_state(steps={"mergeStatus": "success"})
+
+"""
+export_folder(run)
+
+    Gets the folder the download of the run was exported to: the main backup if it was the full history, or the update.
+
+"""
+def export_folder(run):
+    return c.SERVER_NAME if run["date"] is None else "Update"
+
+"""
+Step functions
+
+    Each one runs a step with the arguments it needs from the run.
+
+"""
+def run_download(run):
+    run["date"] = set_export_date()
+    download_channels(run["date"])
+
+
+def run_merge(run):
+    if run["date"] is not None:
+        merge_exports()
+    else:
+        skip_merge()
+        cm.record_folder(c.SERVER_NAME)
+
+
+STEPS = [
+    {
+        "name": "get_channel_list",
+        "run": lambda run: get_channel_list(),
+        "always": True,
+        "inputs": lambda run: [],
+        "outputs": lambda run: [c.BACKUP_INFO],
+        "status": ["updateStatus", "updateCleanStatus"]
+    },
+    {
+        "name": "download",
+        "run": run_download,
+        "always": True,
+        "inputs": lambda run: [c.BACKUP_INFO],
+        "outputs": lambda run: [export_folder(run)],
+        "status": ["downloadStatus"]
+    },
+    {
+        "name": "sort",
+        "run": lambda run: sort_exported_files(export_folder(run)),
+        "inputs": lambda run: [c.BACKUP_INFO, export_folder(run)],
+        "outputs": lambda run: [c.LAYOUT_MANIFEST, c.BACKUP_INFO, export_folder(run)],
+        "status": ["sortingReadStatus", "sortingCleanStatus", "sortingWriteStatus"]
+    },
+    {
+        "name": "assign_ids",
+        "run": lambda run: assign_ids(export_folder(run)),
+        "inputs": lambda run: [export_folder(run), c.CHARACTER_LIST],
+        "outputs": lambda run: [export_folder(run), c.CHARACTER_LIST],
+        "status": ["idAssignStatus"]
+    },
+    {
+        "name": "merge",
+        "run": run_merge,
+        "inputs": lambda run: [export_folder(run), c.SERVER_NAME],
+        "outputs": lambda run: [c.SERVER_NAME, c.CHANNEL_MANIFEST],
+        "status": ["mergeStatus"]
+    },
+    {
+        "name": "fix",
+        "run": lambda run: fix_bad_messages(),
+        "inputs": lambda run: [c.SERVER_NAME, c.FIXED_MESSAGES],
+        "outputs": lambda run: [c.SERVER_NAME, c.BAD_MESSAGES, c.BAD_END_MESSAGES],
+        "status": ["messageFixStatus"]
+    },
+    {
+        "name": "update_info",
+        "run": lambda run: update_info(),
+        "inputs": lambda run: [c.SERVER_NAME, c.CHANNEL_MANIFEST, c.BACKUP_INFO],
+        "outputs": lambda run: [c.BACKUP_INFO],
+        "status": []
+    },
+    {
+        "name": "find_all_scenes",
+        "run": lambda run: find_all_scenes(),
+        "inputs": lambda run: [c.SEARCH_FOLDER, c.CHARACTER_LIST, c.BACKUP_INFO],
+        "outputs": lambda run: [c.CHANNEL_MANIFEST],
+        "status": []
+    }
+]
+
+"""
+fingerprint(paths)
+
+    Calculates a fingerprint of files and folders.
+
+    Files, like the list of channels or the manifests, are fingerprinted by their content, since other steps
+    rewrite them with the same content. Folders are fingerprinted by the size and modification time of their
+    channel files, so the whole backup doesn't have to be read. The scene files written in them don't count as a change.
+
+"""
+def fingerprint(paths):
+
+    digest = hashlib.blake2b(digest_size=16)
+
+    for path in paths:
+
+        if os.path.isdir(path):
+            for file_path in bm.list_channel_files(path):
+                stat = os.stat(file_path)
+                digest.update(f"{file_path}:{stat.st_size}:{stat.st_mtime_ns}\n".encode("utf-8"))
+
+        elif os.path.exists(path):
+            digest.update(f"{path}:{bm.hash_file(path)}\n".encode("utf-8"))
+
+        else:
+            digest.update(f"{path}:missing\n".encode("utf-8"))
+
+    return digest.hexdigest()
+
+"""
+load_pipeline(), save_pipeline(pipeline)
+
+    Functions to read and write the state of the pipeline. If there is no state yet, it's empty.
+    The state is written to a temporary file first and then replaces the old one, so it's never left half written.
+
+"""
+def load_pipeline():
+    try:
+        return t.load_from_json(c.PIPELINE_STATE)
+
+    except FileNotFoundError:
+        return {"steps": {}, "run": None}
+
+
+def save_pipeline(pipeline):
+    t.save_to_json(pipeline, f"{c.PIPELINE_STATE}.tmp")
+    os.replace(f"{c.PIPELINE_STATE}.tmp", c.PIPELINE_STATE)
+
+"""
+start_run(pipeline, force)
+
+    Resumes the failed run, or starts a new one.
+
+    Returns:
+        dict: The run, with the steps already "done".
+"""
+def start_run(pipeline, force):
+
+    run = pipeline["run"]
+
+    if not force and run is not None and run["failed"] is not None:
+
+        t.log("info", f"\tResuming the run started at {run['startedAt']} from '{run['failed']}'. Already done: {', '.join(run['done']) or 'nothing'}\n")
+
+        # the failed step is tried again, so the backup is not left as failed
+        if bs.load_state()["status"] == "failed":
+            bs.update_state(status="pending")
+
+        run["failed"] = None
+        return run
+
+    clean()
+
+    return {
+        "startedAt": datetime.now().astimezone().isoformat(sep='T', timespec='seconds'),
+        "date": None,
+        "done": [],
+        "failed": None
+    }
+
+"""
+can_skip(step, pipeline, run)
+
+    Checks if a step has nothing new to do: none of its inputs changed since it last succeeded, and its outputs exist.
+
+"""
+def can_skip(step, pipeline, run):
+
+    last = pipeline["steps"].get(step["name"])
+
+    if step.get("always") or last is None or last["status"] != "success":
+        return False
+
+    if not all(os.path.exists(path) for path in step["outputs"](run)):
+        return False
+
+    return last["inputs"] == fingerprint(step["inputs"](run))
+
+
+################ Main function #################
+
+"""
+run_pipeline(force)
+
+    Runs every step of the pipeline in order, skipping the ones that have nothing new to do,
+    and resuming the last run if it failed.
+
+    Args:
+        force (bool, optional): Run every step, even if its inputs didn't change or the last run failed.
+
+    Returns:
+        list: The names of the steps that ran.
+"""
+@tracing.traced("run")
+def run_pipeline(force=False):
+
+    t.log("base", f"\n# Running the pipeline for {c.SERVER_NAME}... #\n")
+
+    start_time = time.time()
+
+    bs.acquire("pipeline")
+
+    try:
+        pipeline = load_pipeline()
+        run = start_run(pipeline, force)
+        pipeline["run"] = run
+
+        ran = []
+
+        for step in STEPS:
+
+            if step["name"] in run["done"]:
+                t.log("info", f"\tSkipping '{step['name']}': it finished before the run failed\n")
+                continue
+
+            if not force and can_skip(step, pipeline, run):
+                t.log("info", f"\tSkipping '{step['name']}': nothing changed since it last ran\n")
+
+                # the next steps check that the steps before them succeeded
+                if step["status"]:
+                    bs.update_state(steps={key: "success" for key in step["status"]})
+
+                continue
+
+            t.log("info", f"\n\tRunning '{step['name']}'...\n")
+
+            try:
+                step["run"](run)
+
+            # an interrupted step is saved as failed too, so the next run resumes from it
+            except BaseException:
+                run["failed"] = step["name"]
+                pipeline["steps"][step["name"]] = {"status": "failed", "inputs": None, "finishedAt": None}
+                save_pipeline(pipeline)
+                raise
+
+            ran.append(step["name"])
+            run["done"].append(step["name"])
+
+            pipeline["steps"][step["name"]] = {
+                "status": "success",
+                "inputs": fingerprint(step["inputs"](run)),
+                "finishedAt": datetime.now().astimezone().isoformat(sep='T', timespec='seconds')
+            }
+            save_pipeline(pipeline)
+
+        t.log("info", f"\tRan {len(ran)} of {len(STEPS)} steps: {', '.join(ran) or 'none'}")
+
+        return ran
+
+    except Exception as e:
+        raise exc.PipelineError("The pipeline failed. Run it again to resume from the failed step") from e
+
+    finally:
+        bs.release()
+        t.log("base", f"\n# Pipeline finished --- {time.time() - start_time:.2f} seconds --- #\n")
+
+
+if __name__ == "__main__":
+
+    try:
+        run_pipeline(len(sys.argv) > 1 and sys.argv[1] == "force")
+
+    except Exception as e:
+        t.log("error", f"\n{exc.unwrap(e)}\n")
@@ -0,0 +1,174 @@
+import asyncio
+import random
+import re
+import time
+import tricks as t
+t.set_path()
+from res import constants as c
+
+################ File summary #################
+
+"""
+
+This module decides what to do when an export fails, and how many exports can run at the same time.
+
+Main class: AdaptiveConcurrency
+
+    When too many exports run at the same time, Discord starts answering with rate limits (HTTP 429),
+    and DCE exits with an error. Other errors, like timeouts or a 5xx from Discord, also go away on their own.
+    The native exporter writes the errors of discord.py and aiohttp in its output, so they are classified the same way.
+
+    The output of each failed export is classified:
+        - "stall": the export stopped printing progress and was killed. The export is retried from the same watermark.
+        - "rate_limit": Discord rate limited the bot. The export is retried, and fewer exports run at once.
+        - "transient": a network or server error. The export is retried.
+        - "fatal": anything else, like a missing permission. The export fails.
+
+    Retries wait with a jittered exponential backoff, so the exports that failed together don't retry together.
+
+    The number of exports running at once follows AIMD (additive increase, multiplicative decrease):
+    it grows by one after a full round of exports finish without rate limits, and it's halved on a rate limit.
+    This keeps it close to the highest number Discord allows.
+
+"""
+
+################ Functions #################
+
+"""
+    These regex patterns detect rate limits and errors that are worth retrying in the output of an export.
+
+"""
+rate_limit_pattern = re.compile(r"\b429\b|too many requests|rate.?limit", re.IGNORECASE)
+transient_pattern = re.compile(
+    r"\b50[0234]\b|internal server error|bad gateway|service unavailable|gateway timeout"
+    r"|timed? ?out|connection (?:was )?(?:reset|refused|closed)|error occurred while sending the request"
+    r"|ssl connection could not be established|name or service not known|temporary failure"
+    r"|DiscordServerError|ClientConnectorError|ClientOSError|ServerDisconnectedError|ClientPayloadError|ConnectionResetError",
+    re.IGNORECASE
+)
+
+"""
+classify(result)
+
+    Classifies the result of an export.
+
+    Args:
+        result (dict): The result of the export, with the return "code" and the "output" of DCE.
+
+    Returns:
+        str: "success", "stall", "rate_limit", "transient" or "fatal".
+"""
+def classify(result):
+
+    if result.get("stalled"):
+        return "stall"
+
+    if result["code"] == 0:
+        return "success"
+
+    if rate_limit_pattern.search(result["output"]):
+        return "rate_limit"
+
+    if transient_pattern.search(result["output"]):
+        return "transient"
+
+    return "fatal"
+
+"""
+backoff(attempt)
+
+    Calculates how long to wait before retrying an export, with "full jitter":
+    a random time between 0 and EXPORT_BACKOFF * 2^attempt, capped at EXPORT_BACKOFF_MAX seconds.
+
+    Args:
+        attempt (int): The number of retries so far, starting at 0.
+
+    Returns:
+        float: The time to wait, in seconds.
+"""
+def backoff(attempt):
+    return random.uniform(0, min(c.EXPORT_BACKOFF_MAX, c.EXPORT_BACKOFF * 2 ** attempt))
+
+
+################ Classes #################
+
+"""
+AdaptiveConcurrency(initial, maximum, minimum)
+
+    Limits how many exports run at the same time, and adapts the limit with AIMD.
+    It's used like a semaphore: "async with limiter:" waits until there is a free slot.
+
+    Args:
+        initial (int): The number of exports at the start.
+        maximum (int): The highest number of exports at the same time.
+        minimum (int, optional): The lowest number of exports at the same time. Defaults to 1.
+
+"""
+class AdaptiveConcurrency:
+
+    def __init__(self, initial, maximum, minimum=1):
+        self.minimum = minimum
+        self.maximum = max(maximum, initial)
+        self.limit = float(initial)
+        self.running = 0
+        self.condition = None
+        self.last_decrease = 0
+        self.stats = {"successes": 0, "rateLimits": 0, "decreases": 0, "lowest": initial, "highest": initial}
+
+    async def __aenter__(self):
+
+        if self.condition is None:
+            self.condition = asyncio.Condition()
+
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.running < int(self.limit))
+            self.running += 1
+
+    async def __aexit__(self, *exc_info):
+
+        async with self.condition:
+            self.running -= 1
+            self.condition.notify_all()
+
+    """
+    success()
+
+        Additive increase: the limit grows by 1/limit per success, so by one after a full round of exports.
+        Waiting exports see the new limit the next time a slot is freed.
+
+    """
+    def success(self):
+
+        self.stats["successes"] += 1
+        self.limit = min(self.maximum, self.limit + 1 / self.limit)
+        self.stats["highest"] = max(self.stats["highest"], int(self.limit))
+
+    """
+    rate_limited(started_at)
+
+        Multiplicative decrease: the limit is halved.
+
+        Exports that were already running when the limit last went down are hitting the same rate limit,
+        so they don't decrease it again.
+
+        Args:
+            started_at (float): When the export that was rate limited started, from time.monotonic().
+
+    """
+    def rate_limited(self, started_at):
+
+        self.stats["rateLimits"] += 1
+
+        if started_at < self.last_decrease:
+            return
+
+        self.limit = max(self.minimum, self.limit / 2)
+        self.last_decrease = time.monotonic()
+        self.stats["decreases"] += 1
+        self.stats["lowest"] = min(self.stats["lowest"], int(self.limit))
+
+        t.log("debug", f"\t\t{t.YELLOW}Rate limited by Discord, exporting {int(self.limit)} channels at the same time")
+
+
+if __name__ == "__main__":
+    print("\nThis module is not intended to be run directly.\n")
@@ -0,0 +1,431 @@
+import html
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import tricks as t
+import exceptions as exc
+import tracing
+import message_index as mi
+import channel_manifest as cm
+import scene_cache as sc
+t.set_path()
+from res import constants as c
+
+################ File summary #################
+
+"""
+
+This module creates the HTML files of the found scenes from the server backup, without downloading anything.
+
+Main function: render_scenes(scenes_file, folder)
+
+    This script reads the scenes from the JSON file created by the find_scenes script,
+    finds the channel file that contains each scene with the message index,
+    and cuts the scene exactly from its start message to its end message.
+    Scenes without an end message go on until the end of the channel.
+
+    Each scene is saved as an HTML file with a dark theme, similar to the ones DCE creates.
+    The channel files are read in parallel, and each one only once, no matter how many scenes it has.
+
+    Rendered scenes are kept in the scene cache, so scenes shared with other characters, or that haven't changed
+    since the last time, are not rendered again.
+
+"""
+
+################ Functions #################
+
+"""
+    These regex patterns convert the Discord markdown of the messages to HTML.
+    They work on text that has already been escaped.
+
+"""
+code_block_pattern = re.compile(r"```(?:[a-z0-9]+\n)?(.*?)```", re.DOTALL)
+inline_code_pattern = re.compile(r"`([^`\n]+)`")
+bold_pattern = re.compile(r"\*\*(.+?)\*\*", re.DOTALL)
+underline_pattern = re.compile(r"__(.+?)__", re.DOTALL)
+italic_pattern = re.compile(r"(?<![\w*])[*_](?![*_\s])(.+?)(?<![\s*_])[*_](?![\w*])", re.DOTALL)
+strike_pattern = re.compile(r"~~(.+?)~~", re.DOTALL)
+spoiler_pattern = re.compile(r"\|\|(.+?)\|\|", re.DOTALL)
+quote_pattern = re.compile(r"^&gt; (.*)$", re.MULTILINE)
+link_pattern = re.compile(r"(https?://[^\s<\x00]+)")
+placeholder_pattern = re.compile(r"\x00(\d+)\x00")
+user_mention_pattern = re.compile(r"&lt;@!?(\d+)&gt;")
+channel_mention_pattern = re.compile(r"&lt;#(\d+)&gt;")
+emoji_pattern = re.compile(r"&lt;(a?):(\w+):(\d+)&gt;")
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".gif", ".webp")
+
+STYLE = """
+body { background: #36393e; color: #dcddde; font-family: "gg sans", "Helvetica Neue", Helvetica, Arial, sans-serif; font-size: 16px; margin: 0; }
+.preamble { display: flex; padding: 1em; border-bottom: 1px solid #4f545c; }
+.preamble__entries { margin-left: 0.6em; }
+.preamble__entry { font-size: 1.3em; }
+.preamble__entry--small { font-size: 0.9em; color: #b9bbbe; }
+.chatlog { padding: 1em 0; }
+.chatlog__message-group { display: flex; padding: 0.3em 1em; margin-top: 0.6em; }
+.chatlog__avatar { width: 40px; height: 40px; border-radius: 50%; margin-right: 1em; flex-shrink: 0; }
+.chatlog__messages { min-width: 0; }
+.chatlog__author { font-weight: 600; color: #ffffff; }
+.chatlog__bot-tag { background: #5865f2; color: #ffffff; font-size: 0.65em; padding: 0.1em 0.3em; border-radius: 3px; margin-left: 0.3em; vertical-align: middle; }
+.chatlog__timestamp { margin-left: 0.3em; color: #a3a6aa; font-size: 0.75em; }
+.chatlog__message-container { padding: 0.1em 0; }
+.chatlog__content { line-height: 1.375; white-space: normal; overflow-wrap: break-word; }
+.chatlog__attachment img { max-width: 45vw; max-height: 500px; border-radius: 3px; margin-top: 0.3em; }
+.chatlog__embed { border-left: 4px solid #202225; background: #2f3136; border-radius: 3px; padding: 0.5em 0.8em; margin-top: 0.3em; max-width: 520px; }
+.chatlog__embed-title { font-weight: 600; }
+.chatlog__reactions { margin-top: 0.3em; }
+.chatlog__reaction { display: inline-block; background: #2f3136; border-radius: 8px; padding: 0.1em 0.4em; margin-right: 0.3em; font-size: 0.85em; }
+.chatlog__system { color: #a3a6aa; font-style: italic; padding: 0.3em 1em 0.3em 4em; }
+.mention { background: rgba(88, 101, 242, 0.3); color: #dee0fc; border-radius: 3px; padding: 0 2px; }
+.spoiler { background: #202225; color: transparent; border-radius: 3px; }
+.spoiler:hover { color: inherit; }
+.quote { border-left: 4px solid #4f545c; padding-left: 0.6em; display: block; }
+code { background: #2f3136; border-radius: 3px; padding: 0.1em 0.3em; font-size: 0.85em; }
+pre { background: #2f3136; border: 1px solid #202225; border-radius: 4px; padding: 0.5em; white-space: pre-wrap; }
+.emoji { width: 1.375em; height: 1.375em; vertical-align: bottom; }
+a { color: #00aff4; text-decoration: none; }
+.postamble { padding: 1em; border-top: 1px solid #4f545c; color: #b9bbbe; font-size: 0.9em; }
+"""
+
+"""
+format_markdown(content, mentions)
+
+    Converts the content of a message to HTML, escaping it first.
+
+    Args:
+        content (str): The content of the message.
+        mentions (list): The users mentioned in the message, to show their names.
+
+    Returns:
+        str: The content in HTML.
+"""
+def format_markdown(content, mentions):
+
+    names = {user["id"]: user.get("nickname") or user["name"] for user in mentions}
+
+    text = html.escape(content, quote=False)
+
+    # code, links, emoji and mentions are kept as they are, so they're taken out before the rest of the formatting
+    # and put back at the end. Otherwise a name like __init__ would be underlined
+    kept = []
+
+    def keep(html_text):
+        kept.append(html_text)
+        return f"\x00{len(kept) - 1}\x00"
+
+    text = code_block_pattern.sub(lambda m: keep(f"<pre>{m.group(1)}</pre>"), text)
+    text = inline_code_pattern.sub(lambda m: keep(f"<code>{m.group(1)}</code>"), text)
+
+    text = link_pattern.sub(lambda m: keep(f'<a href="{m.group(1)}">{m.group(1)}</a>'), text)
+    text = emoji_pattern.sub(lambda m: keep(f'<img class="emoji" alt=":{m.group(2)}:" src="https://cdn.discordapp.com/emojis/{m.group(3)}.{"gif" if m.group(1) else "png"}">'), text)
+    text = user_mention_pattern.sub(lambda m: keep(f'<span class="mention">@{html.escape(names.get(m.group(1), "Unknown"))}</span>'), text)
+    text = channel_mention_pattern.sub(lambda m: keep(f'<span class="mention">#{m.group(1)}</span>'), text)
+
+    text = bold_pattern.sub(r"<strong>\1</strong>", text)
+    text = underline_pattern.sub(r"<u>\1</u>", text)
+    text = italic_pattern.sub(r"<em>\1</em>", text)
+    text = strike_pattern.sub(r"<s>\1</s>", text)
+    text = spoiler_pattern.sub(r'<span class="spoiler">\1</span>', text)
+    text = quote_pattern.sub(r'<span class="quote">\1</span>', text)
+
+    text = text.replace("\n", "<br>")
+
+    return placeholder_pattern.sub(lambda m: kept[int(m.group(1))], text)
+
+"""
+format_timestamp(timestamp)
+
+    Formats the timestamp of a message like DCE does with the en-GB locale.
+
+"""
+def format_timestamp(timestamp):
+    return datetime.fromisoformat(timestamp).strftime("%d/%m/%Y %H:%M")
+
+"""
+render_message(message)
+
+    Renders the content, attachments, embeds and reactions of a message.
+
+"""
+def render_message(message):
+
+    parts = [f'<div class="chatlog__message-container" id="chatlog__message-container-{message["id"]}">']
+
+    if message.get("content"):
+        parts.append(f'<div class="chatlog__content">{format_markdown(message["content"], message.get("mentions", []))}</div>')
+
+    for attachment in message.get("attachments", []):
+        url = html.escape(attachment["url"])
+        name = html.escape(attachment.get("fileName", "attachment"))
+
+        if attachment.get("fileName", "").lower().endswith(IMAGE_EXTENSIONS):
+            parts.append(f'<div class="chatlog__attachment"><a href="{url}"><img src="{url}" alt="{name}" loading="lazy"></a></div>')
+        else:
+            parts.append(f'<div class="chatlog__attachment"><a href="{url}">{name}</a></div>')
+
+    for embed in message.get("embeds", []):
+        color = f' style="border-color: {embed["color"]}"' if embed.get("color") else ""
+        parts.append(f'<div class="chatlog__embed"{color}>')
+
+        if embed.get("title"):
+            parts.append(f'<div class="chatlog__embed-title">{format_markdown(embed["title"], [])}</div>')
+        if embed.get("description"):
+            parts.append(f'<div>{format_markdown(embed["description"], [])}</div>')
+        for field in embed.get("fields", []):
+            parts.append(f'<div><strong>{format_markdown(field["name"], [])}</strong><br>{format_markdown(field["value"], [])}</div>')
+
+        parts.append("</div>")
+
+    if message.get("reactions"):
+        reactions = "".join(f'<span class="chatlog__reaction">{html.escape(reaction["emoji"]["name"])} {reaction["count"]}</span>' for reaction in message["reactions"])
+        parts.append(f'<div class="chatlog__reactions">{reactions}</div>')
+
+    parts.append("</div>")
+
+    return "".join(parts)
+
+"""
+render_scene(channel_data, messages, scene)
+
+    Renders the messages of a scene as a full HTML page.
+    Consecutive messages from the same author are grouped together, like in Discord.
+
+    Args:
+        channel_data (dict): The content of the channel file, for the server and channel names.
+        messages (list): The messages of the scene, in order.
+        scene (dict): The scene, from the scenes file.
+
+    Returns:
+        str: The HTML page.
+"""
+def render_scene(channel_data, messages, scene):
+
+    guild = channel_data["guild"]
+    channel = channel_data["channel"]
+
+    body = []
+    last_author = None
+
+    for message in messages:
+
+        # system messages, like pins or new threads, have their own line
+        if message["type"] not in ("Default", "Reply"):
+            if last_author is not None:
+                body.append("</div></div>")
+                last_author = None
+
+            body.append(f'<div class="chatlog__system" id="chatlog__message-container-{message["id"]}">'
+                        f'{html.escape(message["author"].get("nickname") or message["author"]["name"])} {html.escape(message.get("content") or message["type"])}</div>')
+            continue
+
+        author = message["author"]
+
+        if author["id"] != last_author:
+            if last_author is not None:
+                body.append("</div></div>")
+
+            name = html.escape(author.get("nickname") or author["name"])
+            bot_tag = '<span class="chatlog__bot-tag">BOT</span>' if author.get("isBot") else ""
+            avatar = html.escape(author.get("avatarUrl") or "")
+
+            body.append(f'<div class="chatlog__message-group"><img class="chatlog__avatar" src="{avatar}" alt="" loading="lazy"><div class="chatlog__messages">'
+                        f'<span class="chatlog__author" title="{html.escape(author["name"])}">{name}</span>{bot_tag}'
+                        f'<span class="chatlog__timestamp">{format_timestamp(message["timestamp"])}</span>')
+
+            last_author = author["id"]
+
+        body.append(render_message(message))
+
+    if last_author is not None:
+        body.append("</div></div>")
+
+    title = f"{guild['name']} - {channel.get('category') or ''} - {channel['name']}"
+    dates = f"{format_timestamp(messages[0]['timestamp'])} to {format_timestamp(messages[-1]['timestamp'])}" if messages else ""
+
+    return (
+        f'<!DOCTYPE html><html lang="en"><head><meta charset="utf-8"><title>{html.escape(title)}</title><style>{STYLE}</style></head><body>'
+        f'<div class="preamble"><div class="preamble__entries">'
+        f'<div class="preamble__entry">{html.escape(guild["name"])}</div>'
+        f'<div class="preamble__entry">{html.escape(channel.get("category") or "")} / {html.escape(channel["name"])}</div>'
+        f'<div class="preamble__entry preamble__entry--small">Scene {scene.get("id", "")} ({html.escape(str(scene.get("status", "")))}) - {dates}</div>'
+        f'</div></div>'
+        f'<div class="chatlog">{"".join(body)}</div>'
+        f'<div class="postamble">Rendered {len(messages)} message(s) from the backup</div>'
+        f'</body></html>'
+    )
+
+"""
+find_position(messages, message_id, position)
+
+    Finds the position of a message in a channel, checking the position from the index first.
+
+"""
+def find_position(messages, message_id, position=None):
+
+    if position is not None and position < len(messages) and messages[position]["id"] == message_id:
+        return position
+
+    for i, message in enumerate(messages):
+        if message["id"] == message_id:
+            return i
+
+    return None
+
+"""
+render_channel_scenes(file_path, jobs)
+
+    Renders all the scenes of a channel file. It's meant to run in a worker process.
+
+    Args:
+        file_path (str): The path to the channel JSON file.
+        jobs (list): For each scene, a tuple with the scene, the positions of its start and end messages from the index
+                     (or None), and the path of the HTML file.
+
+    Returns:
+        list: For each scene, a tuple with True and the path of the HTML file, or False and the reason it couldn't be rendered.
+"""
+def render_channel_scenes(file_path, jobs):
+
+    channel_data = t.load_from_json(file_path)
+    messages = channel_data["messages"]
+
+    results = []
+
+    for scene, start_position, end_position, output_path in jobs:
+
+        start = find_position(messages, scene["start"]["id"], start_position)
+
+        if start is None:
+            results.append((False, f"The start of scene {scene.get('id')} ({scene['start']['id']}) is not in {file_path}"))
+            continue
+
+        if scene.get("end"):
+            end = find_position(messages, scene["end"]["id"], end_position)
+
+            if end is None:
+                results.append((False, f"The end of scene {scene.get('id')} ({scene['end']['id']}) is not in {file_path}"))
+                continue
+        else:
+            end = len(messages) - 1
+
+        with open(output_path, "w", encoding="utf-8") as file:
+            file.write(render_scene(channel_data, messages[start:end + 1], scene))
+
+        results.append((True, output_path))
+
+    return results
+
+"""
+scene_filename(scene, used_names)
+
+    Names the HTML file of a scene like DCE did: the start date and the channel name.
+    If two scenes would have the same name, the ID of the scene is added.
+
+"""
+def scene_filename(scene, used_names):
+
+    date = scene["start"]["timestamp"][:10]
+    name = re.sub(r'[\\/:*?"<>|]', "_", f"{date} - {scene['channel']}")
+
+    if name in used_names:
+        name = f"{name} ({scene.get('id', len(used_names))})"
+
+    used_names.add(name)
+
+    return f"{name}.html"
+
+
+################ Main function #################
+
+@tracing.traced("step")
+def render_scenes(scenes_file=c.OUTPUT_SCENES, folder=f"out/{c.CHARACTER}"):
+
+    try:
+        t.log("base", f"\n##  Rendering all scenes with '{c.CHARACTER}' from the backup...  ##\n")
+
+        start_time = time.time()
+
+        scenes = t.load_from_json(scenes_file)
+
+        t.log("info", f"\tLoaded scene information for {len(scenes)} scenes\n")
+
+        os.makedirs(folder, exist_ok=True)
+
+        index = mi.load_index()
+        manifest = cm.load_manifest()
+
+        # group the scenes by channel file, so each file is only read once
+        jobs_by_file = {}
+        used_names = set()
+        missing = 0
+        cached = 0
+        keys = {}
+
+        for scene in scenes:
+
+            location = mi.locate(index, scene["start"]["id"])
+
+            if location is None:
+                t.log("info", f"\t{t.YELLOW}Scene {scene.get('id')} in '{scene['channel']}' is not in the message index. Skipping...")
+                missing += 1
+                continue
+
+            file_path, start_position = location
+            end_location = mi.locate(index, scene["end"]["id"]) if scene.get("end") else None
+            end_position = end_location[1] if end_location is not None and end_location[0] == file_path else None
+
+            output_path = os.path.join(folder, scene_filename(scene, used_names))
+
+            # scenes that were already rendered, for this or another character, come from the cache
+            key = sc.lookup(scene, "local", manifest)
+
+            if sc.fetch(key, output_path):
+                cached += 1
+                continue
+
+            sc.prepare(output_path)
+            keys[output_path] = (key, scene)
+
+            jobs_by_file.setdefault(file_path, []).append((scene, start_position, end_position, output_path))
+
+        rendered = 0
+
+        with ProcessPoolExecutor(max_workers=c.WORKERS) as pool:
+
+            file_paths = list(jobs_by_file)
+
+            for results in pool.map(render_channel_scenes, file_paths, [jobs_by_file[file_path] for file_path in file_paths]):
+                for success, result in results:
+
+                    if success:
+                        rendered += 1
+                        key, scene = keys[result]
+                        sc.store(key, result, scene)
+                        t.log("debug", "\t  Rendered %s", result)
+
+                    else:
+                        missing += 1
+                        t.log("info", f"\t{t.YELLOW}{result}")
+
+        tracing.add(scenes=rendered)
+
+        t.log("info", f"\n\tRendered {rendered} scenes and reused {cached} from the cache, out of {len(scenes)}, into {folder}")
+
+        if missing > 0:
+            t.log("info", f"\t{t.YELLOW}{missing} scenes could not be found in the backup. Rebuilding the message index may help")
+
+        t.log("base", f"\n##  Finished rendering all scenes! --- {time.time() - start_time:.2f} seconds --- ##\n")
+
+    except Exception as e:
+        raise exc.ExportScenesError("Failed to render the scenes") from e
+
+
+if __name__ == "__main__":
+
+    try:
+        render_scenes()
+
+    except Exception as e:
+        t.log("error", f"\n{exc.unwrap(e)}\n")
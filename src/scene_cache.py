@@ -0,0 +1,133 @@
+import os
+import shutil
+import tricks as t
+t.set_path()
+from res import constants as c
+
+################ File summary #################
+
+"""
+
+This module keeps a cache of the scenes already exported, shared by all characters.
+
+Main functions: lookup(scene, file_format, manifest), fetch(key, output_path), store(key, file_path, scene)
+
+    A scene is the same file whoever exports it, so it's cached with its channel, start message, end message and format as the key:
+        SCENE_CACHE/[format]/[channel ID]/[start ID]-[end ID].html
+
+    Scenes without an end message go until the last message of the channel, so the last message in the channel manifest
+    is used as their end, with their own prefix:
+        SCENE_CACHE/[format]/[channel ID]/[start ID]-open-[last message ID].html
+
+    When new messages are added to the channel, the key changes and the scene is exported again.
+    Ended scenes with the same start keep their own key, so other characters can still use them.
+    If the channel isn't in the manifest, the scene isn't cached.
+
+    Cached scenes are copied to the output folder with a hardlink when possible, so they don't take space twice.
+    Since the output file and the cache can be the same file, an output file must be deleted before it's written again.
+
+"""
+
+################ Functions #################
+
+"""
+lookup(scene, file_format, manifest)
+
+    Gets the cache key of a scene.
+
+    Args:
+        scene (dict): The scene, from the scenes file.
+        file_format (str): The format of the exported file, like "local" or "HtmlDark".
+        manifest (dict): The channel manifest, to know the last message of scenes with no end.
+
+    Returns:
+        str: The key of the scene, or None if the scene can't be cached.
+"""
+def lookup(scene, file_format, manifest):
+
+    if scene.get("end"):
+        end = scene["end"]["id"]
+    else:
+        last_id = manifest.get(scene["channelId"], {}).get("lastMessageId")
+        end = f"open-{last_id}" if last_id is not None else None
+
+    if end is None:
+        return None
+
+    return os.path.join(c.SCENE_CACHE, file_format, scene["channelId"], f"{scene['start']['id']}-{end}.html")
+
+"""
+link(source, destination)
+
+    Makes 'destination' the same file as 'source' with a hardlink, or copies it if hardlinks aren't possible.
+    If 'destination' already exists, it's replaced.
+
+"""
+def link(source, destination):
+
+    os.makedirs(os.path.dirname(destination) or ".", exist_ok=True)
+    temporary = f"{destination}.tmp"
+
+    try:
+        os.link(source, temporary)
+
+    except OSError:
+        shutil.copyfile(source, temporary)
+
+    os.replace(temporary, destination)
+
+"""
+fetch(key, output_path)
+
+    Copies a cached scene to the output folder.
+
+    Returns:
+        bool: True if the scene was in the cache, False if it has to be exported.
+"""
+def fetch(key, output_path):
+
+    if key is None or not os.path.exists(key):
+        return False
+
+    link(key, output_path)
+
+    return True
+
+"""
+store(key, file_path, scene)
+
+    Adds an exported scene to the cache.
+
+    If the scene has no end, the older versions of it, with the same start but an older last message, are removed.
+    Ended scenes with the same start are kept.
+
+"""
+def store(key, file_path, scene):
+
+    if key is None:
+        return
+
+    folder, name = os.path.split(key)
+    open_prefix = f"{scene['start']['id']}-open-"
+
+    if not scene.get("end") and os.path.isdir(folder):
+        for entry in os.scandir(folder):
+            if entry.name.startswith(open_prefix) and entry.name != name:
+                os.remove(entry.path)
+
+    link(file_path, key)
+
+"""
+prepare(output_path)
+
+    Deletes an output file before it's written again, so the cached scene it may be linked to stays as it is.
+
+"""
+def prepare(output_path):
+
+    if os.path.exists(output_path):
+        os.remove(output_path)
+
+
+if __name__ == "__main__":
+    print("\nThis module is not intended to be run directly.\n")
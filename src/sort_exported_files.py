@@ -2,6 +2,11 @@ import os
 import re
 import tricks as t
 import exceptions as exc
+import tracing
+import backup_state as bs
+import file_layout as fl
+import message_index as mi
+import backup_manifest as bm
 t.set_path()
 from res import constants as c
 
@@ -10,20 +15,19 @@ from res import constants as c
 """
 
 'export_channels' can numerate categories just fine, but not channels or threads.
-This module renames the exported JSON files to reflect channel positions inside the category.
+This module gives the channel and thread files of the backup their position inside the category.
 
 This module is meant to be run after `src/export_channels.py`. It will assume the backup folder contains the channels of backup_info.json.
 
 Main function: sort_exported_files(base_folder)
 
-    This script first goes through the backup folder and analyzes the current order of channels.
-    It substitutes the global position index for a local (category-based) position index, and updates the backup_info.json with this new info.
+    The exports are already written with their final names, calculated from the list of channels before exporting (see file_layout).
+    This script records the positions and paths of the channels and threads in backup_info.json.
 
-    Then, it cleans up the filenames from the old position numbers.
+    If channels were added, moved or renamed since the last backup, the files of the main backup are renamed once to their new paths,
+    so the update can be merged into them, and the message index is updated with the new paths.
 
-    Lastly, it goes through the backup folder and renames the JSON files to reflect the localized positions.
-
-    Note: It fails if the channel files don't match the 'export_channels' format.
+    Backups made before the layout manifest existed are found by the name of their files the first time.
 
     Args:
         base_folder (str): The base folder where the exported JSON files are stored.
@@ -55,132 +59,84 @@ def check_base_status():
     try: 
         t.log("debug", "\nChecking the status of the backup...")
 
-        backup_info = t.load_from_json(c.BACKUP_INFO)
+        bs.acquire("sort_exported_files")
+        state = bs.load_state()
 
         t.log("debug", "  Loaded the status file\n")
 
-        if backup_info["status"] == "running":
-            raise exc.AlreadyRunningError("The export is still running in another process. Exiting...")
-        
-        t.log("debug", f"  The current status of the backup is '{backup_info["status"]}'\n")
+        t.log("debug", f"  The current status of the backup is '{state["status"]}'\n")
 
-        if backup_info["steps"]["downloadStatus"] != "success":
+        if state["steps"]["downloadStatus"] != "success":
             raise exc.DataNotReadyError("There is no data to sort. Ensure the backup downloaded successfully and try again.")
-        
-    except (exc.AlreadyRunningError, exc.DataNotReadyError) as e:
-        raise e
-    
-    except Exception as e:
-        raise exc.FileSortingError("The export status file could not be read") from e
-    
-    finally:
-        return backup_info["status"]
-
-"""
-check_read_status()
-
-    Checks the status file, and raises exceptions if the backup file names are not ready to be read.
-
-    Args:
-        backup_info (dict): The channel list dictionary which contains the status of the backup.
-
-"""
-def check_read_status(backup_info):
-
-    try: 
-        t.log("debug", "\n  Checking the status of the backup to read file order...")
 
-        if backup_info["status"] == "running":
-            raise exc.AlreadyRunningError("The program is still running in another process. Exiting...")
-        
-        if backup_info["steps"]["sortingCleanStatus"] == "failed" or backup_info["steps"]["sortingWriteStatus"] == "failed":
-            raise exc.DataNotReadyError("Filenames may have been partially cleaned of position numbers. Exiting...")
+        return state["status"]
 
-        if backup_info["steps"]["sortingCleanStatus"] == "success" and backup_info["steps"]["sortingWriteStatus"] != "success":
-            raise exc.AlreadyRunningError("Filenames have been cleaned of position numbers. Skipping...")
-        
     except (exc.AlreadyRunningError, exc.DataNotReadyError) as e:
         raise e
     
     except Exception as e:
         raise exc.FileSortingError("The export status file could not be read") from e
 
-
 """
-check_clean_status()
-
-    Checks the status file, and raises exceptions if the backup file names are not ready to be cleaned.
+index_folder(folder)
 
-    Args:
-        backup_info (dict): The channel list dictionary which contains the status of the backup.
+    Indexes the channel files of a folder by their normalized name, without the position number, in one pass.
 
-"""
-def check_clean_status(backup_info):
+    If two files have the same normalized name, only the first one in alphabetical order is indexed,
+    and the collision is reported, since the channel could be matched to the wrong file.
 
-    try: 
-        t.log("debug", "\n  Checking the status of the backup to clean file order...")
-
-        if backup_info["status"] == "running":
-            raise exc.AlreadyRunningError("The program is still running in another process. Exiting...")
-        
-        if backup_info["steps"]["sortingReadStatus"] != "success":
-            raise exc.DataNotReadyError("Filenames were not read correctly. Ensure the reading process completed successfully and try again.")
+    Args:
+        folder (str): The folder to index.
 
-        if backup_info["steps"]["sortingCleanStatus"] == "success" and backup_info["steps"]["sortingWriteStatus"] != "success":
-            raise exc.AlreadyRunningError("Filenames have been cleaned of position numbers. Skipping...")
-        
-    except (exc.AlreadyRunningError, exc.DataNotReadyError) as e:
-        raise e
-    
-    except Exception as e:
-        raise exc.FileSortingError("The export status file could not be read") from e
+    Returns:
+        dict: The actual filename and the position number (or None) of each channel file, by normalized name.
 
 """
-check_write_status()
+def index_folder(folder):
 
-    Checks the status file, and raises exceptions if the backup file names are not ready to be written.
+    folder_index = {}
+    collisions = {}
 
-    Args:
-        backup_info (dict): The channel list dictionary which contains the status of the backup.
+    for entry in sorted(os.scandir(folder), key=lambda x: x.name):
 
-"""
-def check_write_status(backup_info):
+        if not entry.is_file() or not entry.name.endswith(".json") or entry.name.endswith("scenes.json"):
+            continue
 
-    try: 
-        t.log("debug", "\n  Checking the status of the backup to write file order...")
+        # remove the position tag if it has it
+        position, separator, name = os.path.splitext(entry.name)[0].partition("# ")
 
-        if backup_info["status"] == "running":
-            raise exc.AlreadyRunningError("The program is still running in another process. Exiting...")
-        
-        if backup_info["steps"]["sortingCleanStatus"] != "success":
-            raise exc.DataNotReadyError("Filenames were not cleaned correctly. Ensure the cleaning process ran and try again.")
+        if not separator:
+            position, name = None, position
 
-        if backup_info["steps"]["sortingCleanStatus"] == "success" and backup_info["steps"]["sortingWriteStatus"] != "pending":
-            raise exc.DataNotReadyError("Filenames have already been numbered. Clean them again if you want to re-do it.")
+        normalized_name = super_normalize(name)
 
+        if normalized_name in folder_index:
+            collisions.setdefault(normalized_name, [folder_index[normalized_name][0]]).append(entry.name)
+            continue
 
-    except (exc.AlreadyRunningError, exc.DataNotReadyError) as e:
-        raise e
-    
-    except Exception as e:
-        raise exc.FileSortingError("The export status file could not be read") from e
+        folder_index[normalized_name] = (entry.name, int(position) if position is not None and position.isdigit() else None)
+
+    t.log("debug", "\t    Found %d files in %s", len(folder_index), folder)
 
+    for normalized_name, filenames in collisions.items():
+        t.log("info", f"\t{t.YELLOW}  These files in {folder} have the same name '{normalized_name}', only the first one is used: {', '.join(filenames)}")
 
+    return folder_index
 
 """
-find_channel_file(folder, target_name)
+find_channel_file(folder_index, target_name)
 
-    Finds a channel file in the specified folder that matches the target name.
+    Finds the channel file in a folder index that matches the target name.
 
     Args:
-        folder (str): The folder to search in.
+        folder_index (dict): The index of the folder to search in, from index_folder.
         target_name (str): The target name to search for.
 
     Returns:
         str: The actual filename of the matching channel file, or None if not found.
 
 """
-def find_channel_file(folder, target_name):
+def find_channel_file(folder_index, target_name):
 
     # remove the position tag if it has it
     try:
@@ -188,402 +144,135 @@ def find_channel_file(folder, target_name):
     except IndexError:
         target = target_name
 
-    normalized_target = super_normalize(target)
+    entry = folder_index.get(super_normalize(target))
 
-    for filename in os.listdir(folder):
-        if filename.endswith(".json") and not filename.endswith("scenes.json"):
-            
-            file_name = os.path.splitext(filename)[0]
-            try:
-                file = file_name.split("# ")[1]
-            except IndexError:
-                file = file_name
-
-            if super_normalize(file) == normalized_target:
-                return filename  # Return actual filename with full characters
-            
-    return None
+    return entry[0] if entry is not None else None
 
 """
-get_file_dictionary(folder)
+find_legacy_paths(base_folder, backup_info)
 
-    Gets all filenames in the specified folder, sorts them, and returns them as a dictionary.
+    Finds the files of a backup made before the layout manifest existed, by the name of their category, channel and thread.
 
     Args:
-        folder (str): The folder to search in.
+        base_folder (str): The folder of the backup.
+        backup_info (dict): The list of channels.
 
     Returns:
-        dict: A dictionary of file names and their position numbers.
-
+        dict: The path of each channel and thread file found, relative to the backup folder, by ID.
 """
-def get_file_dictionary(folder):
-
-    # get a list of file names
-    file_names = [f.name for f in os.scandir(folder) if f.is_file()]
-    t.log("debug", f"\t    Found {len(file_names)} files in {folder}")
-
-    file_dict = {}
-
-    for file in file_names:
-        # get number# from the filename
-        if not file.endswith("scenes.json"):
-            channel_position, channel_name = file.split("# ")
-            norm_channel_name = super_normalize(channel_name.split(".js")[0])
-            file_dict[norm_channel_name] = int(channel_position)
+def find_legacy_paths(base_folder, backup_info):
 
-    # sort dictionary by value
-    sorted_dict = {k: v for k, v in sorted(file_dict.items(), key=lambda item: item[1])}
-
-    # renumber the dictionary
-    for index, (key, value) in enumerate(sorted_dict.items(), start=1):
-        sorted_dict[key] = index
-
-    # print the sorted dictionary to the log
-    for key, value in sorted_dict.items():
-        t.log("log", f"\t  {key}: {value}")
-
-    return sorted_dict
-
-"""
-sort_threads_in_channel(threads, search_folder=None)
+    paths = {}
 
-    In DCE, threads can only be sorted by alphabetical order.
-    This method opens thread files to get their date of creation, 
-    and sorts them by channel and then by date.
+    if not os.path.isdir(base_folder):
+        return paths
 
-    Args:
-        threads (list): The list of threads to be sorted.
-        search_folder (str, optional): The folder to search in.
+    # the category folders have a position that may have changed, so they are found by name too
+    category_folders = {}
 
-"""
-def sort_threads_in_channel(threads, search_folder=c.SEARCH_FOLDER):
+    for entry in sorted(os.scandir(base_folder), key=lambda x: x.name):
+        if entry.is_dir():
+            category_folders.setdefault(super_normalize(entry.name.partition("# ")[2] or entry.name), entry.name)
 
-    max = 1
+    for category in backup_info["categories"]:
 
-    for thread in threads:
+        folder_name = category_folders.get(super_normalize(category["category"].replace(":", "_")))
 
-        # get the date of the first message
-        file_path = os.path.join(search_folder, thread["path"])
-        data = t.load_from_json(file_path)
-        thread["date"] = data["messages"][0]["timestamp"]
+        if folder_name is None:
+            continue
 
-        # get the largest value of "position" in the list
-        if thread["position"] > max:
-            max = thread["position"]
+        folder = os.path.join(base_folder, folder_name)
+        folder_index = index_folder(folder)
+        threads_index = index_folder(os.path.join(folder, "Threads")) if os.path.isdir(os.path.join(folder, "Threads")) else {}
 
-    # sort the list by position, then by timestamp
-    threads.sort(key=lambda x: (x["position"], x["date"]))
+        for channel in category["channels"]:
+            filename = find_channel_file(folder_index, channel["channel"])
+            if filename is not None:
+                paths[channel["id"]] = f"{folder_name}/{filename}"
 
-    # for each position (associated with a channel), assing thread positions
-    for i in range(1, max+1):
+        for thread in category["threads"]:
+            filename = find_channel_file(threads_index, thread["thread"])
+            if filename is not None:
+                paths[thread["id"]] = f"{folder_name}/Threads/{filename}"
 
-        threadPos = 1
-        
-        # find the first thread with position i
-        for thread in threads:
-            if thread["position"] == i:
-                thread["threadPosition"] = threadPos
-                threadPos += 1
+    t.log("info", f"\tFound {len(paths)} files of a backup made before the layout manifest existed")
 
-                #remove date
-                thread.pop("date")
+    return paths
 
 """
-read_order_in_category(category, search_folder, backup_info)    
-
-    In a category folder, it goes through the channel filenames and writes down the actual position numbers.
-    If this is executed right after `export_channels`, the numbers should be the global position index.
-    Then, it replaces those numbers by a localized index for each category, maintaining the order of channels.
+record_layout(backup_info, layout)
 
-    To finish, it reorders the threads in each channel, and assigns them a thread position.
-
-    Args:
-        category (dict): The category dictionary which contains the status of the backup.
-        search_folder (str): The folder to search in.
-        backup_info (dict): The channel list dictionary which contains the status of the backup.
+    Writes the position and the path of each channel and thread in the list of channels,
+    and sorts the channels and threads of each category by position.
 
 """
-def read_order_in_category(category, search_folder, backup_info):
-    
-    folder_name = category["category"].replace(":", "_")
-    folder = os.path.join(search_folder, f"{category['position']}# {folder_name}")
-    t.save_to_json(backup_info, c.BACKUP_INFO)
-        
-    t.log("debug", f"\n\t  Analyzing current order in {folder}... ###")
-
-    # get the filenames and sort them
-    sorted_dict = get_file_dictionary(folder)
-
-    t.log("debug", f"\n\t  Sorted the dictionary of files in {folder}\n")
-    
-    for channel in category["channels"]:
-        channel["position"] = sorted_dict[super_normalize(channel["channel"])]
-        channel["path"] = f"{category['position']}# {folder_name}\\{find_channel_file(folder, channel["channel"])}"
-        t.log("log", f"\tFound channel: {channel['position']}# {channel['channel']}")
-    
-    # sort channels by position
-    category["channels"] = sorted(category["channels"], key=lambda x: x["position"])
+def record_layout(backup_info, layout):
 
-    for thread in category.get("threads", []):
-        thread["position"] = sorted_dict[super_normalize(thread["channel"])]
-        thread["path"] = f"{category['position']}# {folder_name}\\Threads\\{find_channel_file(folder+"/Threads", thread["thread"])}"
-        t.log("log", f"\tFound thread: {thread['position']}-{thread['threadPosition']}# {thread['thread']}")
+    for category in backup_info["categories"]:
 
-    sort_threads_in_channel(category.get("threads", []), search_folder)
+        for channel in category["channels"] + category["threads"]:
+            channel.update(layout[channel["id"]])
 
-    # sort threads by position then threadPosition
-    category["threads"] = sorted(category["threads"], key=lambda x: (x["position"], x["threadPosition"]))
+        category["channels"].sort(key=lambda x: x["position"])
+        category["threads"].sort(key=lambda x: (x["position"], x["threadPosition"]))
 
-    t.save_to_json(backup_info, c.BACKUP_INFO)
 
-"""
-read_order_from_files(search_folder, main_status)
-
-    Analyzes the current order of channel files in the specified folder.
-    
-    Reads the order of the files in each category folder, and assigns them a position.
-
-    The backup_info structure is updated to reflect the new positions.
-
-    Args:
-        search_folder (str): The folder to search in.
-        main_status (str): The main status of the backup.
-
-"""
-def read_order_from_files(search_folder, main_status):
+################# Main function #################
 
-    t.log("info", f"\n\tReading the current file order in {search_folder}...\n")
+@tracing.traced("step")
+def sort_exported_files(base_folder=c.SEARCH_FOLDER):
 
-    try:
-        backup_info = t.load_from_json(c.BACKUP_INFO)
+    t.log("base", f"\n###  Sorting channel files in {base_folder}...  ###\n")
 
-        check_read_status(backup_info)
+    main_status = "failed"
+    steps = {"sortingWriteStatus": "failed"}
 
-    # If "clean" has already been run, there will be nothing to read,  so we can skip
-    except exc.AlreadyRunningError as e:
-        t.log("debug", f"\t  {e}\n")
-        return
-    
     try:
+        main_status = check_base_status()
 
-        # flag it as running in case another execution of the script is launched
-        backup_info["status"] = "running"
-        backup_info["steps"]["sortingReadStatus"] = "running"
-        t.save_to_json(backup_info, c.BACKUP_INFO)
-
-        # For each category in the channel list
-        for category in backup_info["categories"]:
-
-            read_order_in_category(category, search_folder, backup_info)
-
-        backup_info["steps"]["sortingReadStatus"] = "success"
-        backup_info["steps"]["sortingCleanStatus"] = "pending"
-        backup_info["status"] = main_status
-    
-    except Exception as e:
-        backup_info["status"] = "failed"
-        backup_info["steps"]["sortingReadStatus"] = "failed"
-        
-        raise exc.FileSortingReadError(f"An error occurred while reading the current order in {search_folder}") from e
-
-    finally:
-        try:
-            t.log("info", "\n\tFinished analyzing current order\n")
-            t.save_to_json(backup_info, c.BACKUP_INFO)
-
-        except Exception as e:
-            t.log("error", f"\tFailed to save the list of channels: {e}\n")
-
-"""
-remove_order_from_files(search_folder)
-
-    Removes the position number from the filenames of the channel files in the specified folder.
-
-    Args:
-        search_folder (str): The folder to search in.
-
-"""
-def remove_order_from_files(search_folder):
-
-    # function to clean the filenames
-    def clean_filename(item):
-        # separate path from filename
-        folder, filename = os.path.split(item["path"])
-
-        t.log("log", f"\t  Cleaning {filename}...")
-
-        root = os.path.join(search_folder, folder)
-
-        # remove 'number#' from the filename
-        new_filename = filename.split("# ")[1]
-        src = os.path.join(root, filename)
-        dst = os.path.join(root, new_filename)
-        os.rename(src, dst)
-        item["path"] = os.path.join(folder, new_filename)
+        # flag it as running in case the process is interrupted
+        bs.update_state(status="running", steps={"sortingWriteStatus": "running"})
 
-    t.log("info", f"\n\tCleaning up position numbers in the filenames of {search_folder}...\n")
-    
-    try:
         backup_info = t.load_from_json(c.BACKUP_INFO)
 
-        check_clean_status(backup_info)
-
-    # If "clean" has already been run, there will be nothing to clean, so we can skip
-    except exc.AlreadyRunningError as e:
-        t.log("debug", f"\t  {e}\n")
-        return
-    
-    try:
-        # flag it as running in case another execution of the script is launched
-        backup_info["status"] = "running"
-        backup_info["steps"]["sortingCleanStatus"] = "running"
-        t.save_to_json(backup_info, c.BACKUP_INFO)
-
-        # Iterate over all categories
-        for category in backup_info["categories"]:
-
-            for channel in category["channels"]:
-                clean_filename(channel)
-            
-            for thread in category["threads"]:
-                clean_filename(thread)
-            
-            t.save_to_json(backup_info, c.BACKUP_INFO)
-   
-
-        backup_info["status"] = "pending"
-        backup_info["steps"]["sortingCleanStatus"] = "success"
-        backup_info["steps"]["sortingWriteStatus"] = "pending"
-    
-    except Exception as e:
-        backup_info["status"] = "failed"
-        backup_info["steps"]["sortingCleanStatus"] = "failed"
-        backup_info["steps"]["sortingWriteStatus"] = "pending"
-        
-        raise exc.FileSortingCleanError(f"An error occurred while cleaning the current order in {search_folder}") from e
-
-    finally:
-        try:
-            t.log("info", f"\n\tFinished cleaning up position numbers from channel files\n")
-            t.save_to_json(backup_info, c.BACKUP_INFO)
-
-        except Exception as e:
-            t.log("error", f"\tFailed to save the status file: {e}\n")
-
-"""
-write_order_to_files(search_folder, main_status)
-
-    Writes the position number to the filenames of the channel files in the specified folder.
-
-    Args:
-        search_folder (str): The folder to search in.
-        main_status (str): The main status of the program.
-
-"""
-
-def write_order_to_files(search_folder, main_status):
-
-    # function to write into channels
-    def rename_file(item):
-
-         # separate path from filename
-        folder, filename = os.path.split(item["path"])
-
-        root = os.path.join(search_folder, folder)
+        layout = fl.plan_layout(backup_info)
 
-        # add 'number#' from the filename
-        # if item has ["threadPosition"] is a thread
-        if "threadPosition" in item:
-            new_filename = f"{item["position"]}-{item['threadPosition']}# {filename}"
-        else:
-            new_filename = f"{item["position"]}# {filename}"
+        # rename the files of the main backup whose channel changed, so the update can be merged into them
+        layout_manifest = fl.load_layout()
 
-        src = os.path.join(root, filename)
-        dst = os.path.join(root, new_filename)
-        os.rename(src, dst)
-        item["path"] = os.path.join(folder, new_filename)
+        if not layout_manifest["paths"]:
+            layout_manifest["paths"] = find_legacy_paths(c.SERVER_NAME, backup_info)
 
-        t.log("log", f"\tRenamed file: {filename} → {new_filename}")
+        moves = fl.move_files(c.SERVER_NAME, layout_manifest, {channel_id: entry["path"] for channel_id, entry in layout.items()})
 
+        if moves:
+            t.log("info", f"\tRenamed {len(moves)} files of the main backup to their new position")
 
+            if os.path.exists(c.MESSAGE_INDEX):
+                index = mi.load_index()
+                mi.rename_files(index, moves)
+                mi.save_index(index)
 
-    t.log("info", f"\n\tWriting channel order to files in {search_folder}...\n")
+            if os.path.exists(c.BACKUP_MANIFEST):
+                with bm.open_manifest() as manifest:
+                    bm.rename_files(manifest, moves, c.SERVER_NAME)
 
-    try:
-        backup_info = t.load_from_json(c.BACKUP_INFO)
-
-        check_write_status(backup_info)
-
-    # If "write" has already been run, there will be nothing to write, so we can skip
-    except exc.AlreadyRunningError as e:
-        t.log("debug", f"\t  {e}\n")
-        return
-    
-    try:
-        # flag it as running in case another execution of the script is launched
-        backup_info["status"] = "running"
-        backup_info["steps"]["sortingWriteStatus"] = "running"
+        record_layout(backup_info, layout)
         t.save_to_json(backup_info, c.BACKUP_INFO)
 
-        # For each category in the channel list
-        for category in backup_info["categories"]:
-
-            t.log("info", f"\n  Sorting '{category["category"]}'...")
-
-            t.log("info", f"    Renaming {category["numberOfChannels"]} channel files...")
-
-            # Rename channel files
-            for channel in category["channels"]:
-
-                rename_file(channel)
+        steps = {"sortingReadStatus": "success", "sortingCleanStatus": "success", "sortingWriteStatus": "success"}
 
-            t.log("info", f"    Renaming {category['numberOfThreads']} thread files...")
-
-            for thread in category.get("threads", []):
-
-                rename_file(thread)
-            
-            t.save_to_json(backup_info, c.BACKUP_INFO)
-
-
-        backup_info["steps"]["sortingWriteStatus"] = "success"
-        backup_info["status"] = main_status
-    
     except Exception as e:
-        backup_info["status"] = "failed"
-        backup_info["steps"]["sortingWriteStatus"] = "failed"
-        
-        raise exc.FileSortingWriteError(f"An error occurred while reading the current order in {search_folder}") from e
+        main_status = "failed"
+        raise exc.FileSortingError(f"An error occurred while sorting channel files in {base_folder}:") from e
 
     finally:
         try:
-            t.log("info", "\n\tFinished writing channel order to files\n")
-            t.save_to_json(backup_info, c.BACKUP_INFO)
+            bs.finish(steps, main_status)
 
         except Exception as e:
             t.log("error", f"\tFailed to save the status file: {e}\n")
 
-
-################# Main function #################
-
-def sort_exported_files(base_folder=c.SEARCH_FOLDER):
-
-    t.log("base", f"\n###  Sorting channel files in {base_folder}...  ###\n")
-
-    try:
-
-        main_status = check_base_status()
-
-        read_order_from_files(base_folder, main_status)
-
-        remove_order_from_files(base_folder)
-
-        write_order_to_files(base_folder, main_status)
-    
-    except Exception as e:
-        raise exc.FileSortingError(f"An error occurred while sorting channel files in {base_folder}:") from e
-
-    finally:
         t.log("base", f"### Finished sorting files ###\n")
 
 
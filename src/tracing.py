@@ -0,0 +1,250 @@
+import datetime
+import functools
+import json
+import multiprocessing
+import os
+import time
+from contextlib import contextmanager
+import tricks as t
+t.set_path()
+from res import constants as c
+
+################ File summary #################
+
+"""
+
+This module records how long each part of the pipeline takes.
+
+Main function: summarize(trace_file)
+
+    Every step, category and channel file that the pipeline processes is wrapped in a span.
+    Spans are nested (pipeline run → step → category → channel file), and each one records its duration,
+    the number of messages it went through, the bytes it read and wrote, the scenes it found,
+    and the exports that stalled and had to be killed.
+    Counters are added up to the parent span when a span finishes.
+
+    Finished spans are appended to TRACE_FILE as JSON lines, if the TRACE flag is set.
+    Worker processes don't write their spans: they send them back, and the main process records them with record().
+
+    The summary lists the slowest steps and channels of the last run in the trace file.
+
+"""
+
+################ Functions #################
+
+COUNTERS = ("messages", "bytesRead", "bytesWritten", "scenes", "stalls")
+
+_stack = []
+_trace_file = None
+_run = None
+_next_id = 1
+
+
+def write_span(record):
+    global _trace_file
+
+    if not c.TRACE or multiprocessing.parent_process() is not None:
+        return
+
+    if _trace_file is None:
+
+        # create directory if it doesn't exist
+        if not os.path.exists(os.path.dirname(c.TRACE_FILE)):
+            os.makedirs(os.path.dirname(c.TRACE_FILE))
+
+        _trace_file = open(c.TRACE_FILE, "a", encoding="utf-8")
+
+    _trace_file.write(json.dumps(record) + "\n")
+
+    # close the file when the outermost span finishes
+    if not _stack:
+        _trace_file.close()
+        _trace_file = None
+
+"""
+span(name, kind, **attributes)
+
+    Context manager that records a span around a block of code.
+
+    Args:
+        name (str): The name of the span, like the step function or the channel file.
+        kind (str): The level of the span (run, step, category, channel).
+        attributes (optional): Other values to save with the span, like the path of a file.
+
+    Yields:
+        dict: The span record. Counters can also be updated with add().
+"""
+@contextmanager
+def span(name, kind, **attributes):
+    global _run, _next_id
+
+    if not _stack:
+        _run = datetime.datetime.now().astimezone().isoformat(timespec="microseconds")
+
+    record = {
+        "run": _run,
+        "id": _next_id,
+        "parent": _stack[-1]["id"] if _stack else None,
+        "kind": kind,
+        "name": name,
+        "start": datetime.datetime.now().astimezone().isoformat(timespec="milliseconds"),
+        "duration": 0,
+        "status": "success",
+        **{counter: 0 for counter in COUNTERS},
+        **attributes
+    }
+    _next_id += 1
+
+    _stack.append(record)
+    start_time = time.perf_counter()
+
+    try:
+        yield record
+
+    except BaseException:
+        record["status"] = "failed"
+        raise
+
+    finally:
+        record["duration"] = round(time.perf_counter() - start_time, 4)
+        _stack.pop()
+
+        # add the counters up to the parent
+        if _stack:
+            for counter in COUNTERS:
+                _stack[-1][counter] += record[counter]
+
+        write_span(record)
+
+"""
+record(name, kind, duration, **attributes)
+
+    Records a span that has already finished, as a child of the current span.
+    Useful for work that doesn't fit in a block of code, like exports running at the same time.
+
+    Args:
+        name (str): The name of the span.
+        kind (str): The level of the span (run, step, category, channel).
+        duration (float): How long it took, in seconds.
+        attributes (optional): Counters and other values to save with the span.
+
+"""
+def record(name, kind, duration, **attributes):
+    global _next_id
+
+    finished = {
+        "run": _run,
+        "id": _next_id,
+        "parent": _stack[-1]["id"] if _stack else None,
+        "kind": kind,
+        "name": name,
+        "start": (datetime.datetime.now().astimezone() - datetime.timedelta(seconds=duration)).isoformat(timespec="milliseconds"),
+        "duration": round(duration, 4),
+        "status": "success",
+        **{counter: 0 for counter in COUNTERS},
+        **attributes
+    }
+    _next_id += 1
+
+    if _stack:
+        for counter in COUNTERS:
+            _stack[-1][counter] += finished[counter]
+
+    write_span(finished)
+
+"""
+traced(kind)
+
+    Decorator that records a span around each call of a function, named after the function.
+
+"""
+def traced(kind="step"):
+
+    def decorator(function):
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(function.__name__, kind):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+"""
+add(**counts)
+
+    Adds to the counters of the current span. Does nothing if there is no span open.
+
+    Example:
+        tracing.add(messages=120, scenes=3)
+"""
+def add(**counts):
+
+    if not _stack:
+        return
+
+    for counter, value in counts.items():
+        _stack[-1][counter] = _stack[-1].get(counter, 0) + value
+
+"""
+load_trace(trace_file, run)
+
+    Loads the spans of a run from the trace file.
+
+    Args:
+        trace_file (str): The path to the trace file.
+        run (str, optional): The run to load. Defaults to the last one in the file.
+
+    Returns:
+        list: The spans of the run.
+"""
+def load_trace(trace_file=c.TRACE_FILE, run=None):
+
+    spans = []
+
+    with open(trace_file, "r", encoding="utf-8") as file:
+        for line in file:
+            if line.strip():
+                spans.append(json.loads(line))
+
+    if run is None and spans:
+        run = spans[-1]["run"]
+
+    return [record for record in spans if record["run"] == run]
+
+
+def format_span(record):
+    return (f"{record['duration']:>10.2f}s  {record['name']:<50.50}  {record['messages']:>9} messages"
+            f"  {record['bytesRead'] / 1024 / 1024:>9.2f} MB read  {record['bytesWritten'] / 1024 / 1024:>9.2f} MB written"
+            f"  {record['scenes']:>6} scenes" + (f"  {record['stalls']} stalls" if record.get("stalls") else ""))
+
+
+################ Main function #################
+
+def summarize(trace_file=c.TRACE_FILE, top=10, run=None):
+
+    spans = load_trace(trace_file, run)
+
+    if not spans:
+        t.log("error", f"There are no spans in {trace_file}")
+        return
+
+    t.log("base", f"\n## Summary of the run started at {spans[0]['run']} ##\n")
+
+    for kind in ("run", "step", "category", "channel"):
+
+        kind_spans = sorted((record for record in spans if record["kind"] == kind), key=lambda x: x["duration"], reverse=True)
+
+        if not kind_spans:
+            continue
+
+        t.log("base", f"\n  Slowest {kind} spans ({len(kind_spans)} in total):\n")
+
+        for record in kind_spans[:top]:
+            failed = f"  {t.RED}(failed){t.GREEN}" if record["status"] == "failed" else ""
+            t.log("base", f"\t{format_span(record)}{failed}")
+
+
+if __name__ == "__main__":
+    summarize()
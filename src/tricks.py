@@ -1,10 +1,13 @@
+import asyncio
+import atexit
 import datetime
 import sys
 import os
 import subprocess
 import json
 import re
-import inspect
+import time
+from multiprocessing.util import Finalize
 import exceptions as exc
 from collections import deque
 
@@ -38,85 +41,309 @@ def set_path():
         sys.path.append(project_root)
 
 """
-save_to_json(data, file_path), load_from_json(file_path)
+save_to_json(data, file_path, compact), load_from_json(file_path)
 
     Functions to read and write a JSON file.
+    Big files that no one reads by hand, like the message index, can be saved compact, without indentation or spaces.
+    The size of the file is added to the current tracing span, if there is one.
     
 """
 def load_from_json(file_path):
     with open(file_path, "r", encoding="utf-8") as file:
-        return json.load(file)
+        data = json.load(file)
 
+    record_io(bytesRead=os.path.getsize(file_path))
+    return data
 
-def save_to_json(data, file_path):
+
+def save_to_json(data, file_path, compact=False):
     with open(file_path, "w", encoding="utf-8") as file:
-        json.dump(data, file, indent=4)
+        if compact:
+            json.dump(data, file, separators=(",", ":"))
+        else:
+            json.dump(data, file, indent=4)
+
+    record_io(bytesWritten=os.path.getsize(file_path))
+
+"""
+record_io(**counts)
+
+    Adds the bytes read or written to the current tracing span.
+    The tracing module is only used if some other module imported it, so there's no cost otherwise.
+
+"""
+def record_io(**counts):
+    tracing = sys.modules.get("tracing")
+
+    if tracing is not None:
+        tracing.add(**counts)
+
+"""
+snowflake_to_datetime(snowflake), datetime_to_snowflake(moment)
 
+    Functions to convert between Discord IDs and dates.
+    Discord IDs (snowflakes) start with the milliseconds since the Discord epoch, so they grow with time.
+    The smallest ID of a date has all the other bits set to 0.
+
+"""
+DISCORD_EPOCH = 1420070400000
+
+def snowflake_to_datetime(snowflake):
+    return datetime.datetime.fromtimestamp(((int(snowflake) >> 22) + DISCORD_EPOCH) / 1000, datetime.timezone.utc)
+
+
+def datetime_to_snowflake(moment):
+    return str(max(0, int(moment.timestamp() * 1000) - DISCORD_EPOCH) << 22)
 
 
+"""
+    This regex pattern matches ANSI escape sequences.
+
+"""
+ansi_escape = re.compile(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])')
+
 """
 clean(message)
 
     Function to remove ANSI escape sequences from a string and remove leading and trailing newlines.
 """
 def clean(message):
-    ansi_escape = re.compile(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])')
     no_ansi = ansi_escape.sub('', message)
 
     return no_ansi.lstrip('\n').rstrip('\n')
 
 """
-log(level, message)
+Logger state
+
+    The constants module and the caller names are loaded once and cached.
+    The log file is opened once and kept open, and it's flushed every LOG_FLUSH_LINES lines,
+    every LOG_FLUSH_SECONDS seconds, on errors, and when the program exits.
+
+    Worker processes are forked with a copy of the logger. The pending lines are flushed before forking,
+    so a worker doesn't write them again, and each worker opens the log file again and writes every line right away,
+    since workers exit without running the exit handlers.
+
+"""
+LOG_FLUSH_LINES = 200
+LOG_FLUSH_SECONDS = 2
+
+_constants = None
+_caller_names = {}
+_log_file = None
+_log_pending = 0
+_log_flushed_at = 0
+_log_in_worker = False
+_console = None
+
+
+def get_constants():
+    global _constants
+
+    if _constants is None:
+        set_path()
+        from res import constants
+        _constants = constants
+
+    return _constants
+
+"""
+log_enabled(level)
+
+    Checks if a message of the given level would be printed or saved anywhere.
+    Useful to skip building expensive messages inside loops.
+
+    Args:
+        level (str): The level of the message (info, debug, console).
+
+    Returns:
+        bool: True if the message would be printed or saved to the log file.
+"""
+def log_enabled(level="base"):
+    c = get_constants()
+
+    if c.LOG:
+        return True
+
+    if level == "info":
+        return c.INFO
+    if level == "debug":
+        return c.DEBUG
+    if level == "console":
+        return c.CONSOLE
+
+    return level in ("base", "error")
+
+
+def open_log():
+    global _log_file, _log_flushed_at
+    c = get_constants()
+
+    # create directory if it doesn't exist
+    if not os.path.exists(os.path.dirname(c.LOG_FILE)):
+        os.makedirs(os.path.dirname(c.LOG_FILE))
+
+    _log_file = open(c.LOG_FILE, "a", encoding="utf-8")
+    _log_flushed_at = time.monotonic()
+
+    return _log_file
+
+"""
+flush_log(), close_log()
+
+    Functions to write the pending lines to the log file, and to close it.
+    The log file has to be closed before deleting or moving it.
+
+"""
+def flush_log():
+    global _log_pending, _log_flushed_at
+
+    if _log_file is not None:
+        _log_file.flush()
+
+    _log_pending = 0
+    _log_flushed_at = time.monotonic()
+
+
+def close_log():
+    global _log_file
+
+    if _log_file is not None:
+        flush_log()
+        _log_file.close()
+        _log_file = None
+
+
+"""
+reset_log_after_fork()
+
+    Forgets the log file of the parent process in a forked worker, so the worker opens its own.
+    The parent flushed it before forking, so nothing pending is lost or written twice.
+
+"""
+def reset_log_after_fork():
+    global _log_file, _log_pending, _log_in_worker
+
+    _log_file = None
+    _log_pending = 0
+    _log_in_worker = True
+
+atexit.register(close_log)
+Finalize(None, close_log, exitpriority=10)
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(before=flush_log, after_in_child=reset_log_after_fork)
+
+"""
+log_to_stderr()
+
+    Prints the messages to the standard error instead of the standard output,
+    so the standard output can be used for data, like a zip file.
+
+"""
+def log_to_stderr():
+    global _console
+
+    _console = sys.stderr
+
+"""
+log(level, message, *args)
 
     Centralized function to handle information messages.
     
     It prints the message if the corresponding flag is set in the constants module.
     It also writes the message to a log file if the LOG flag is set.
 
+    The level is checked before doing anything else, so a disabled message costs almost nothing.
+    If args are given, the message is formatted with them (printf-style) only when it's going to be used.
+
     Args:
         level (str): The level of the message (info, debug, console).
         message (str): The message to be logged.
+        args (optional): Values to format the message with.
 
 """
-def log(level="base", message=""):
-    set_path()
-    from res import constants as c
+def log(level="base", message="", *args):
+    global _log_pending
+    c = _constants or get_constants()
+
+    if level == "base" or level == "error":
+        show = True
+    elif level == "info":
+        show = c.INFO
+    elif level == "debug":
+        show = c.DEBUG
+    elif level == "console":
+        show = c.CONSOLE
+    else:
+        show = False
+
+    if not show and not c.LOG:
+        return
 
-    # Determine caller module
-    stack = inspect.stack()
-    caller_frame = stack[1]
-    caller_module = inspect.getmodule(caller_frame.frame)
-    caller_name = caller_module.__name__ if caller_module else None
+    if args:
+        message = message % args
+
+    # Determine caller module, once per calling function
+    code = sys._getframe(1).f_code
+    caller_name = _caller_names.get(code)
+    if caller_name is None:
+        caller_name = _caller_names[code] = sys._getframe(1).f_globals.get("__name__", "")
 
     # Prepend tab if not called from export_channels.py
     if caller_name != "export_channels":
         message = "\t" + message
 
-    if level == "base":
-        print(GREEN + message + RESET)
-    elif level == "info":
-        if c.INFO:
-            print(CYAN + message + RESET)
-    elif level == "debug":
-        if c.DEBUG:
-            print(BLUE + message + RESET)
-    elif level == "console":
-        if c.CONSOLE:
-            print(GRAY + message, end="")
-    elif level == "error":
-        print(RED + message + RESET)
+    if show:
+        if level == "base":
+            print(GREEN + message + RESET, file=_console)
+        elif level == "info":
+            print(CYAN + message + RESET, file=_console)
+        elif level == "debug":
+            print(BLUE + message + RESET, file=_console)
+        elif level == "console":
+            print(GRAY + message, end="", file=_console)
+        elif level == "error":
+            print(RED + message + RESET, file=_console)
     
     level = "console" if level == "consolelog" else level
     
     if c.LOG:
         timestamp = datetime.datetime.now().strftime("%H:%M:%S")
+
+        file = _log_file or open_log()
+        file.write(f"[{timestamp}]{level}: {clean(message)}\n")
+        _log_pending += 1
+
+        if _log_in_worker or level == "error" or _log_pending >= LOG_FLUSH_LINES or time.monotonic() - _log_flushed_at >= LOG_FLUSH_SECONDS:
+            flush_log()
+
+"""
+show_output_line(tail_buffer, line)
+
+    Shows a line of output of a console command.
+
+    If there is a tail buffer and the CONSOLE flag is set, the last lines are redrawn in place,
+    so the output of long commands doesn't flood the console. Otherwise, the line is just logged.
+
+    Args:
+        tail_buffer (deque): The last lines shown, or an empty deque to not use the tail display.
+        line (str): The line to show.
+"""
+def show_output_line(tail_buffer, line):
+    c = get_constants()
+
+    if tail_buffer.maxlen and c.CONSOLE:
+        # Clear previous lines (simulate dynamic overwrite)
+        print("\033[F" * len(tail_buffer), end="", file=_console)  # Move cursor up
+
+        tail_buffer.append(line)
         
-        # create directory if it doesn't exist
-        if not os.path.exists(os.path.dirname(c.LOG_FILE)):
-            os.makedirs(os.path.dirname(c.LOG_FILE))
+        for l in tail_buffer:
+            print(f">\t{l.strip():<80}", file=_console)  # Print line padded to overwrite
 
-        with open(c.LOG_FILE, "a", encoding="utf-8") as file:
-            file.write(f"[{timestamp}]{level}: {clean(message)}\n")
+        log("consolelog", f">\t{line}")
+    else:
+        log("console", f">\t{line}")
 
 """
 run_command(command: str, show_lines: int = 0)
@@ -131,8 +358,6 @@ run_command(command: str, show_lines: int = 0)
         tuple[int, str]: A tuple containing the return code and the full output.
 """
 def run_command(command: str, show_lines: int = None):
-    set_path()
-    from res import constants as c
 
     try:
         log("console", f"# RUNNING CONSOLE COMMAND #\n")
@@ -154,17 +379,7 @@ def run_command(command: str, show_lines: int = None):
             for line in process.stdout:
                 full_output.append(line)  # Collect output for return
 
-                if show_lines and c.CONSOLE:
-                    # Clear previous lines (simulate dynamic overwrite)
-                    print("\033[F" * len(tail_buffer), end="")  # Move cursor up
-
-                    tail_buffer.append(line)
-                    
-                    for l in tail_buffer:
-                        print(f">\t{l.strip():<80}")  # Print line padded to overwrite
-                        log("consolelog", f">\t{l}")
-                else:
-                    log("console", f">\t{line}")
+                show_output_line(tail_buffer, line)
                 
         except KeyboardInterrupt:
             log("base", f"{YELLOW}\nCommand interrupted by user.\n")
@@ -179,6 +394,184 @@ def run_command(command: str, show_lines: int = None):
         raise exc.ConsoleCommandError("An error occurred while running the command") from e
 
 
+"""
+run_commands(commands, concurrency, show_lines, on_result, group_limits, limiter, retry, stall_timeout)
+
+    Run several commands at the same time, stream their output in real time, and return the result of each one.
+
+    Commands are started without a shell, in the order of the list, and at most 'concurrency' of them run at once.
+    A new command starts as soon as a running one finishes.
+    The lines of all the commands are tagged and shown together in the same tail display.
+
+    Commands can also belong to a group with its own, lower limit. A command waiting for its group
+    doesn't take a slot, so other commands can run in the meantime.
+
+    A failed command can be run again: 'retry' is called with its result and the number of retries so far,
+    and returns how many seconds to wait before running it again, or None to give up.
+    Commands waiting to be retried don't take a slot either.
+
+    Commands that don't print anything for 'stall_timeout' seconds are killed, and can be retried the same way.
+
+    Args:
+        commands (list): A list of dictionaries with the arguments of each command ("args"),
+                         a tag to identify it ("tag"), like the ID of the channel being exported, and optionally a "group".
+        concurrency (int, optional): The maximum number of commands running at once.
+        show_lines (int, optional): The number of lines of the tail display.
+        on_result (function, optional): A function called with the result of each command as soon as it finishes.
+        group_limits (dict, optional): The maximum number of commands of each group running at once.
+        limiter (optional): An async context manager that limits the commands running at once, used instead of 'concurrency'.
+        retry (function, optional): A function that decides if a command has to be run again, and when.
+        stall_timeout (float, optional): The seconds without output after which a command is killed.
+
+    Returns:
+        list: A list of dictionaries, in the same order as the commands, with the "tag", the return "code",
+              the full "output" and the "duration" in seconds of the last run of each command,
+              whether it "stalled", and the number of "attempts".
+"""
+def run_commands(commands, concurrency=5, show_lines=None, on_result=None, group_limits=None, limiter=None, retry=None, stall_timeout=None):
+
+    try:
+        return asyncio.run(run_commands_async(commands, concurrency, show_lines, on_result, group_limits, limiter, retry, stall_timeout))
+
+    except KeyboardInterrupt:
+        log("base", f"{YELLOW}\nCommands interrupted by user.\n")
+        raise
+
+    except Exception as e:
+        raise exc.ConsoleCommandError("An error occurred while running the commands") from e
+
+
+async def run_commands_async(commands, concurrency=5, show_lines=None, on_result=None, group_limits=None, limiter=None, retry=None, stall_timeout=None):
+
+    semaphore = limiter if limiter is not None else asyncio.Semaphore(concurrency)
+    group_semaphores = {group: asyncio.Semaphore(limit) for group, limit in (group_limits or {}).items()}
+    tail_buffer = deque(maxlen=show_lines if show_lines else 0)
+
+    async def run_in_slot(command):
+        group_semaphore = group_semaphores.get(command.get("group"))
+        attempt = 0
+
+        while True:
+
+            # wait for the group first, so waiting commands don't take a slot
+            if group_semaphore is not None:
+                await group_semaphore.acquire()
+
+            try:
+                async with semaphore:
+                    result = await run_command_async(command["args"], command.get("tag", ""), tail_buffer, stall_timeout)
+
+            finally:
+                if group_semaphore is not None:
+                    group_semaphore.release()
+
+            delay = retry(result, attempt) if retry is not None else None
+
+            if delay is None:
+                break
+
+            attempt += 1
+            await asyncio.sleep(delay)
+
+        result["attempts"] = attempt + 1
+
+        if on_result is not None:
+            on_result(result)
+
+        return result
+
+    return await asyncio.gather(*(run_in_slot(command) for command in commands))
+
+"""
+run_command_async(args, tag, tail_buffer, stall_timeout)
+
+    Run a command without a shell, stream its output in real time, and return its result.
+    If the command is cancelled, the process is killed.
+
+    If 'stall_timeout' is set, the command is also killed when it doesn't print anything for that many seconds.
+    Any output counts, even progress bars that keep rewriting the same line.
+
+    Args:
+        args (list): The program to run and its arguments.
+        tag (str, optional): A tag to identify the lines of this command in the output.
+        tail_buffer (deque, optional): The tail display shared by all the running commands.
+        stall_timeout (float, optional): The seconds without output after which the command is considered stalled.
+
+    Returns:
+        dict: The "tag", the return "code", the full "output" and the "duration" in seconds of the command,
+              and whether it "stalled" and was killed.
+"""
+async def run_command_async(args, tag="", tail_buffer=None, stall_timeout=None):
+
+    if tail_buffer is None:
+        tail_buffer = deque(maxlen=0)
+
+    prefix = f"[{tag}] " if tag else ""
+
+    log("console", f"# RUNNING CONSOLE COMMAND {prefix}#\n")
+    log("console", f"> {MAGENTA}{' '.join(args)}{GRAY}\n")
+
+    start_time = time.monotonic()
+    full_output = []
+
+    process = await asyncio.create_subprocess_exec(
+        *args,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT,
+        limit=1024 * 1024
+    )
+
+    stalled = False
+    pending = b""
+
+    try:
+        while True:
+
+            try:
+                chunk = await asyncio.wait_for(process.stdout.read(64 * 1024), stall_timeout)
+
+            except asyncio.TimeoutError:
+                stalled = True
+                log("info", f"\t{YELLOW}{prefix}No output for {stall_timeout} seconds. Killing the process...")
+                break
+
+            if not chunk:
+                break
+
+            # only show full lines, the rest waits for the next chunk
+            *raw_lines, pending = (pending + chunk).split(b"\n")
+
+            for raw_line in raw_lines:
+                line = raw_line.decode("utf-8", errors="replace") + "\n"
+                full_output.append(line)  # Collect output for return
+
+                show_output_line(tail_buffer, prefix + line)
+
+        if pending:
+            line = pending.decode("utf-8", errors="replace")
+            full_output.append(line)
+
+            show_output_line(tail_buffer, prefix + line)
+
+        if not stalled:
+            await process.wait()
+
+    finally:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+
+    log("console", f"\n{RESET}# END OF CONSOLE COMMAND {prefix}#\n\n")
+
+    return {
+        "tag": tag,
+        "code": process.returncode,
+        "output": ''.join(full_output),
+        "duration": time.monotonic() - start_time,
+        "stalled": stalled
+    }
+
+
 ################ End Functions ################
 
 if __name__ == "__main__":
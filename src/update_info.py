@@ -2,6 +2,10 @@ import os
 import time
 import tricks as t
 import exceptions as exc
+import tracing
+import backup_state as bs
+import channel_manifest as cm
+import backup_manifest as bm
 t.set_path()
 from res import constants as c
 
@@ -13,8 +17,13 @@ This module updates the file with information about the status of the backup.
 
 Main function: update_info()
 
-    This function traverses all JSON files in the specified folder and its subdirectories to
-    find messages with bad formatting and replace them with the corresponding fixed versions.
+    This function updates the status of the backup, and the number of messages and scenes and the dates
+    of the first and last messages of each channel, category, and the whole server.
+
+    The statistics are kept up to date in the channel manifest by the steps that change the files (merge_exports, find_all_scenes),
+    so no channel file is opened, and backup_info.json is written once.
+    If a file changed after its statistics were written down, they are taken from the backup manifest instead.
+    find_all_scenes adds up the statistics of each category again as soon as its scenes are found, with fold_category().
 
 """
 
@@ -31,16 +40,14 @@ def check_base_status():
     try: 
         t.log("debug", "\nChecking the status of the backup...")
 
-        backup_info = t.load_from_json(c.BACKUP_INFO)
+        bs.acquire("update_info")
+        state = bs.load_state()
 
         t.log("debug", "  Loaded the status file\n")
 
-        t.log("debug", f"  The current status of the backup is '{backup_info["status"]}'\n")
+        t.log("debug", f"  The current status of the backup is '{state["status"]}'\n")
 
-        if backup_info["status"] == "running":
-            raise exc.AlreadyRunningError("The export is still running in another process. Exiting...")
-        
-        if backup_info["status"] == "failed":
+        if state["status"] == "failed":
             raise exc.DataNotReadyError("The data may be corrupted. Ensure the backup downloaded successfully and try again.")
 
     except (exc.AlreadyRunningError, exc.DataNotReadyError) as e:
@@ -50,104 +57,134 @@ def check_base_status():
         raise exc.UpdateInfoError("The export status file could not be read") from e
     
 
-def check_overall_status():
+"""
+set_overall_status()
+
+    Sets the status of the backup from the status of its steps.
+
+"""
+def set_overall_status():
 
-    info = t.load_from_json(c.BACKUP_INFO)
+    steps = bs.load_state()["steps"]
 
-    # check if all statuses in info["steps"] are "success"
-    if all(info["steps"][key] == "success" for key in info["steps"]):
-        info["status"] = "success"
+    # check if all statuses in steps are "success"
+    if all(steps[key] == "success" for key in steps):
+        status = "success"
 
     # if any status is "failed"
-    elif any(info["steps"][key] == "failed" for key in info["steps"]):
-        info["status"] = "failed"
+    elif any(steps[key] == "failed" for key in steps):
+        status = "failed"
 
     else:
-        info["status"] = "pending"
+        status = "pending"
 
-    t.log("info", f"  The current status of the backup is '{info['status']}'\n")
-    
-    t.save_to_json(info, c.BACKUP_INFO)
+    bs.update_state(status=status)
 
-def get_category_folder(category):
+    t.log("info", f"  The current status of the backup is '{status}'\n")
 
-    folder_name = category["category"].replace(":", "_")
-    return os.path.join(c.SERVER_NAME, f"{category['position']}# {folder_name}")
+"""
+get_channel_stats(channel, manifest, file_manifest)
 
-def count_scenes_in_category(category=None):
+    Gets the statistics of a channel from the channel manifest.
 
-    info = t.load_from_json(c.BACKUP_INFO)
+    If the backup manifest has a newer version of the file, its number of messages is used, and the dates of
+    the first and last messages are taken from their IDs, in local time like the timestamps of DCE.
+    The channel manifest is left as it is, since its watermark is only moved by the download and the merge.
+    Channels that are in neither manifest yet (backups made before they kept statistics) are read once,
+    and written down in the channel manifest, so the next time they don't have to be read.
 
-    if category is not None:
-        scenes_folder = get_category_folder(category)
-        scenes_file = f"{scenes_folder}/scenes.json"
-    else:
-        scenes_file = f"{c.SERVER_NAME}/scenes.json"
-    
-    try:
-        scenes = t.load_from_json(scenes_file)
-    except FileNotFoundError:
-        t.log("debug", f"{t.YELLOW}  {scenes_file} does not exist. Skipping...")
-        scenes = []
-    except Exception as e:
-        t.log("debug", f"{t.YELLOW}  {scenes_file} could not be read: {e}. Skipping...")
-        scenes = []
-
-    if category is not None:
-        # find category in info["categories"]
-        for cat in info["categories"]:
-            if cat["category"] == category["category"]:
-                cat["numberOfScenes"] = len(scenes)
-    else:
-        info["numberOfScenes"] = len(scenes)
+    Returns:
+        dict: The statistics of the channel, with the format of its entry in the manifest.
+"""
+def get_channel_stats(channel, manifest, file_manifest):
 
-    t.log("debug", f"\t  Found {len(scenes)} scenes in {scenes_file}")
+    channel_file = os.path.join(c.SERVER_NAME, channel["path"])
 
-    t.save_to_json(info, c.BACKUP_INFO)
+    entry = manifest.get(channel["id"], {})
+    record = bm.lookup(file_manifest, channel_file)
 
+    if record is not None and (entry.get("messageCount"), entry.get("lastMessageId")) != (record["message_count"], record["last_message_id"]):
 
-def count_scenes_in_channel(channel):
+        t.log("debug", "\t  %s changed. Using the backup manifest...", channel.get("thread", channel["channel"]))
 
-    channel_file = os.path.join(c.SERVER_NAME, channel["path"])
+        entry = {**entry, "messageCount": record["message_count"]}
 
-    # count the number of messages
-    channel_data = t.load_from_json(channel_file)
-    numberOfMessages = channel_data["messageCount"]
+        if record["message_count"] > 0:
+            entry["lastMessageAt"] = t.snowflake_to_datetime(record["last_message_id"]).astimezone().isoformat(timespec="milliseconds")
+            entry["firstMessageAt"] = t.snowflake_to_datetime(record["first_message_id"]).astimezone().isoformat(timespec="milliseconds")
 
-    t.log("debug", f"\t  Found {numberOfMessages} messages in {channel["channel"]}")
+    elif "messageCount" not in entry:
 
-    scenes_file = channel_file.replace(".json", "_scenes.json")
-    scenes_file = os.path.join(os.path.dirname(scenes_file), "Scenes", os.path.basename(scenes_file))
+        t.log("debug", "\t  %s has no statistics yet. Reading %s...", channel.get("thread", channel["channel"]), channel_file)
 
-    # count the number of scenes
-    try:
-        scenes = t.load_from_json(scenes_file)
-        numberOfScenes = len(scenes)
-    except FileNotFoundError:
-        t.log("debug", f"{t.YELLOW}  {scenes_file} does not exist. Skipping...")
-        numberOfScenes = 0
-    except Exception as e:
-        t.log("debug", f"{t.YELLOW}  {scenes_file} could not be read: {e}. Skipping...")
-        numberOfScenes = 0
+        cm.update_channel(manifest, t.load_from_json(channel_file))
+        entry = manifest[channel["id"]]
 
-    t.log("debug", f"\t  Found {numberOfScenes} scenes in {scenes_file}")
+    return entry
 
-    return numberOfMessages, numberOfScenes
+"""
+fold_category(category, manifest, file_manifest)
 
+    Copies the statistics of each channel and thread of a category from the manifest to the list of channels,
+    and adds them up for the category.
 
-def count_scenes_in_thread(channel):
+"""
+def fold_category(category, manifest, file_manifest):
 
-    channel_file = os.path.join(c.SERVER_NAME, channel["path"])
+    category["numberOfMessages"] = 0
+    category["numberOfScenes"] = 0
+
+    for channel in category["channels"] + category["threads"]:
+
+        entry = get_channel_stats(channel, manifest, file_manifest)
 
-    # count the number of messages
-    channel_data = t.load_from_json(channel_file)
-    numberOfMessages = channel_data["messageCount"]
+        channel["numberOfMessages"] = entry.get("messageCount", 0)
+        channel["firstMessageAt"] = entry.get("firstMessageAt")
+        channel["lastMessageAt"] = entry.get("lastMessageAt")
 
-    return numberOfMessages
+        # scenes are only kept for channels, but the scenes of threads count for their category
+        scenes = entry.get("numberOfScenes", channel.get("numberOfScenes", 0))
+
+        if "thread" not in channel:
+            channel["numberOfScenes"] = scenes
+
+        category["numberOfMessages"] += channel["numberOfMessages"]
+        category["numberOfScenes"] += scenes
+
+    t.log("debug", "\t  Found %d messages and %d scenes in %s", category["numberOfMessages"], category["numberOfScenes"], category["category"])
+
+"""
+add_up_categories(backup_info)
+
+    Adds up the statistics of the categories for the whole server.
+
+"""
+def add_up_categories(backup_info):
+
+    backup_info["numberOfMessages"] = sum(category.get("numberOfMessages", 0) for category in backup_info["categories"])
+    backup_info["numberOfScenes"] = sum(category.get("numberOfScenes", 0) for category in backup_info["categories"])
+
+"""
+fold_stats(backup_info, manifest, file_manifest)
+
+    Copies the statistics of each channel and thread from the manifest to the list of channels,
+    and adds them up for each category and for the whole server.
+
+"""
+def fold_stats(backup_info, manifest, file_manifest):
+
+    for category in backup_info["categories"]:
+
+        with tracing.span(category["category"], "category"):
+            fold_category(category, manifest, file_manifest)
+            tracing.add(messages=category["numberOfMessages"], scenes=category["numberOfScenes"])
+
+    add_up_categories(backup_info)
 
 
 ################# Main function #################
 
+@tracing.traced("step")
 def update_info():
 
     try:
@@ -158,38 +195,32 @@ def update_info():
 
         check_base_status()
 
-        # check if all steps are "success"
-        check_overall_status()
-
-        # count the number of scenes
-        count_scenes_in_category()
-
-        t.log("debug", "\n  Analyzing the channels in the backup... ###")
-        
         backup_info = t.load_from_json(c.BACKUP_INFO)
+        manifest = cm.load_manifest()
 
-         # For each category in the channel list
-        for category in backup_info["categories"]:
-
-            count_scenes_in_category(category)
-
-            t.log("debug", f"\n\t  Analyzing {category["category"]}... ###")
+        # check if all steps are "success"
+        set_overall_status()
 
-            for channel in category["channels"]:
+        # the status is kept by backup_state, so the copy that older versions kept in the list of channels is removed
+        for key in ("status", "steps", "dates"):
+            backup_info.pop(key, None)
 
-                channel["numberOfMessages"], channel["numberOfScenes"] = count_scenes_in_channel(channel)
-                t.save_to_json(backup_info, c.BACKUP_INFO)
+        t.log("debug", "\n  Adding up the statistics of the channels in the backup... ###")
 
-            for thread in category["threads"]:
+        with bm.open_manifest() as file_manifest:
+            fold_stats(backup_info, manifest, file_manifest)
 
-                thread["numberOfMessages"] = count_scenes_in_thread(thread)
-                t.save_to_json(backup_info, c.BACKUP_INFO)
+        t.log("info", f"\tThe backup has {backup_info['numberOfMessages']} messages and {backup_info['numberOfScenes']} scenes")
 
+        # the manifest only changes if some channel had no statistics yet, or they were out of date
+        cm.save_manifest(manifest)
+        t.save_to_json(backup_info, c.BACKUP_INFO)
 
     except Exception as e:
         raise exc.UpdateInfoError("Failed to update backup info") from e
     
     finally:
+        bs.release()
         t.log("base", f"### Finished updating info --- {time.time() - start_time:.2f} seconds --- ###\n")
 
 